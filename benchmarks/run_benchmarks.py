@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+"""
+run_benchmarks.py
+
+Times the stages of meds/match_meds.py, diagnoses/match_diags.py and
+locations/generate_locs.py on synthetic inputs (see synthetic.py), at one
+or more scales from a thousand to a million rows, and writes the timings to
+benchmarks/results/<commit>.json. Comparing the file of one commit with
+another's shows what got faster or slower:
+
+    benchmarks/run_benchmarks.py --scale 1000 --scale 100000
+    benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.json
+
+benchmarks/results/ is ignored by git, so that running the benchmarks
+doesn't leave changes in the tree; -o writes the timings elsewhere.
+
+The scale is the number of rows of each dictionary, diagnosis list and
+locality catalogue. Each drug query is scored against a whole dictionary,
+so the drug lists are capped at --queries rows.
+
+Everything runs offline. The inputs are generated from the sample data
+checked in under meds/, diagnoses/ and locations/, into a temporary
+directory laid out like those, which the scripts are run from.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+REPO = synthetic.REPO
+sys.path[:0] = [os.path.join(REPO, d) for d in ["meds", "diagnoses", "locations"]]
+
+RESULTS_DIR = os.path.join(REPO, "benchmarks", "results")
+
+SCALES = [1000]
+QUERIES = 1000
+REPEAT = 1
+
+# How much slower than the baseline a stage can get before --compare
+# reports it as a regression
+TOLERANCE = 0.25
+# Differences smaller than this, in seconds, are put down to noise
+NOISE = 0.01
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the scripts' progress messages and bars"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+        devnull
+    ), contextlib.redirect_stderr(devnull):
+        yield
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    """Runs the block from `directory`, which the scripts' paths are relative to"""
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+class Stages:
+    """Times stages and collects their timings"""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        # {stage: {"seconds": fastest, "runs": [seconds], ...}}
+        self.timings = {}
+
+    def time(self, name, run, setup=None, **info):
+        """
+        Runs `run` `repeat` times, after `setup` each time, and records the
+        fastest run as the stage's time.
+
+        Returns:
+            what the last run of `run` returned
+        """
+        runs = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            with quiet():
+                start = time.perf_counter()
+                result = run()
+                runs.append(time.perf_counter() - start)
+        self.timings[name] = dict(
+            seconds=round(min(runs), 4), runs=[round(r, 4) for r in runs], **info
+        )
+        print("  {:<36} {:10.3f}s".format(name, min(runs)))
+        return result
+
+
+def bench_meds(directory, scale, args):
+    """The loading, cleaning and automatic stages of match_meds.py"""
+    import match_meds
+    import normalize
+
+    names = synthetic.sample_drug_names()
+    queries = min(scale, args.queries)
+    os.makedirs(os.path.join(directory, "input"))
+    with working_directory(directory):
+        synthetic.write_hum_csv(match_meds.HUM_CSV, scale, args.seed, names)
+        synthetic.write_ciel_json(match_meds.CIEL_JSON, scale, args.seed, names)
+        synthetic.write_ssa_csv(match_meds.SSA_CSV, queries, args.seed, names)
+
+        match_meds.MODE = "ssa"
+        match_meds.USE_CACHE = False
+        match_meds.BACKEND = args.backend
+        match_meds.WORKERS = args.workers
+
+        def clear_caches():
+            for clean in [
+                normalize.clean_ssa_drug_name,
+                normalize.clean_hum_drug_name,
+                normalize.clean_ciel_drug_name,
+            ]:
+                clean.cache_clear()
+
+        def read_input():
+            ssa_csv = match_meds.clean_csv_list(
+                match_meds.csv_as_list(match_meds.SSA_CSV)
+            )
+            return [
+                (l[0], l[1], l[2], match_meds.clean_ssa_drug_name(l[1]))
+                for l in ssa_csv
+            ]
+
+        stages = Stages(args.repeat)
+        input_data = stages.time("read_input", read_input, clear_caches, rows=queries)
+        hum = stages.time(
+            "load_hum_dictionary",
+            match_meds.load_hum_dictionary,
+            clear_caches,
+            rows=scale,
+        )
+        ciel = stages.time(
+            "load_ciel_dictionary",
+            match_meds.load_ciel_dictionary,
+            clear_caches,
+            rows=scale,
+        )
+        stages.time(
+            "extract_good_matches_hum",
+            lambda: match_meds.extract_good_matches_hum(input_data, hum),
+            queries=len(input_data),
+            dictionary=len(hum.codes_to_names),
+            backend=args.backend,
+        )
+        stages.time(
+            "extract_good_matches_ciel",
+            lambda: match_meds.extract_good_matches_ciel(input_data, ciel),
+            queries=len(input_data),
+            dictionary=len(ciel.codes_to_names),
+            backend=args.backend,
+        )
+    return stages.timings
+
+
+def bench_diagnoses(directory, scale, args):
+    """Joining the SSA diagnoses to the concept sources, and all of match_diags.py"""
+    from icd_join import IcdIndex, cascade_match
+    import match_diags
+
+    os.makedirs(os.path.join(directory, "input"))
+    with working_directory(directory):
+        synthetic.write_diagnoses("input", scale, args.seed)
+        ssa_data = match_diags.clean_csv_list(
+            match_diags.csv_as_list(match_diags.SSA_CSV)
+        )
+        sources = [
+            match_diags.clean_csv_list(match_diags.csv_as_list(match_diags.PIH_CSV)),
+            match_diags.clean_csv_list(match_diags.csv_as_list(match_diags.CIEL_CSV)),
+            list(
+                match_diags.iter_json_fields(
+                    match_diags.OCL_JSON, ["from_concept_code", "to_concept_code"]
+                )
+            ),
+        ]
+
+        stages = Stages(args.repeat)
+        stages.time(
+            "match_on_icd_code",
+            lambda: match_diags.match_on_icd_code(ssa_data, sources[1]),
+            rows=len(ssa_data),
+            concepts=len(sources[1]),
+        )
+        stages.time(
+            "cascade_match",
+            lambda: cascade_match(
+                ssa_data,
+                [IcdIndex(str(i), source) for i, source in enumerate(sources)],
+            ),
+            rows=len(ssa_data),
+            concepts=sum(len(s) for s in sources),
+        )
+        stages.time("main", match_diags.main, rows=len(ssa_data))
+    return stages.timings
+
+
+def bench_locations(directory, scale, args):
+    """generate_locs.py, for the default municipalities and for a whole state"""
+    import generate_locs
+
+    os.makedirs(os.path.join(directory, "input"))
+    with working_directory(directory):
+        synthetic.write_localidad_csv(generate_locs.LOCALIDAD_CSV, scale, args.seed)
+        with open(generate_locs.DEFAULT_MUNS_FILE, "w", encoding="utf8") as f:
+            with open(
+                os.path.join(REPO, "locations", generate_locs.DEFAULT_MUNS_FILE),
+                encoding="utf8",
+            ) as sample:
+                f.write(sample.read())
+        muns = generate_locs.read_mun_names(generate_locs.DEFAULT_MUNS_FILE)
+
+        stages = Stages(args.repeat)
+        stages.time(
+            "generate_locs",
+            lambda: generate_locs.main(
+                [generate_locs.DEFAULT_STATE], muns, generate_locs.CHUNK_SIZE
+            ),
+            rows=scale,
+        )
+        stages.time(
+            "generate_locs_whole_state",
+            lambda: generate_locs.main(
+                [generate_locs.DEFAULT_STATE], [], generate_locs.CHUNK_SIZE
+            ),
+            rows=scale,
+        )
+    return stages.timings
+
+
+SUITES = {
+    "meds": bench_meds,
+    "diagnoses": bench_diagnoses,
+    "locations": bench_locations,
+}
+
+
+def git(*args):
+    """The output of a git command run in the repo, or None if it fails"""
+    try:
+        return subprocess.run(
+            ["git"] + list(args), cwd=REPO, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def same_inputs(timing, baseline_timing):
+    """Whether two timings of a stage were of the same sizes of input"""
+    if baseline_timing is None:
+        return False
+    sizes = {k: v for k, v in timing.items() if k not in ["seconds", "runs"]}
+    return sizes == {
+        k: v for k, v in baseline_timing.items() if k not in ["seconds", "runs"]
+    }
+
+
+def compare(report, baseline_filename, tolerance):
+    """
+    Prints how each stage's time compares with the baseline report's, for
+    the stages that were run on the same inputs.
+
+    Returns:
+        bool: whether no stage got slower by more than `tolerance`
+    """
+    with open(baseline_filename, "r", encoding="utf8") as f:
+        baseline = json.load(f)
+    print("\nCompared with {} ({}):".format(baseline_filename, baseline["commit"]))
+    ok = True
+    for scale, suites in report["results"].items():
+        for suite, timings in suites.items():
+            baseline_timings = baseline["results"].get(scale, {}).get(suite, {})
+            for stage, timing in timings.items():
+                if not same_inputs(timing, baseline_timings.get(stage)):
+                    continue
+                before = baseline_timings[stage]["seconds"]
+                ratio = timing["seconds"] / before if before else float("inf")
+                slower = ratio > 1 + tolerance and timing["seconds"] - before > NOISE
+                ok = ok and not slower
+                print(
+                    "  {:>8} {:<46} {:9.3f}s -> {:9.3f}s  {:5.2f}x{}".format(
+                        scale,
+                        suite + "." + stage,
+                        before,
+                        timing["seconds"],
+                        ratio,
+                        "  SLOWER" if slower else "",
+                    )
+                )
+    return ok
+
+
+def main(args):
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    report = {
+        "commit": commit,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "seed": args.seed,
+        "repeat": args.repeat,
+        # {scale: {suite: {stage: timing}}}
+        "results": {},
+    }
+    suites = args.suite or list(SUITES)
+    for scale in args.scale or SCALES:
+        report["results"][str(scale)] = {}
+        for suite in suites:
+            print("{} at {} rows".format(suite, scale))
+            with tempfile.TemporaryDirectory() as directory:
+                report["results"][str(scale)][suite] = SUITES[suite](
+                    os.path.join(directory, suite), scale, args
+                )
+
+    output = args.output or os.path.join(RESULTS_DIR, commit + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote the timings to " + output)
+
+    if args.compare and not compare(report, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scale",
+        type=int,
+        action="append",
+        help="how many rows to generate for each input. Can be given more than "
+        "once. Default {}.".format(SCALES[0]),
+    )
+    parser.add_argument(
+        "--suite",
+        choices=list(SUITES),
+        action="append",
+        help="which scripts to benchmark. Can be given more than once. Default all.",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=QUERIES,
+        help="the most drugs to match against the dictionaries",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=REPEAT,
+        help="how many times to run each stage, keeping the fastest",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="the seed of the synthetic inputs"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["fuzzywuzzy", "rapidfuzz"],
+        default="fuzzywuzzy",
+        help="the scoring backend of the automatic stages",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="how many processes the automatic stages run on",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="where to write the timings. Default {}.".format(
+            os.path.join("benchmarks", "results", "<commit>.json")
+        ),
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="the timings of another commit to compare with. Exits non-zero if "
+        "a stage got slower by more than the tolerance.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="how much slower a stage can get, as a fraction, before it counts "
+        "as a regression",
+    )
+    main(parser.parse_args())
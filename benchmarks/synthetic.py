@@ -0,0 +1,260 @@
+"""
+synthetic.py
+
+Writes synthetic inputs for the benchmarks, at any scale, in the layouts of
+the real files: HUM_Drug_List-13.csv, meds-ciel.json and meds-ssa.csv for
+meds/, the concept source CSVs, WHO mappings and SSA diagnosis list for
+diagnoses/, and the INEGI localidad catalogue for locations/.
+
+The rows are made by varying the sample data checked in next to each
+script: a real row is picked, the numbers in its names are replaced, and
+half the time its first word is swapped for the first word of another
+drug, so that synthetic names clean, index and score like real ones. Each
+file gets its own random generator, seeded from the seed and the file's
+name, so the same scale and seed always give the same files.
+"""
+import csv
+import json
+import os
+import random
+import re
+import uuid
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEDS_INPUT = os.path.join(REPO, "meds", "input")
+DIAGNOSES_INPUT = os.path.join(REPO, "diagnoses", "input")
+LOCATIONS_INPUT = os.path.join(REPO, "locations", "input")
+
+# The sample data the synthetic rows are varied from
+HUM_SAMPLE_CSV = os.path.join(MEDS_INPUT, "HUM_Drug_List-13.csv")
+CIEL_SAMPLE_JSON = os.path.join(MEDS_INPUT, "meds-ciel.json")
+SSA_SAMPLE_CSV = os.path.join(MEDS_INPUT, "meds-ssa.csv")
+PIH_DIAGNOSES_SAMPLE_CSV = os.path.join(DIAGNOSES_INPUT, "pih-diagnoses.csv")
+CIEL_DIAGNOSES_SAMPLE_CSV = os.path.join(DIAGNOSES_INPUT, "ciel-diagnoses.csv")
+MUNICIPIO_SAMPLE_CSV = os.path.join(LOCATIONS_INPUT, "cat_municipio_NOV2017.csv")
+# A slice of the localidad catalogue, which has its full set of columns
+LOCALIDAD_SAMPLE_CSV = os.path.join(
+    os.path.dirname(LOCATIONS_INPUT), "intermediates", "our-locs.csv"
+)
+
+# What the numbers in drug names are replaced with
+STRENGTHS = [1, 2, 4, 5, 10, 20, 25, 50, 100, 200, 250, 500, 1000]
+NUMBER = re.compile(r"\d+(\.\d+)?")
+
+# How many of the SSA diagnoses' ICD codes each source has, in the order
+# match_diags.py tries them
+DIAGNOSIS_SOURCE_COVERAGE = {"pih": 0.05, "ciel": 0.4, "ocl": 0.6}
+
+# How the INEGI codes are padded in the catalogue
+CODE_WIDTHS = {"CVE_ENT": 2, "CVE_MUN": 3, "CVE_LOC": 4}
+
+
+def generator(seed, filename):
+    """The random generator for the file called `filename`"""
+    return random.Random("{}-{}".format(seed, os.path.basename(filename)))
+
+
+def read_csv(filename):
+    with open(filename, "r", encoding="utf8", newline="") as f:
+        return [row for row in csv.reader(f) if row]
+
+
+class DrugNames:
+    """Varies real drug names into synthetic ones"""
+
+    def __init__(self, names):
+        # Lower-cased, so each source can case them its own way
+        self.first_words = sorted(
+            {n.split()[0].strip(",").lower() for n in names if n.split()}
+        )
+
+    def vary(self, name, rng, case=str.capitalize):
+        """Returns a variation of `name`, with its first word in `case`"""
+        words = name.split(" ", 1)
+        if len(words) == 2 and rng.random() < 0.5:
+            # Whatever punctuation followed the first word, like 'Aciclovir,'
+            punctuation = words[0][len(words[0].rstrip(",.")) :]
+            name = "{}{} {}".format(
+                case(rng.choice(self.first_words)), punctuation, words[1]
+            )
+        return NUMBER.sub(lambda _: str(rng.choice(STRENGTHS)), name)
+
+
+def sample_drug_names():
+    """The vocabulary of the HUM, CIEL and SSA sample data together"""
+    hum = [row[2] for row in read_csv(HUM_SAMPLE_CSV)[1:]]
+    ssa = [row[1] for row in read_csv(SSA_SAMPLE_CSV)[1:]]
+    with open(CIEL_SAMPLE_JSON, "r", encoding="utf8") as f:
+        ciel = [c["display_name"] for c in json.load(f)]
+    return DrugNames(hum + ssa + ciel)
+
+
+def write_hum_csv(filename, count, seed=0, names=None):
+    """Writes `count` rows laid out like HUM_Drug_List-13.csv"""
+    rng = generator(seed, filename)
+    names = names or sample_drug_names()
+    sample = read_csv(HUM_SAMPLE_CSV)
+    with open(filename, "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(sample[0])
+        for i in range(count):
+            template = rng.choice(sample[1:])
+            writer.writerow(
+                [
+                    str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "{}{:02d}".format(
+                        "".join(rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ") for _ in "AB"),
+                        i % 100,
+                    ),
+                    names.vary(template[2], rng),
+                    "CIEL:{}".format(100000 + i),
+                    template[4],
+                ]
+            )
+
+
+def write_ciel_json(filename, count, seed=0, names=None):
+    """
+    Writes `count` concepts laid out like meds-ciel.json, an OCL export, of
+    which one in twenty is retired
+    """
+    rng = generator(seed, filename)
+    names = names or sample_drug_names()
+    with open(CIEL_SAMPLE_JSON, "r", encoding="utf8") as f:
+        sample = json.load(f)
+    with open(filename, "w", encoding="utf8") as f:
+        f.write("[")
+        for i in range(count):
+            concept = dict(rng.choice(sample))
+            concept_id = str(100000 + i)
+            concept.update(
+                id=concept_id,
+                external_id=concept_id.ljust(36, "A"),
+                display_name=names.vary(concept["display_name"], rng),
+                retired=rng.random() < 0.05,
+                url="/orgs/CIEL/sources/CIEL/concepts/{}/".format(concept_id),
+            )
+            f.write((",\n " if i else "") + json.dumps(concept))
+        f.write("]\n")
+
+
+def write_ssa_csv(filename, count, seed=0, names=None):
+    """Writes `count` rows laid out like meds-ssa.csv"""
+    rng = generator(seed, filename)
+    names = names or sample_drug_names()
+    sample = read_csv(SSA_SAMPLE_CSV)
+    with open(filename, "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(sample[0])
+        for i in range(count):
+            template = rng.choice(sample[1:])
+            writer.writerow(
+                [
+                    "010.000.{:04d}.{:02d}".format(i // 100, i % 100),
+                    names.vary(template[1], rng, case=str.upper),
+                ]
+                + template[2:]
+            )
+
+
+def icd_codes(count, rng):
+    """
+    Returns `count` distinct ICD-10 codes, in SSA's dotless format, starting
+    with the codes of the sample concept sources
+    """
+    codes = {}
+    for filename in [PIH_DIAGNOSES_SAMPLE_CSV, CIEL_DIAGNOSES_SAMPLE_CSV]:
+        for _, code in read_csv(filename):
+            codes[code.replace(".", "")] = None
+            if len(codes) == count:
+                return list(codes)
+    while len(codes) < count:
+        code = "{}{:02d}".format(chr(ord("A") + rng.randrange(26)), rng.randrange(100))
+        suffix_length = rng.choice([0, 1, 1, 2])
+        codes[
+            code + "".join(str(rng.randrange(10)) for _ in range(suffix_length))
+        ] = None
+    return list(codes)
+
+
+def dotted(code):
+    """`code` in the format the concept sources use, like 'K73.0'"""
+    return code if len(code) <= 3 else code[:3] + "." + code[3:]
+
+
+def write_diagnoses(directory, count, seed=0):
+    """
+    Writes the inputs of match_diags.py to `directory`, with `count` SSA
+    diagnoses, and sources covering DIAGNOSIS_SOURCE_COVERAGE of them
+
+    Returns:
+        {what: filename}
+    """
+    rng = generator(seed, "diagnoses")
+    codes = icd_codes(count, rng)
+    filenames = {
+        "ssa": os.path.join(directory, "ssa-diagnoses.csv"),
+        "pih": os.path.join(directory, "pih-diagnoses.csv"),
+        "ciel": os.path.join(directory, "ciel-diagnoses.csv"),
+        "ocl": os.path.join(directory, "who-diagnoses.json"),
+    }
+    # The SSA list has the ICD code at 2 and the name at 4
+    with open(filenames["ssa"], "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "capitulo", "clave", "grupo", "nombre"])
+        for i, code in enumerate(codes):
+            writer.writerow([i, "-", code, "-", "Diagnostico {}".format(code)])
+    for source in ["pih", "ciel"]:
+        coverage = DIAGNOSIS_SOURCE_COVERAGE[source]
+        with open(filenames[source], "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            for code in codes:
+                if rng.random() < coverage:
+                    writer.writerow([rng.randrange(1, count * 2), dotted(code)])
+    with open(filenames["ocl"], "w", encoding="utf8") as f:
+        mappings = [
+            {
+                "from_concept_code": str(rng.randrange(1, count * 2)),
+                "to_concept_code": dotted(code),
+                "map_type": "SAME-AS",
+            }
+            for code in codes
+            if rng.random() < DIAGNOSIS_SOURCE_COVERAGE["ocl"]
+        ]
+        json.dump(mappings, f)
+    return filenames
+
+
+def write_localidad_csv(filename, count, seed=0):
+    """
+    Writes `count` localities laid out like INEGI's cat_localidad CSV, in
+    latin1 with padded codes, spread evenly over the real municipalities
+    """
+    rng = generator(seed, filename)
+    municipalities = read_csv(MUNICIPIO_SAMPLE_CSV)[1:]
+    sample = read_csv(LOCALIDAD_SAMPLE_CSV)
+    header = sample[0]
+    locality_names = [row[header.index("NOM_LOC")] for row in sample[1:]]
+    with open(filename, "w", encoding="latin1", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        for m, (cve_ent, nom_ent, nom_abr, cve_mun, nom_mun) in enumerate(
+            row[:5] for row in municipalities
+        ):
+            localities = count * (m + 1) // len(municipalities) - count * m // len(
+                municipalities
+            )
+            for cve_loc in range(1, localities + 1):
+                row = dict(zip(header, rng.choice(sample[1:])))
+                row.update(
+                    CVE_ENT=cve_ent,
+                    NOM_ENT=nom_ent,
+                    NOM_ABR=nom_abr,
+                    CVE_MUN=cve_mun,
+                    NOM_MUN=nom_mun,
+                    CVE_LOC=str(cve_loc),
+                    NOM_LOC=rng.choice(locality_names),
+                )
+                for column, width in CODE_WIDTHS.items():
+                    row[column] = row[column].zfill(width)
+                writer.writerow([row[c] for c in header])
@@ -0,0 +1,44 @@
+"""
+inputs.py
+
+Reads the input files that the matching scripts in meds/ and diagnoses/
+have in common.
+"""
+import os
+
+import ijson
+
+
+def snapshot_path(store, filename):
+    """
+    Returns where the current snapshot in `store`, as written by
+    sources/sync_sources.py, has the file `filename` is a copy of, or
+    `filename` if it hasn't one.
+    """
+    with open(os.path.join(store, "CURRENT"), encoding="utf8") as f:
+        version = f.read().strip()
+    path = os.path.join(store, "versions", version, os.path.basename(filename))
+    if not os.path.exists(path):
+        print("Snapshot {} has no {}, reading {}".format(version, path, filename))
+        return filename
+    return path
+
+
+def iter_json_fields(filename, fields, **filters):
+    """
+    Streams the objects in the JSON array at `filename`, such as an OCL
+    export, without loading the whole file.
+
+    Args:
+        filename (str): the JSON file
+        fields (list): the keys to keep from each object
+        filters: objects are skipped unless they have these values for these keys,
+            e.g. retired=False
+
+    Yields:
+        tuple: the values of `fields` for each object, in order
+    """
+    with open(filename, "rb") as f:
+        for item in ijson.items(f, "item"):
+            if all(item.get(key) == value for key, value in filters.items()):
+                yield tuple(item[field] for field in fields)
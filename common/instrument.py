@@ -0,0 +1,216 @@
+"""
+instrument.py
+
+Times and counts what a run of a matching script spends its time on, and
+writes it out as a JSON run report.
+
+A run is split into stages, which can nest:
+
+    instrument.start("match_meds")
+    with instrument.stage("hum", queries=len(queries)):
+        ...
+        instrument.count("scorer_calls", len(queries) * len(dictionary))
+    instrument.finish("intermediates/run-report.json")
+
+Each stage records how long it took, the peak memory (resident set size)
+of the process while it ran, what it was started with, and what was
+counted while it was the innermost stage. Memory is sampled by a
+background thread every SAMPLE_INTERVAL seconds, so it doesn't include
+worker processes, and very short peaks can be missed.
+
+With a profile directory, the top-level stages are also run under cProfile,
+and their stats are written there as <n>-<stage>.prof, for pstats or
+snakeviz, and as a <n>-<stage>.txt summary of the slowest calls.
+"""
+from contextlib import contextmanager
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+# How often the memory sampler reads the process's memory use, in seconds
+SAMPLE_INTERVAL = 0.05
+
+# How many functions the profile summaries list
+PROFILE_SUMMARY_LIMIT = 30
+
+_run = None
+
+
+def current_rss_mb():
+    """
+    Returns the resident set size of this process in MB, or its peak so far
+    where the current size isn't available, or None on systems that
+    provide neither.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in KB, macOS in bytes
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+class Stage:
+    """What was recorded about one stage of the run"""
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.counts = {}
+        self.children = []
+        self.seconds = None
+        self.peak_rss_mb = current_rss_mb()
+        self._start = time.perf_counter()
+
+    def sample(self, rss_mb):
+        if rss_mb is not None and (
+            self.peak_rss_mb is None or rss_mb > self.peak_rss_mb
+        ):
+            self.peak_rss_mb = rss_mb
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def as_dict(self):
+        report = {"name": self.name, "seconds": round(self.seconds, 4)}
+        if self.peak_rss_mb is not None:
+            report["peak_rss_mb"] = round(self.peak_rss_mb, 1)
+        if self.info:
+            report["info"] = self.info
+        if self.counts:
+            report["counts"] = self.counts
+        if self.children:
+            report["stages"] = [c.as_dict() for c in self.children]
+        return report
+
+
+class Run:
+    """The stages of a run, and the sampler that tracks their memory use"""
+
+    def __init__(self, script, profile_dir):
+        self.root = Stage(script, {"argv": sys.argv[1:]})
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.profile_dir = profile_dir
+        self.profiled = 0
+        # The stages that are running, outermost first
+        self.open = [self.root]
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._done.wait(SAMPLE_INTERVAL):
+            rss_mb = current_rss_mb()
+            for stage in list(self.open):
+                stage.sample(rss_mb)
+
+    def totals(self):
+        """The counts of all the stages, added up"""
+        totals = {}
+        pending = [self.root]
+        while pending:
+            stage = pending.pop()
+            for name, n in stage.counts.items():
+                totals[name] = totals.get(name, 0) + n
+            pending += stage.children
+        return totals
+
+    def stop(self):
+        self._done.set()
+        self._sampler.join()
+        rss_mb = current_rss_mb()
+        for stage in self.open:
+            stage.sample(rss_mb)
+        self.root.stop()
+
+    def as_dict(self):
+        report = {"started": self.started, "python": sys.version.split()[0]}
+        report.update(self.root.as_dict())
+        report["totals"] = self.totals()
+        return report
+
+
+def start(script, profile_dir=None):
+    """
+    Starts recording a run of `script`. If `profile_dir` is given, the
+    top-level stages are profiled into it.
+    """
+    global _run
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    _run = Run(script, profile_dir)
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Records the time and peak memory of the code in the `with` block as a
+    stage called `name`, with `info`, such as the sizes of its inputs.
+    Does nothing if no run was started.
+    """
+    if _run is None:
+        yield
+        return
+    current = Stage(name, info)
+    _run.open[-1].children.append(current)
+    profiler = None
+    if _run.profile_dir and len(_run.open) == 1:
+        profiler = cProfile.Profile()
+    _run.open.append(current)
+    try:
+        if profiler:
+            profiler.enable()
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        # The stages around this one have been running all the while too
+        rss_mb = current_rss_mb()
+        for running in _run.open:
+            running.sample(rss_mb)
+        current.stop()
+        _run.open.remove(current)
+        if profiler:
+            _write_profile(profiler, name)
+
+
+def count(name, n=1):
+    """Adds `n` to the count called `name` of the innermost running stage"""
+    if _run is not None:
+        counts = _run.open[-1].counts
+        counts[name] = counts.get(name, 0) + n
+
+
+def finish(filename):
+    """Stops recording the run, and writes its report to `filename` as JSON"""
+    global _run
+    if _run is None:
+        return
+    _run.stop()
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(_run.as_dict(), f, indent=2)
+    print("Wrote a report of the run to " + filename)
+    _run = None
+
+
+def _write_profile(profiler, name):
+    _run.profiled += 1
+    base = os.path.join(_run.profile_dir, "{:02d}-{}".format(_run.profiled, name))
+    profiler.dump_stats(base + ".prof")
+    with open(base + ".txt", "w") as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LIMIT)
@@ -0,0 +1,132 @@
+#! env/bin/python3
+"""
+benchmark_icd_join.py
+
+Times the PIH -> CIEL -> OCL cascade in match_diags.py, run by cascade_match,
+against the list-based match_on_icd_code it replaced, on a synthetic SSA
+diagnosis list the size of ICD-10 (~70k codes). Checks that both find the
+same matches and leave the same diagnoses unmatched at each stage.
+
+The old approach is quadratic, so by default it is only timed up to 5k codes.
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+from typing import List
+
+from icd_join import IcdIndex, cascade_match, fix_ssa_icd_code
+
+SIZES = [1000, 5000, 20000, 70000]
+
+
+def synthetic_data(size: int, seed: int = 0):
+    """
+    Returns:
+        ssa_data (list): rows laid out like ssa-diagnoses.csv, with the ICD
+            code at 2 and the name at 4, in SSA's dotless format
+        sources (list): [(name, [(concept_id, icd_code)])] for PIH, CIEL and
+            OCL, covering progressively more of the SSA codes
+    """
+    rng = random.Random(seed)
+    codes = set()
+    while len(codes) < size:
+        code = "{}{:02d}".format(chr(ord("A") + rng.randrange(26)), rng.randrange(100))
+        suffix_length = rng.choice([0, 1, 1, 2])
+        codes.add(code + "".join(str(rng.randrange(10)) for _ in range(suffix_length)))
+    ssa_codes = sorted(codes)
+    ssa_data = [
+        [str(i), "-", code, "-", "Diagnostico {}".format(code)]
+        for i, code in enumerate(ssa_codes)
+    ]
+
+    sources = []
+    for name, coverage in [("PIH", 0.05), ("CIEL", 0.4), ("OCL CIEL", 0.6)]:
+        concept_data = [
+            (str(100000 + rng.randrange(size * 2)), dotted_icd_code(code))
+            for code in ssa_codes
+            if rng.random() < coverage
+        ]
+        sources.append((name, concept_data))
+    return ssa_data, sources
+
+
+def dotted_icd_code(code: str):
+    """ Like fix_ssa_icd_code, without warning about 5 character codes """
+    return code if len(code) == 3 else code[:3] + "." + code[3:]
+
+
+def match_on_icd_code_with_lists(ssa_data: List[List], concept_data: List):
+    """ The way match_diags.py used to match one source """
+    icd_code_to_ssa_name = {fix_ssa_icd_code(l[2]): l[4] for l in ssa_data}
+    icd_code_to_concept_id = {l[1]: l[0] for l in concept_data}
+    concept_id_and_ssa_name = [
+        (c[1], icd_code_to_ssa_name[c[0]])
+        for c in icd_code_to_concept_id.items()
+        if c[0] in icd_code_to_ssa_name
+    ]
+    selected_concept_ids = [l[0] for l in concept_id_and_ssa_name]
+    selected_icd_codes = [
+        k for k, v in icd_code_to_concept_id.items() if v in selected_concept_ids
+    ]
+    unmatched = [
+        l for l in ssa_data if fix_ssa_icd_code(l[2]) not in selected_icd_codes
+    ]
+    return concept_id_and_ssa_name, unmatched
+
+
+def run_old(ssa_data, sources):
+    stage_matches = []
+    unmatched = ssa_data
+    # Silence the warnings about the 5 character codes
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, concept_data in sources:
+            matches, unmatched = match_on_icd_code_with_lists(unmatched, concept_data)
+            stage_matches.append(matches)
+    return stage_matches, unmatched
+
+
+def run_new(ssa_data, sources):
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexes = [IcdIndex(name, concept_data) for name, concept_data in sources]
+        results, unmatched = cascade_match(ssa_data, indexes)
+    return [r.matches for r in results], unmatched
+
+
+def main(old_max: int):
+    print(
+        "{:>8}  {:>10}  {:>10}  {}".format(
+            "codes", "old (s)", "new (s)", "matches per stage"
+        )
+    )
+    for size in SIZES:
+        ssa_data, sources = synthetic_data(size)
+        start = time.perf_counter()
+        new_matches, new_unmatched = run_new(ssa_data, sources)
+        new_seconds = time.perf_counter() - start
+        if size <= old_max:
+            start = time.perf_counter()
+            old_matches, old_unmatched = run_old(ssa_data, sources)
+            old_column = "{:10.3f}".format(time.perf_counter() - start)
+            assert old_matches == new_matches, "matches differ at {}".format(size)
+            assert old_unmatched == new_unmatched, "unmatched differ at {}".format(size)
+        else:
+            old_column = "{:>10}".format("-")
+        print(
+            "{:>8}  {}  {:10.3f}  {}".format(
+                size, old_column, new_seconds, [len(m) for m in new_matches]
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--old-max",
+        type=int,
+        default=5000,
+        help="largest input to time the old, quadratic approach on",
+    )
+    args = parser.parse_args()
+    main(args.old_max)
@@ -0,0 +1,96 @@
+"""
+icd_join.py
+
+Joins the SSA diagnosis list against concept sources on ICD code.
+
+Each source is indexed by ICD code once. The SSA diagnoses are then run
+through the sources in order, in one pass, each diagnosis going to the
+first source that has its ICD code. This is the same as matching against
+the first source and then matching what's left against the next, but
+without re-scanning anything.
+"""
+from typing import Dict, Iterable, List, Tuple
+
+
+def fix_ssa_icd_code(code: str):
+    """
+    Fixes SSA's wierd ICD code representation.
+
+    They're supposed to look like 'K73.0', but SSA represents them like
+    'K730'. Prints the code with a warning if it is longer than 4 characters.
+    """
+    if len(code) == 3:
+        return code
+    else:
+        if len(code) > 4:
+            print("Weird SSA ICD code: " + code)
+        return code[:3] + "." + code[3:]
+
+
+class IcdIndex:
+    """ A hash index from ICD code to concept_id for one concept source """
+
+    def __init__(self, name: str, concept_data: Iterable):
+        """
+        Args:
+            name (str): what to call the source when reporting, e.g. 'PIH'
+            concept_data (iterable): (concept_id, icd_code) from the source
+        """
+        self.name = name
+        # This de-duplicates on ICD code, keeping the last concept_id for each
+        self.icd_code_to_concept_id: Dict[str, str] = {l[1]: l[0] for l in concept_data}
+
+    def __contains__(self, icd_code: str):
+        return icd_code in self.icd_code_to_concept_id
+
+    def __len__(self):
+        return len(self.icd_code_to_concept_id)
+
+
+class CascadeResult:
+    """ What cascade_match found for one source """
+
+    def __init__(self, index: IcdIndex):
+        self.index = index
+        # {icd_code: ssa_name}, for the SSA diagnoses matched to this source
+        self.icd_code_to_ssa_name: Dict[str, str] = {}
+        # How many lines of the SSA data were matched to this source
+        self.ssa_line_count = 0
+
+    @property
+    def matches(self) -> List[Tuple]:
+        """ (concept_id, ssa_name), in the order of the source's concept data """
+        return [
+            (concept_id, self.icd_code_to_ssa_name[icd_code])
+            for icd_code, concept_id in self.index.icd_code_to_concept_id.items()
+            if icd_code in self.icd_code_to_ssa_name
+        ]
+
+
+def cascade_match(
+    ssa_data: List[List], indexes: List[IcdIndex]
+) -> Tuple[List[CascadeResult], List]:
+    """
+    Matches each SSA diagnosis to the first of `indexes` which has its ICD code.
+
+    Args:
+        ssa_data (list): data from the SSA diagnoses CSV file
+        indexes (list[IcdIndex]): the sources to match against, in order of
+            preference
+
+    Returns:
+        results (list[CascadeResult]): what was matched to each source
+        unmatched_ssa (list): entries from ssa_data which were not matched
+    """
+    results = [CascadeResult(index) for index in indexes]
+    unmatched = []
+    for l in ssa_data:
+        icd_code = fix_ssa_icd_code(l[2])
+        for result in results:
+            if icd_code in result.index:
+                result.icd_code_to_ssa_name[icd_code] = l[4]
+                result.ssa_line_count += 1
+                break
+        else:
+            unmatched.append(l)
+    return results, unmatched
@@ -6,11 +6,19 @@ Attempts to match diagnoses from SSA (Mexican MoH) diagnosis list with
 those in the PIH concepts server (icd-pih.csv) and, secondarily, CIEL
 (icd-ciel.csv).
 """
+import argparse
 import csv
-import json
 import os
+import sys
 from typing import Dict, List, Tuple
 
+from icd_join import IcdIndex, cascade_match
+
+# The modules in common/ at the top of the repo are shared by the scripts
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import instrument
+from common.inputs import iter_json_fields, snapshot_path
+
 SSA_CSV = os.path.join(".", "input", "ssa-diagnoses.csv")
 PIH_CSV = os.path.join(".", "input", "pih-diagnoses.csv")
 PIH_MATCHES_CSV = os.path.join(".", "output", "diagnoses-matches-pih.csv")
@@ -18,45 +26,54 @@ CIEL_CSV = os.path.join(".", "input", "ciel-diagnoses.csv")
 CIEL_MATCHES_CSV = os.path.join(".", "output", "diagnoses-matches-ciel.csv")
 OCL_JSON = os.path.join(".", "input", "who-diagnoses.json")
 UNMATCHED_CSV = os.path.join(".", "output", "diagnoses-unmatched.csv")
+# Where each run reports how long its stages took and how much they did.
+# See common/instrument.py.
+RUN_REPORT_JSON = os.path.join(".", "output", "run-report.json")
+# Where sources/sync_sources.py keeps its snapshots of PIH_CSV, CIEL_CSV and
+# OCL_JSON, which --snapshot reads them from instead
+SNAPSHOT_STORE = os.path.join("..", "sources", "snapshots")
 
 
 def main():
     # Make sure the directories we're going to use exist
     os.makedirs(os.path.join(".", "output"), exist_ok=True)
 
-    # Match the SSA diagnoses with existing PIH diagnoses
-    ssa_data = clean_csv_list(csv_as_list(SSA_CSV))
-
-    pih_data = clean_csv_list(csv_as_list(PIH_CSV))
-    pih_id_to_ssa_name, unmatched_ssa_data = match_on_icd_code(ssa_data, pih_data)
-    print("Found {} matches from PIH concepts".format(len(pih_id_to_ssa_name)))
-    print(str(len(unmatched_ssa_data)) + " unmatched")
-    write_to_csv(pih_id_to_ssa_name, PIH_MATCHES_CSV)
-
-    # Match the remaining SSA diagnoses with diagnoses from the CIEL
-    # diagnoses that PIH has
-    ciel_data = clean_csv_list(csv_as_list(CIEL_CSV))
-    ciel_id_to_ssa_name, unmatched_ssa_data = match_on_icd_code(
-        unmatched_ssa_data, ciel_data
-    )
-    print("Found {} matches from CIEL concepts".format(len(ciel_id_to_ssa_name)))
-    print(str(len(unmatched_ssa_data)) + " unmatched")
-    write_to_csv(ciel_id_to_ssa_name, CIEL_MATCHES_CSV)
-
-    # Match the remaining SSA diagnoses with diagnoses from the WHO,
-    # as represented on the OCL website
-    ocl_data = from_json_file(OCL_JSON)
-    formatted_ocl_data = [
-        (l["from_concept_code"], l["to_concept_code"]) for l in ocl_data
-    ]
-    ocl_ciel_id_and_ssa_name, unmatched_ssa_data = match_on_icd_code(
-        unmatched_ssa_data, formatted_ocl_data
-    )
-    print(
-        "Found {} matches from OCL CIEL concepts".format(len(ocl_ciel_id_and_ssa_name))
-    )
-    print(str(len(unmatched_ssa_data)) + " unmatched")
-    write_to_csv(ocl_ciel_id_and_ssa_name, CIEL_MATCHES_CSV)
+    with instrument.stage("read_input", file=SSA_CSV):
+        ssa_data = clean_csv_list(csv_as_list(SSA_CSV))
+        instrument.count("queries", len(ssa_data))
+
+    # Match the SSA diagnoses with existing PIH diagnoses, then the remainder
+    # with the CIEL diagnoses that PIH has, and then the remainder of that
+    # with diagnoses from the WHO, as represented on the OCL website
+    with instrument.stage("load_pih", file=PIH_CSV):
+        pih_index = IcdIndex("PIH", clean_csv_list(csv_as_list(PIH_CSV)))
+        instrument.count("dictionary_entries", len(pih_index))
+    with instrument.stage("load_ciel", file=CIEL_CSV):
+        ciel_index = IcdIndex("CIEL", clean_csv_list(csv_as_list(CIEL_CSV)))
+        instrument.count("dictionary_entries", len(ciel_index))
+    with instrument.stage("load_ocl", file=OCL_JSON):
+        ocl_index = IcdIndex(
+            "OCL CIEL",
+            iter_json_fields(OCL_JSON, ["from_concept_code", "to_concept_code"]),
+        )
+        instrument.count("dictionary_entries", len(ocl_index))
+    with instrument.stage("cascade_match", queries=len(ssa_data)):
+        results, unmatched_ssa_data = cascade_match(
+            ssa_data, [pih_index, ciel_index, ocl_index]
+        )
+        instrument.count("matched_lines", sum(r.ssa_line_count for r in results))
+
+    remaining = len(ssa_data)
+    for result, filename in zip(
+        results, [PIH_MATCHES_CSV, CIEL_MATCHES_CSV, CIEL_MATCHES_CSV]
+    ):
+        matches = result.matches
+        remaining -= result.ssa_line_count
+        print(
+            "Found {} matches from {} concepts".format(len(matches), result.index.name)
+        )
+        print(str(remaining) + " unmatched")
+        write_to_csv(matches, filename)
 
     write_to_csv(unmatched_ssa_data, UNMATCHED_CSV)
 
@@ -76,24 +93,8 @@ def match_on_icd_code(
         matches (list[tuple]): (concept_id, ssa_name) tuples
         unmatched_ssa (list): entries from ssa_data which were not matched
     """
-    icd_code_to_ssa_name = {fix_ssa_icd_code(l[2]): l[4] for l in ssa_data}
-
-    # Put concept_data into a dict, which will de-duplicate on ICD code
-    icd_code_to_concept_id = {l[1]: l[0] for l in concept_data}
-
-    concept_id_and_ssa_name = [
-        (c[1], icd_code_to_ssa_name[c[0]])
-        for c in icd_code_to_concept_id.items()
-        if c[0] in icd_code_to_ssa_name
-    ]
-    selected_concept_ids = [l[0] for l in concept_id_and_ssa_name]
-    selected_icd_codes = [
-        k for k, v in icd_code_to_concept_id.items() if v in selected_concept_ids
-    ]
-    unmatched = [
-        l for l in ssa_data if fix_ssa_icd_code(l[2]) not in selected_icd_codes
-    ]
-    return concept_id_and_ssa_name, unmatched
+    (result,), unmatched = cascade_match(ssa_data, [IcdIndex("", concept_data)])
+    return result.matches, unmatched
 
 
 def print_dict_items(data: Dict, limit: int):
@@ -113,33 +114,38 @@ def clean_csv_list(input_list: List):
     return [l for l in input_list if l != []][1:]
 
 
-def from_json_file(filename: str):
-    """ Returns a dict representation of the JSON data at `filename` """
-    with open(filename) as f:
-        return json.load(f)
-
-
-def fix_ssa_icd_code(code: str):
-    """
-    Fixes SSA's wierd ICD code representation.
-
-    They're supposed to look like 'K73.0', but SSA represents them like
-    'K730'. Prints the code with a warning if it is longer than 4 characters.
-    """
-    if len(code) == 3:
-        return code
-    else:
-        if len(code) > 4:
-            print("Weird SSA ICD code: " + code)
-        return code[:3] + "." + code[3:]
-
-
 def write_to_csv(data: List, filename: str):
     """ Writes `data` to a new CSV file at `filename`. """
-    with open(filename, "w") as csvfile:
+    with instrument.stage("write_to_csv", file=filename), open(
+        filename, "w"
+    ) as csvfile:
         writer = csv.writer(csvfile)
         writer.writerows(data)
+        instrument.count("rows_written", len(data))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="profile each stage with cProfile, writing the stats to DIR",
+    )
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        const=SNAPSHOT_STORE,
+        metavar="STORE",
+        help="read the PIH, CIEL and OCL data from the current snapshot in STORE "
+        "(default {}), as written by sync_sources.py".format(SNAPSHOT_STORE),
+    )
+    args = parser.parse_args()
+    if args.snapshot:
+        PIH_CSV = snapshot_path(args.snapshot, PIH_CSV)
+        CIEL_CSV = snapshot_path(args.snapshot, CIEL_CSV)
+        OCL_JSON = snapshot_path(args.snapshot, OCL_JSON)
+    instrument.start("match_diags", args.profile)
+    try:
+        main()
+    finally:
+        instrument.finish(RUN_REPORT_JSON)
@@ -1,42 +1,150 @@
+#! /usr/bin/env python3
+"""
+icd-suive-map-prep.py
+
+Expands the ICD-10 to SUIVE map, icd-suive.csv (columns ICD, SUIVE, Name),
+into one row per ICD code. The SUIVE catalog lists whole categories with a
+wildcard, like 'A06.X', which stands for the category 'A06' and each of its
+subcategories 'A06.0' to 'A06.9'. A wildcard without the dot, like 'A0X',
+stands for 'A00' to 'A09'.
+
+All the wildcard rows are expanded at once, by crossing them with the list
+of what each kind of wildcard stands for, and then rows that map the same
+ICD code to the same SUIVE code are dropped, keeping the first. ICD codes
+mapped to more than one SUIVE code are kept, with a warning.
+
+Writes icd-suive-expanded.csv, and with --sql, the statements that create
+the SUIVE reference terms and map the concepts with those ICD codes to them
+(see sql/dx-suive.sql).
+"""
+import argparse
+
 import pandas as pd
 
-tbl = pd.read_csv("icd-suive.csv")
-new_tbl = tbl
-
-for index, row in tbl.iterrows():
-    if row["ICD"].endswith("X"):
-        new_part = {
-            "ICD": [row["ICD"].replace("X", str(i)) for i in range(10)],
-            "SUIVE": [row["SUIVE"]] * 10,
-            "Name": [row["Name"]] * 10,
-        }
-        new_tbl_part = pd.DataFrame(new_part)
-        print(new_tbl_part)
-        new_tbl.append(new_tbl_part)
-new_tbl
-
-for index, row in tbl.iterrows():
-    if row["ICD"].endswith("X"):
-        new_part = {
-            "ICD": [row["ICD"].replace("X", str(i)) for i in range(10)]
-            + [row["ICD"].replace(".X", "")],
-            "SUIVE": [row["SUIVE"]] * 11,
-            "Name": [row["Name"]] * 11,
-        }
-        new_tbl_part = pd.DataFrame(new_part)
-        print(new_tbl_part)
-        new_tbl.append(new_tbl_part)
-
-for index, row in tbl.iterrows():
-    if row["ICD"].endswith("X"):
-        new_part = {
-            "ICD": [row["ICD"].replace("X", str(i)) for i in range(10)]
-            + [row["ICD"].replace(".X", "")],
-            "SUIVE": [row["SUIVE"]] * 11,
-            "Name": [row["Name"]] * 11,
-        }
-        new_tbl_part = pd.DataFrame(new_part)
-        print(new_tbl_part)
-        new_tbl = pd.concat([new_tbl, new_tbl_part])
-new_tbl
-new_tbl.to_csv("icd-suive.csv")
+from sql.emit_sql import BATCH_SIZE, Insert
+
+ICD_SUIVE_CSV = "icd-suive.csv"
+EXPANDED_CSV = "icd-suive-expanded.csv"
+
+# What each kind of wildcard is replaced with. '' keeps the category itself.
+WILDCARDS = pd.DataFrame(
+    [(".X", s) for s in [""] + [".{}".format(d) for d in range(10)]]
+    + [("X", str(d)) for d in range(10)],
+    columns=["wildcard", "suffix"],
+)
+
+# The OpenMRS ids the SQL uses
+SUIVE_SOURCE_ID = 57
+ICD10_SOURCE_ID = 3
+SAME_AS_MAP_TYPE_ID = 2
+CREATOR = 16404
+
+MAP_CONCEPTS_SQL = """
+-- Add mappings from concepts to their SUIVE codes, based on their ICD10 mappings
+INSERT INTO concept_reference_map
+    (creator, date_created, concept_id, uuid, concept_map_type_id, concept_reference_term_id)
+SELECT
+    {creator},   now(),     crm2.concept_id, uuid(), {map_type}              , crtsuive.concept_reference_term_id
+FROM suive_mappings sm
+INNER JOIN concept_reference_term crtsuive
+    ON crtsuive.code = sm.suive AND crtsuive.concept_source_id = {suive_source}
+INNER JOIN concept_reference_term crticd
+    ON crticd.code = sm.icd10 AND crticd.concept_source_id = {icd_source}
+INNER JOIN concept_reference_map crm2
+    ON crm2.concept_reference_term_id = crticd.concept_reference_term_id;
+
+-- Delete duplicate mappings
+DELETE crm.* FROM concept_reference_map crm
+JOIN
+    (SELECT MAX(concept_map_id) max_cmi
+        FROM concept_reference_map crm2
+        GROUP BY crm2.concept_id, crm2.concept_reference_term_id
+        HAVING COUNT(concept_id) > 1)
+    AS dup
+    ON crm.concept_map_id = dup.max_cmi;
+""".format(
+    creator=CREATOR,
+    map_type=SAME_AS_MAP_TYPE_ID,
+    suive_source=SUIVE_SOURCE_ID,
+    icd_source=ICD10_SOURCE_ID,
+)
+
+
+def expand_wildcards(tbl):
+    """
+    Args:
+        tbl (pd.DataFrame): with columns ICD, SUIVE, Name
+
+    Returns:
+        pd.DataFrame: `tbl` with each wildcard row replaced by the rows it
+            stands for, in place, and duplicate (ICD, SUIVE) rows dropped
+    """
+    tbl = tbl.assign(ICD=tbl["ICD"].str.strip().str.upper())
+    wildcard = tbl["ICD"].str.extract(r"(\.X|X)$", expand=False)
+    # What's left of the code without its wildcard, e.g. 'A06' for 'A06.X'
+    stem = tbl["ICD"].str[:-1].where(wildcard != ".X", tbl["ICD"].str[:-2])
+    tbl = tbl.assign(wildcard=wildcard, stem=stem, order=range(len(tbl)))
+    expanded = tbl[tbl["wildcard"].notna()].merge(WILDCARDS, on="wildcard")
+    expanded["ICD"] = expanded["stem"] + expanded["suffix"]
+    result = pd.concat([tbl[tbl["wildcard"].isna()], expanded])
+    result = result.sort_values("order", kind="stable")[["ICD", "SUIVE", "Name"]]
+    return result.drop_duplicates(["ICD", "SUIVE"]).reset_index(drop=True)
+
+
+def warn_about_conflicts(expanded):
+    """Prints the ICD codes that are mapped to more than one SUIVE code"""
+    suive_codes = expanded.groupby("ICD", sort=False)["SUIVE"].agg(list)
+    for icd, codes in suive_codes[suive_codes.str.len() > 1].items():
+        print(
+            "WARNING: {} is mapped to SUIVE codes {}".format(
+                icd, ", ".join(str(c) for c in codes)
+            )
+        )
+
+
+def write_sql(expanded, filename):
+    """Writes the statements of sql/dx-suive.sql for `expanded` to `filename`"""
+    suive_codes = [[str(c)] for c in expanded["SUIVE"].drop_duplicates()]
+    terms = Insert(
+        "concept_reference_term",
+        ["code"],
+        {
+            "concept_source_id": str(SUIVE_SOURCE_ID),
+            "creator": str(CREATOR),
+            "retired": "0",
+        },
+        {"date_created": "now()", "uuid": "uuid()"},
+        {},
+    )
+    mappings = Insert("suive_mappings", ["icd10", "suive"], {}, {}, {})
+    rows = expanded[["ICD", "SUIVE"]].astype(str).values.tolist()
+    with open(filename, "w", encoding="utf8") as f:
+        f.write("-- Create SUIVE code reference terms\n")
+        f.writelines(terms.statements(suive_codes, BATCH_SIZE))
+        f.write("\n-- Create a temporary table for the mappings from icd10 to SUIVE\n")
+        f.write(
+            "CREATE TEMPORARY TABLE suive_mappings (icd10 varchar(10), suive int);\n\n"
+        )
+        f.writelines(mappings.statements(rows, BATCH_SIZE))
+        f.write(MAP_CONCEPTS_SQL)
+
+
+def main(sql_filename):
+    tbl = pd.read_csv(ICD_SUIVE_CSV, dtype={"ICD": str})
+    expanded = expand_wildcards(tbl)
+    warn_about_conflicts(expanded)
+    expanded.to_csv(EXPANDED_CSV, index=False)
+    print(
+        "Expanded {} rows into {} ICD codes".format(len(tbl), expanded["ICD"].nunique())
+    )
+    if sql_filename:
+        write_sql(expanded, sql_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sql", metavar="FILE", help="also write the SUIVE mapping SQL to FILE"
+    )
+    args = parser.parse_args()
+    main(args.sql)
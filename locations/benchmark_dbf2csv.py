@@ -0,0 +1,206 @@
+#! ./env/bin/python
+"""
+benchmark_dbf2csv.py
+
+Times dbf2csv.py on synthetic DBFs shaped like the INEGI localidad
+catalogue, with accented latin1 names. Reports the throughput of converting
+one large file at a few batch sizes, and of converting it split over several
+files in parallel.
+
+With --baseline, it also times dbf2csv.py as it was at that git revision,
+such as the last one that read the files with dbfpy, run by
+--baseline-python. dbfpy only runs on Python 2:
+
+    python2.7 -m pip install dbfpy
+    ./benchmark_dbf2csv.py --baseline e85fb6c~1 --baseline-python python2.7
+
+The synthetic files are written to a temporary directory and removed
+afterwards.
+"""
+import argparse
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbf2csv
+
+# (name, type, length)
+FIELDS = [
+    ("CVE_ENT", "C", 2),
+    ("NOM_ENT", "C", 40),
+    ("CVE_MUN", "C", 3),
+    ("NOM_MUN", "C", 80),
+    ("CVE_LOC", "C", 4),
+    ("NOM_LOC", "C", 80),
+    ("LATITUD", "N", 12),
+    ("LONGITUD", "N", 12),
+    ("PTOT", "N", 8),
+]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+NAME_WORDS = ["San", "José", "Peñitas", "Ejido", "Cañada", "Ángel", "Río", "Ocotal"]
+
+
+def write_synthetic_dbf(filename, record_count, seed=0):
+    """Writes a dBase III file of `record_count` random localities"""
+    rng = random.Random(seed)
+    record_length = 1 + sum(length for _, _, length in FIELDS)
+    header_length = 32 + 32 * len(FIELDS) + 1
+    # A pool of records to repeat, since generating each one is slow
+    pool = []
+    for i in range(1000):
+        values = [
+            str(rng.randint(1, 32)),
+            "Chiapas",
+            str(rng.randint(1, 125)),
+            " ".join(rng.sample(NAME_WORDS, 2)),
+            str(i),
+            " ".join(rng.sample(NAME_WORDS, 3)),
+            "{:.6f}".format(rng.uniform(14, 18)),
+            "{:.6f}".format(rng.uniform(90, 94)),
+            str(rng.randint(0, 9999)),
+        ]
+        record = b" " + b"".join(
+            (v.ljust(length) if t == "C" else v.rjust(length)).encode("latin1")
+            for v, (_, t, length) in zip(values, FIELDS)
+        )
+        pool.append(record)
+    with open(filename, "wb") as f:
+        f.write(
+            struct.pack(
+                "<B3BIHH20x", 3, 119, 1, 1, record_count, header_length, record_length
+            )
+        )
+        for name, field_type, length in FIELDS:
+            f.write(
+                struct.pack(
+                    "<11sc4xBB14x", name.encode("ascii"), field_type.encode(), length, 0
+                )
+            )
+        f.write(bytes([dbf2csv.HEADER_END]))
+        batch = b"".join(pool)
+        for _ in range(record_count // len(pool)):
+            f.write(batch)
+        f.write(b"".join(pool[: record_count % len(pool)]))
+        f.write(b"\x1a")
+
+
+def write_baseline(revision, directory):
+    """
+    Writes dbf2csv.py as it was at git `revision` to `directory`.
+
+    Returns:
+        str: the script's filename
+    """
+    source = subprocess.run(
+        ["git", "show", revision + ":./dbf2csv.py"],
+        cwd=HERE,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    filename = os.path.join(directory, "baseline_dbf2csv.py")
+    with open(filename, "wb") as f:
+        f.write(source)
+    return filename
+
+
+def convert_with_baseline(python, script, dbf_filename):
+    """Converts `dbf_filename` with the baseline script, next to it"""
+    subprocess.run(
+        [python, script, dbf_filename], check=True, stdout=subprocess.DEVNULL
+    )
+
+
+def report(label, seconds, size):
+    print(
+        "{:<32} {:7.2f}s {:7.1f} MB/s".format(label, seconds, size / seconds / 2 ** 20)
+    )
+
+
+def main(megabytes, files, batch_sizes, baseline=None, baseline_python=None):
+    directory = tempfile.mkdtemp()
+    try:
+        record_length = 1 + sum(length for _, _, length in FIELDS)
+        record_count = megabytes * 2 ** 20 // record_length
+        big = os.path.join(directory, "big.dbf")
+        write_synthetic_dbf(big, record_count)
+        size = os.path.getsize(big)
+        print("{} records, {:.0f} MB".format(record_count, size / 2 ** 20))
+
+        if baseline:
+            script = write_baseline(baseline, directory)
+            start = time.perf_counter()
+            convert_with_baseline(baseline_python, script, big)
+            report("dbf2csv.py at " + baseline, time.perf_counter() - start, size)
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            dbf2csv.convert(big, os.path.join(directory, "big.csv"), batch_size)
+            report(
+                "batches of {}".format(batch_size), time.perf_counter() - start, size
+            )
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("Peak memory: {:.0f} MB".format(max_rss / 1024))
+        os.remove(big)
+
+        split = os.path.join(directory, "split")
+        os.makedirs(split)
+        for i in range(files):
+            write_synthetic_dbf(
+                os.path.join(split, "part{}.dbf".format(i)), record_count // files, i
+            )
+        for workers in sorted({1, dbf2csv.WORKERS}):
+            dbf2csv.WORKERS = workers
+            start = time.perf_counter()
+            dbf2csv.main([split], None, dbf2csv.BATCH_SIZE, dbf2csv.ENCODING)
+            report(
+                "{} files, {} workers".format(files, workers),
+                time.perf_counter() - start,
+                size,
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--megabytes", type=int, default=300, help="the size of the synthetic DBF"
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=4,
+        help="how many files to split it into for the parallel run",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        action="append",
+        help="a batch size to time. Default 1000, 10000 and 100000.",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="REVISION",
+        help="also time dbf2csv.py as it was at this git revision",
+    )
+    parser.add_argument(
+        "--baseline-python",
+        default=sys.executable,
+        help="the Python to run the --baseline script with, which must have "
+        "what it imports. Default this one.",
+    )
+    args = parser.parse_args()
+    main(
+        args.megabytes,
+        args.files,
+        args.batch_size or [1000, 10000, 100000],
+        args.baseline,
+        args.baseline_python,
+    )
@@ -1,23 +1,188 @@
 #!./env/bin/python
+"""
+dbf2csv.py
 
+Converts the dBase (.dbf) files that INEGI ships its catalogues as to
+UTF-8 CSVs, written next to them (or to --output-dir) with the same name.
+Give it files, directories of them, or both; the files are converted in
+parallel, one per process.
+
+Each file is streamed: its records are read and written in batches of
+--batch-size, so memory use doesn't grow with the size of the file. The
+text is decoded from latin1, which is what INEGI uses, and can be changed
+with --encoding to any other single-byte encoding. Deleted records are
+skipped.
+
+    ./dbf2csv.py input/cat_localidad_JUN2018.dbf
+    ./dbf2csv.py --workers 4 input/
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from dbfpy import dbf
+import os
+import struct
 import sys
 
-filename = sys.argv[1]
-if filename.endswith(".dbf"):
-    print("Converting %s to csv" % filename)
-    csv_fn = filename[:-4] + ".csv"
-    with open(csv_fn, "wb") as csvfile:
-        in_db = dbf.Dbf(filename)
-        out_csv = csv.writer(csvfile)
-        names = []
-        for field in in_db.header.fields:
-            names.append(field.name)
-        out_csv.writerow(names)
-        for rec in in_db:
-            out_csv.writerow(rec.fieldData)
-        in_db.close()
-        print("Done...")
-else:
-    print("Filename does not end with .dbf")
+# How many records to read and write at a time. Can be set at runtime with
+# --batch-size.
+BATCH_SIZE = 10000
+
+# How many files to convert at once. Can be set at runtime with --workers.
+WORKERS = os.cpu_count() or 1
+
+ENCODING = "latin1"
+
+# The first byte of each record
+DELETED = b"*"
+# What ends the field descriptors in the header
+HEADER_END = 0x0D
+
+
+class DbfReader:
+    """
+    Streams the records of a dBase III/IV file, as lists of strings with
+    their padding stripped.
+    """
+
+    def __init__(self, f, encoding=ENCODING):
+        """
+        Args:
+            f: the .dbf file, opened in binary mode
+            encoding (str): the single-byte encoding of its text
+        """
+        self.f = f
+        self.encoding = encoding
+        # The record count, header length and record length, after the
+        # version byte and the date of the last update
+        self.record_count, header_length, self.record_length = struct.unpack(
+            "<xxxxIHH20x", f.read(32)
+        )
+        self.field_names = []
+        field_lengths = []
+        descriptor = f.read(32)
+        while descriptor and descriptor[0] != HEADER_END:
+            name = descriptor[:11].split(b"\0")[0].decode(encoding)
+            self.field_names.append(name)
+            field_lengths.append(descriptor[16])
+            descriptor = f.read(32)
+        f.seek(header_length)
+        # The deletion flag, then each field
+        self.record = struct.Struct(
+            "1s" + "".join("{}s".format(n) for n in field_lengths)
+        )
+        if self.record.size != self.record_length:
+            raise ValueError(
+                "The fields add up to {} bytes, but records are {} bytes".format(
+                    self.record.size, self.record_length
+                )
+            )
+
+    def batches(self, batch_size=BATCH_SIZE):
+        """Yields the records, `batch_size` at a time"""
+        remaining = self.record_count
+        while remaining > 0:
+            count = min(batch_size, remaining)
+            data = self.f.read(count * self.record_length)
+            # A truncated file ends with whatever whole records it has
+            count = len(data) // self.record_length
+            if count == 0:
+                return
+            remaining -= count
+            encoding = self.encoding
+            yield [
+                [field.decode(encoding).strip() for field in fields[1:]]
+                for fields in self.record.iter_unpack(
+                    data[: count * self.record_length]
+                )
+                if fields[0] != DELETED
+            ]
+
+
+def output_filename(dbf_filename, output_dir=None):
+    """The CSV to write `dbf_filename` to"""
+    base = os.path.splitext(dbf_filename)[0] + ".csv"
+    if output_dir:
+        return os.path.join(output_dir, os.path.basename(base))
+    return base
+
+
+def convert(dbf_filename, csv_filename, batch_size=BATCH_SIZE, encoding=ENCODING):
+    """
+    Converts the DBF at `dbf_filename` to a CSV at `csv_filename`.
+
+    Returns:
+        int: the number of records written
+    """
+    written = 0
+    with open(dbf_filename, "rb") as dbf_file, open(
+        csv_filename, "w", encoding="utf8", newline=""
+    ) as csv_file:
+        reader = DbfReader(dbf_file, encoding)
+        writer = csv.writer(csv_file)
+        writer.writerow(reader.field_names)
+        for batch in reader.batches(batch_size):
+            writer.writerows(batch)
+            written += len(batch)
+    return written
+
+
+def find_dbfs(paths):
+    """Returns the .dbf files among `paths`, and in the directories among them"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(
+                os.path.join(path, f)
+                for f in os.listdir(path)
+                if f.lower().endswith(".dbf")
+            )
+        elif path.lower().endswith(".dbf"):
+            found.append(path)
+        else:
+            print("Filename does not end with .dbf: " + path)
+    return found
+
+
+def main(paths, output_dir, batch_size, encoding):
+    dbfs = find_dbfs(paths)
+    if not dbfs:
+        sys.exit("No .dbf files to convert")
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    csvs = [output_filename(f, output_dir) for f in dbfs]
+    with ProcessPoolExecutor(max_workers=min(WORKERS, len(dbfs))) as executor:
+        counts = executor.map(
+            convert, dbfs, csvs, [batch_size] * len(dbfs), [encoding] * len(dbfs)
+        )
+        for dbf_filename, csv_filename, count in zip(dbfs, csvs, counts):
+            print(
+                "Converted {} to {} ({} records)".format(
+                    dbf_filename, csv_filename, count
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help=".dbf files or directories of them")
+    parser.add_argument(
+        "--output-dir", help="where to write the CSVs. Default next to the DBFs."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="how many records to read and write at a time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="how many files to convert at once",
+    )
+    parser.add_argument(
+        "--encoding", default=ENCODING, help="the encoding of the DBFs' text"
+    )
+    args = parser.parse_args()
+    WORKERS = args.workers
+    main(args.paths, args.output_dir, args.batch_size, args.encoding)
@@ -1,35 +1,183 @@
 #! ./env/bin/python
-#
-# The resulting AH file is generating the error:
-#
+"""
+generate_locs.py
+
+Generates the address hierarchy entries for Mexico from the INEGI
+localidad catalogue: an 'estado|municipio|localidad' entry for each
+locality of the chosen municipalities, and an 'estado|municipio' entry for
+every other municipality in the country.
+
+Writes both formats in one read of the catalogue:
+    results/mexico_address_hierarchy_entries.csv             plain names
+    results/mexico_address_hierarchy_entries_with_codes.csv  'name^code'
+
+The catalogue is read in chunks and each chunk's entries are assembled as
+whole columns and written out before the next is read, so whole states can
+be generated without holding the catalogue in memory. e.g.
+
+    ./generate_locs.py --state Chiapas --muns input/our-mun-hugo.txt
+    ./generate_locs.py --state Chiapas --state Oaxaca
+"""
+import argparse
+import os
+import re
 
 import pandas
 
-raw_locs = pandas.read_csv("input/cat_localidad_JUN2018.csv", encoding="latin1")
-our_mun_file = open("input/our-mun-hugo.txt", "r")
-our_muns = our_mun_file.readlines()
-our_muns = [l.strip().replace(",", "").replace("'", "") for l in our_muns]
-
-our_loc_rows = raw_locs[
-    (raw_locs["NOM_ENT"] == "Chiapas") & (raw_locs["NOM_MUN"].isin(our_muns))
-]
-our_locs = our_loc_rows[
-    ["NOM_ENT", "CVE_ENT", "NOM_MUN", "CVE_MUN", "NOM_LOC", "CVE_LOC"]
-]
-
-all_mun_duped = raw_locs[["NOM_ENT", "CVE_ENT", "NOM_MUN", "CVE_MUN"]]
-all_mun = all_mun_duped.drop_duplicates()
-all_mun_except_us = all_mun[~all_mun["NOM_MUN"].isin(our_muns)]
-
-loc_output = [
-    row["NOM_ENT"] + "|" + row["NOM_MUN"] + "|" + row["NOM_LOC"]
-    for index, row in our_locs.iterrows()
-]
-
-mun_output = [
-    row["NOM_ENT"] + "|" + row["NOM_MUN"] for index, row in all_mun_except_us.iterrows()
-]
-
-with open("results/mexico_address_hierarchy_entries.csv", "w") as outfile:
-    outfile.write("\n".join(loc_output))
-    outfile.write("\n".join(mun_output))
+LOCALIDAD_CSV = os.path.join("input", "cat_localidad_JUN2018.csv")
+ENTRIES_CSV = os.path.join("results", "mexico_address_hierarchy_entries.csv")
+ENTRIES_WITH_CODES_CSV = os.path.join(
+    "results", "mexico_address_hierarchy_entries_with_codes.csv"
+)
+
+# How many catalogue rows to read at a time. Can be set at runtime with
+# --chunk-size.
+CHUNK_SIZE = 50000
+
+COLUMNS = ["CVE_ENT", "NOM_ENT", "CVE_MUN", "NOM_MUN", "CVE_LOC", "NOM_LOC"]
+CODE_COLUMNS = ["CVE_ENT", "CVE_MUN", "CVE_LOC"]
+
+# The default selection, as it was before the filters were configurable
+DEFAULT_STATE = "Chiapas"
+DEFAULT_MUNS_FILE = os.path.join("input", "our-mun-hugo.txt")
+
+
+def read_mun_names(filename):
+    """Reads a list of municipality names like input/our-mun-hugo.txt"""
+    with open(filename, "r", encoding="utf8") as f:
+        names = [l.strip().replace(",", "").replace("'", "") for l in f]
+    return [n for n in names if n]
+
+
+# The leading zeros of a code, which are dropped so that '007' is written '7'
+LEADING_ZEROS = r"^0+(?=\d)"
+
+
+def clean_code(code):
+    """Drops the leading zeros of `code`"""
+    return re.sub(LEADING_ZEROS, "", code)
+
+
+def select(chunk, states, muns):
+    """
+    Returns a boolean Series of which rows of `chunk` are in one of the
+    `states` (by name or CVE_ENT) and, if `muns` isn't empty, one of `muns`
+    (by name or CVE_MUN)
+    """
+    in_states = chunk["NOM_ENT"].isin(states) | chunk["CVE_ENT"].isin(states)
+    if not muns:
+        return in_states
+    in_muns = chunk["NOM_MUN"].isin(muns) | chunk["CVE_MUN"].isin(muns)
+    return in_states & in_muns
+
+
+def entries(rows, levels, with_codes):
+    """
+    Assembles the address hierarchy entry of each of `rows`, as a Series.
+
+    Args:
+        rows (pandas.DataFrame): catalogue rows
+        levels (list): the levels of the entries, out of 'ENT', 'MUN', 'LOC'
+        with_codes (bool): whether to append '^code' to each name
+    """
+    parts = []
+    for level in levels:
+        part = rows["NOM_" + level]
+        if with_codes:
+            part = part + "^" + rows["CVE_" + level]
+        parts.append(part)
+    return parts[0].str.cat(parts[1:], sep="|")
+
+
+def write_entries(files, rows, levels):
+    """Writes the entries for `rows` to the plain and with-codes `files`"""
+    if rows.empty:
+        return
+    for f, with_codes in zip(files, [False, True]):
+        f.write("\n".join(entries(rows, levels, with_codes)) + "\n")
+
+
+def main(states, muns, chunk_size):
+    os.makedirs("results", exist_ok=True)
+    chunks = pandas.read_csv(
+        LOCALIDAD_CSV,
+        encoding="latin1",
+        usecols=COLUMNS,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+    )
+    municipalities = []
+    expanded = []
+    locality_count = 0
+    with open(ENTRIES_CSV, "w", encoding="utf8") as plain, open(
+        ENTRIES_WITH_CODES_CSV, "w", encoding="utf8"
+    ) as with_codes:
+        files = [plain, with_codes]
+        for chunk in chunks:
+            for column in CODE_COLUMNS:
+                chunk[column] = chunk[column].str.replace(LEADING_ZEROS, "", regex=True)
+            selected = select(chunk, states, muns)
+            write_entries(files, chunk[selected], ["ENT", "MUN", "LOC"])
+            locality_count += int(selected.sum())
+            mun_columns = ["CVE_ENT", "NOM_ENT", "CVE_MUN", "NOM_MUN"]
+            municipalities.append(chunk[mun_columns].drop_duplicates())
+            # Only the municipalities, so that this doesn't grow with the
+            # number of localities
+            expanded.append(
+                chunk.loc[selected, ["CVE_ENT", "CVE_MUN"]].drop_duplicates()
+            )
+
+        # Every municipality whose localities weren't written gets an entry
+        # of its own
+        municipalities = pandas.concat(municipalities).drop_duplicates()
+        expanded = pandas.concat(expanded).drop_duplicates()
+        rest = municipalities.merge(
+            expanded, on=["CVE_ENT", "CVE_MUN"], how="left", indicator=True
+        )
+        rest = rest[rest["_merge"] == "left_only"]
+        write_entries(files, rest, ["ENT", "MUN"])
+
+    print(
+        "Wrote {} localities of {} municipalities, and {} other "
+        "municipalities".format(locality_count, len(expanded), len(rest))
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--state",
+        action="append",
+        help="a state (NOM_ENT or CVE_ENT) to generate localities for. "
+        "Default {}.".format(DEFAULT_STATE),
+    )
+    parser.add_argument(
+        "--mun",
+        action="append",
+        default=[],
+        help="a municipality (NOM_MUN or CVE_MUN) to generate localities for",
+    )
+    parser.add_argument(
+        "--muns",
+        help="a file listing municipalities to generate localities for, like "
+        "input/our-mun-hugo.txt. Default {} if no --state or --mun is "
+        "given.".format(DEFAULT_MUNS_FILE),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="how many catalogue rows to read at a time",
+    )
+    args = parser.parse_args()
+    muns = args.mun
+    if args.muns:
+        muns += read_mun_names(args.muns)
+    elif not args.state and not muns:
+        muns = read_mun_names(DEFAULT_MUNS_FILE)
+    states = [
+        clean_code(s) if s.isdigit() else s for s in args.state or [DEFAULT_STATE]
+    ]
+    muns = [clean_code(m) if m.isdigit() else m for m in muns]
+    main(states, muns, args.chunk_size)
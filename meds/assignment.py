@@ -0,0 +1,115 @@
+"""
+assignment.py
+
+The one-to-one matching mode of match_meds.py (--assign). Instead of giving
+each drug its best match independently, which lets several presentations
+claim the same concept while better pairs go unused, it assigns the drugs
+to dictionary entries so that no entry is used twice and the total score is
+as high as it can be.
+
+Solving that for the whole input against the whole dictionary would mean
+scoring every pair, so drugs and entries are first split into blocks by
+their leading active ingredient, and only pairs within a block are scored
+and assigned. The block key is the start of the first word of the name
+that isn't a generic word like 'acido', with the spellings that Spanish
+and English drug names differ by folded together, so 'amoxicilina' and
+'amoxicillin' share a block, as do 'acido folico' and 'folic acid' and
+'espironolactona' and 'spironolactone'.
+"""
+from collections import defaultdict
+import re
+
+from scipy.optimize import linear_sum_assignment
+
+from common import instrument
+
+# How many letters of the leading ingredient the block key keeps. Short
+# enough for the Spanish and English names of a drug to agree.
+BLOCK_KEY_LENGTH = 5
+
+# Words that come before the name of the ingredient rather than being it
+GENERIC_WORDS = {"acido", "acid", "sodium", "sodio", "de", "y", "and"}
+
+# (pattern, replacement), applied in order to the leading word, that fold
+# the English spellings into the Spanish ones
+SPELLING_FOLDS = [
+    (re.compile(p), r)
+    for p, r in [
+        (r"^e(?=s[cpt])", ""),  # espironolactona -> spironolactona
+        (r"ph", "f"),
+        (r"th", "t"),
+        (r"ch", "c"),
+        (r"y", "i"),
+        (r"h", ""),
+        (r"(.)\1", r"\1"),  # penicillin -> penicilin
+    ]
+]
+
+# What an input drug left without an entry gets, in the form of a match
+NO_MATCH = (None, 0, None)
+
+
+def block_key(clean_name):
+    """Returns the block that `clean_name` goes in, or None if it has no words"""
+    for word in clean_name.split():
+        if word not in GENERIC_WORDS:
+            for pattern, replacement in SPELLING_FOLDS:
+                word = pattern.sub(replacement, word)
+            return word[:BLOCK_KEY_LENGTH]
+    return None
+
+
+def assign_matches(queries, codes_to_names, scorer):
+    """
+    Assigns each of `queries` to a different entry of `codes_to_names`,
+    within blocks, maximizing the total score. Queries that share a clean
+    name are assigned separately, so presentations of the same drug get
+    different entries, if there are enough of them.
+
+    Args:
+        queries (list): [clean_ssa_name]
+        codes_to_names (dict): {concept_code: clean_name}
+        scorer: the fuzzywuzzy scorer to score pairs with
+
+    Returns:
+        [(clean_name, score, concept_code)], in the same order as `queries`.
+            Queries left without an entry get NO_MATCH.
+    """
+    # {block key: [query position]}
+    query_blocks = defaultdict(list)
+    for position, query in enumerate(queries):
+        query_blocks[block_key(query)].append(position)
+    # {block key: [concept_code]}
+    entry_blocks = defaultdict(list)
+    for code, name in codes_to_names.items():
+        entry_blocks[block_key(name)].append(code)
+
+    matches = [NO_MATCH] * len(queries)
+    scored = 0
+    for key, positions in query_blocks.items():
+        codes = entry_blocks.get(key)
+        if key is None or not codes:
+            continue
+        names = [codes_to_names[c] for c in codes]
+        # Queries that share a clean name share a row of scores
+        rows = {}
+        for position in positions:
+            query = queries[position]
+            if query not in rows:
+                rows[query] = [scorer(query, n) for n in names]
+                scored += len(names)
+        scores = [rows[queries[p]] for p in positions]
+        for row, column in zip(*linear_sum_assignment(scores, maximize=True)):
+            matches[positions[row]] = (
+                names[column],
+                scores[row][column],
+                codes[column],
+            )
+
+    instrument.count("scorer_calls", scored)
+    print(
+        "Scored {} pairs in {} blocks, instead of {}".format(
+            scored, len(query_blocks), len(set(queries)) * len(codes_to_names)
+        )
+    )
+    return matches
@@ -0,0 +1,62 @@
+"""
+batch_scoring.py
+
+The rapidfuzz scoring backend for match_meds.py. Instead of scoring one query
+against the dictionary at a time, it scores a whole batch of queries against
+the whole dictionary in one `rapidfuzz.process.cdist` call, which runs
+multithreaded in C++ and returns a NumPy score matrix, and picks each
+query's best match with a vectorized argmax.
+"""
+from fuzzywuzzy import utils
+import numpy as np
+from rapidfuzz import fuzz, process
+
+# How many queries to score per cdist call, which bounds the score matrix
+# at QUERY_BATCH_SIZE x len(dictionary)
+QUERY_BATCH_SIZE = 1000
+
+
+def preprocess(name):
+    """ Processes `name` the way fuzzywuzzy does before scoring it """
+    return utils.full_process(name, force_ascii=True)
+
+
+def best_matches(queries, codes_to_names, scorer, workers=-1):
+    """
+    Like calling `fuzzywuzzy.process.extractOne(q, codes_to_names, scorer)`
+    for each q in `queries`, with the rapidfuzz implementation of `scorer`.
+
+    Args:
+        queries (list): [clean_ssa_name]
+        codes_to_names (dict): {concept_code: clean_name}
+        scorer: the fuzzywuzzy scorer, e.g. fuzz.WRatio
+        workers (int): how many threads cdist uses; -1 for all cores
+
+    Returns:
+        [(clean_name, score, concept_code)], in the same order as `queries`
+    """
+    rapidfuzz_scorer = getattr(fuzz, scorer.__name__)
+    codes = list(codes_to_names.keys())
+    names = list(codes_to_names.values())
+    processed_names = [preprocess(n) for n in names]
+
+    results = []
+    for start in range(0, len(queries), QUERY_BATCH_SIZE):
+        batch = queries[start : start + QUERY_BATCH_SIZE]
+        scores = process.cdist(
+            [preprocess(q) for q in batch],
+            processed_names,
+            scorer=rapidfuzz_scorer,
+            processor=None,
+            dtype=np.float32,
+            workers=workers,
+        )
+        # fuzzywuzzy rounds its scores to integers before comparing them
+        np.rint(scores, out=scores)
+        # argmax returns the first of equal scores, as extractOne does
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(batch)), best].astype(int)
+        results.extend(
+            (names[i], int(score), codes[i]) for i, score in zip(best, best_scores)
+        )
+    return results
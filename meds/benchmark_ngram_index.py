@@ -0,0 +1,104 @@
+#! env/bin/python3
+"""
+benchmark_ngram_index.py
+
+Compares the trigram-index shortlist used by the automatic stages of
+match_meds.py against the brute-force full-dictionary scan, on the
+drugs in meds-ssa.csv and meds-ces.csv.
+
+For each dictionary it reports how often the index finds the very same best
+match as the brute-force path, and how often it agrees on the matches that
+clear the score limit (which are the only ones that end up in the output).
+Exits non-zero if any of those differ.
+"""
+import argparse
+import sys
+import time
+
+from fuzzywuzzy import fuzz, process
+
+import match_meds
+from match_meds import (
+    CES_CSV,
+    CIEL_MATCH_SCORE_LIMIT,
+    HUM_MATCH_SCORE_LIMIT,
+    SSA_CSV,
+)
+from ngram_index import NgramIndex
+
+
+def load_queries():
+    """Returns the de-duplicated clean names from both input lists"""
+    ssa_csv = match_meds.clean_csv_list(match_meds.csv_as_list(SSA_CSV))
+    ces_csv = match_meds.clean_csv_list(match_meds.csv_as_list(CES_CSV))
+    queries = [match_meds.clean_ssa_drug_name(l[1]) for l in ssa_csv] + [
+        match_meds.clean_ces_drug_name(l[0]) for l in ces_csv
+    ]
+    return list(dict.fromkeys(queries))
+
+
+def compare(name, queries, codes_to_names, scorer, score_limit, candidates):
+    start = time.perf_counter()
+    brute = [process.extractOne(q, codes_to_names, scorer=scorer) for q in queries]
+    brute_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = NgramIndex(codes_to_names, candidates)
+    build_seconds = time.perf_counter() - start
+    indexed = [index.extract_one(q, scorer=scorer) for q in queries]
+    indexed_seconds = time.perf_counter() - start
+
+    same = sum(1 for b, i in zip(brute, indexed) if b == i)
+    accepted = [
+        (q, b, i) for q, b, i in zip(queries, brute, indexed) if b[1] > score_limit
+    ]
+    accepted_same = sum(1 for _, b, i in accepted if b == i)
+
+    print("{} ({} entries, {} queries)".format(name, len(codes_to_names), len(queries)))
+    print("  brute force:  {:.2f}s".format(brute_seconds))
+    print(
+        "  index:        {:.2f}s (of which {:.2f}s building it)".format(
+            indexed_seconds, build_seconds
+        )
+    )
+    print("  same best match:      {}/{}".format(same, len(queries)))
+    print(
+        "  same accepted match:  {}/{} (score > {})".format(
+            accepted_same, len(accepted), score_limit
+        )
+    )
+    for q, b, i in accepted:
+        if b != i:
+            print("    MISMATCH {!r}: brute {} index {}".format(q, b, i))
+    return accepted_same == len(accepted)
+
+
+def main(candidates):
+    queries = load_queries()
+    match_meds.USE_CACHE = False
+    hum_codes_to_drug_names = match_meds.load_hum_dictionary().codes_to_names
+    ciel_code_to_ciel_name = match_meds.load_ciel_dictionary().codes_to_names
+    ok = compare(
+        "HUM, WRatio",
+        queries,
+        hum_codes_to_drug_names,
+        fuzz.WRatio,
+        HUM_MATCH_SCORE_LIMIT,
+        candidates,
+    )
+    ok &= compare(
+        "CIEL, token_sort_ratio",
+        queries,
+        ciel_code_to_ciel_name,
+        fuzz.token_sort_ratio,
+        CIEL_MATCH_SCORE_LIMIT,
+        candidates,
+    )
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=match_meds.CANDIDATE_LIMIT)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.candidates) else 1)
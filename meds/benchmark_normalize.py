@@ -0,0 +1,104 @@
+#! env/bin/python3
+"""
+benchmark_normalize.py
+
+Times the name normalization pipelines in normalize.py against the inline
+re.split/re.sub functions they replaced, over the names in
+conceptDictionary1682018_1627.csv.
+
+Each pipeline is timed on a first pass over the names, which fills its memo,
+and on a second pass, which is what every later stage of a run sees. Also
+reports how many names the pipelines clean differently from the old
+functions, which should only be names with accents.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import re
+import time
+
+import normalize
+
+CONCEPT_DICTIONARY_CSV = "input/conceptDictionary1682018_1627.csv"
+
+
+def old_clean_ces_drug_name(drug_name):
+    drug_name = drug_name.lower()
+    result = re.split(r",|-|\d", drug_name)[0]
+    result = result.replace("**especial**", "")
+    result = re.sub(r"[/+]", " ", result).strip()
+    if result == "":
+        result = drug_name.split()[0]
+    return result
+
+
+def old_clean_ciel_drug_name(drug_name):
+    return drug_name.lower()
+
+
+def old_clean_hum_drug_name(drug_name):
+    drug_name = drug_name.lower()
+    result = re.split(r",|\d", drug_name)[0].strip()
+    return result
+
+
+def old_clean_ssa_drug_name(drug_name):
+    drug_name = drug_name.lower()
+    result = re.split(r",|de|-|\(|\d", drug_name)[0].strip()
+    if result == "":
+        result = drug_name.split()[0]
+    return result
+
+
+PAIRS = [
+    ("ces", old_clean_ces_drug_name, normalize.clean_ces_drug_name),
+    ("ciel", old_clean_ciel_drug_name, normalize.clean_ciel_drug_name),
+    ("hum", old_clean_hum_drug_name, normalize.clean_hum_drug_name),
+    ("ssa", old_clean_ssa_drug_name, normalize.clean_ssa_drug_name),
+]
+
+
+def load_names():
+    with open(CONCEPT_DICTIONARY_CSV, "rt", encoding="utf8") as f:
+        return [row[1] for row in list(csv.reader(f))[1:] if row and row[1].strip()]
+
+
+def time_pass(function, names):
+    start = time.perf_counter()
+    results = [function(n) for n in names]
+    return time.perf_counter() - start, results
+
+
+def main(repeat):
+    names = load_names() * repeat
+    print("{} names, {} distinct".format(len(names), len(set(names))))
+    print(
+        "{:>6}  {:>9}  {:>10}  {:>11}  {}".format(
+            "", "old (s)", "cold (s)", "memoed (s)", "cleaned differently"
+        )
+    )
+    for name, old, pipeline in PAIRS:
+        old_seconds, old_results = time_pass(old, names)
+        # Silence the warnings about names cleaned down to nothing
+        with contextlib.redirect_stdout(io.StringIO()):
+            cold_seconds, new_results = time_pass(pipeline, names)
+            warm_seconds, _ = time_pass(pipeline, names)
+        different = sum(1 for o, n in zip(old_results, new_results) if o != n)
+        print(
+            "{:>6}  {:9.3f}  {:10.3f}  {:11.3f}  {}".format(
+                name, old_seconds, cold_seconds, warm_seconds, different
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="how many times over to clean the list of names",
+    )
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,92 @@
+#! env/bin/python3
+"""
+benchmark_remainder.py
+
+Times splitting the automatic stages' results into good matches and
+remainder, as done by split_good_matches in match_meds.py, against the
+list-membership approach it replaced, on synthetic SSA lists of up to 100k
+lines.
+
+The old approach is quadratic, so by default it is only timed up to 20k lines.
+"""
+import argparse
+import random
+import time
+
+from match_meds import HUM_MATCH_SCORE_LIMIT, split_good_matches
+
+SIZES = [1000, 10000, 20000, 50000, 100000]
+
+
+def synthetic_ssa_data(size, seed=0):
+    """
+    Returns:
+        input_data: [ssa_code, ssa_name, moa, clean_ssa_name]
+        best_matches: [(clean_hum_name, score, concept_code)] for each line
+    """
+    rng = random.Random(seed)
+    # Some names repeat, as presentations of the same drug do in meds-ssa.csv
+    clean_names = ["droga {}".format(i) for i in range(size // 3 + 1)]
+    input_data = []
+    best_matches = []
+    for i in range(size):
+        clean_name = rng.choice(clean_names)
+        input_data.append(
+            (
+                "010.000.{:04d}.{:02d}".format(i // 100, i % 100),
+                "{} de {} mg, tableta".format(clean_name.upper(), rng.randint(1, 500)),
+                "-",
+                clean_name,
+            )
+        )
+        score = int(clean_name.split()[1]) % 101
+        best_matches.append((clean_name, score, "CIEL:{}".format(score)))
+    return input_data, best_matches
+
+
+def split_with_lists(input_data, best_matches, score_limit):
+    """The way the automatic stages used to compute their remainder"""
+    matches = list(zip(input_data, best_matches))
+    good_matches = [m for m in matches if m[1][1] > score_limit]
+    good_matches_formatted = [
+        [m[0][0], m[0][1], m[0][2], m[1][2], m[1][0], m[1][1]] for m in good_matches
+    ]
+    matched_clean_ssa_names = [l[0][3] for l in good_matches]
+    ssa_remainder = [l for l in input_data if l[3] not in matched_clean_ssa_names]
+    return good_matches_formatted, ssa_remainder
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(old_max):
+    print("{:>8}  {:>10}  {:>10}".format("lines", "old (s)", "new (s)"))
+    for size in SIZES:
+        input_data, best_matches = synthetic_ssa_data(size)
+        new_seconds, new = time_call(
+            split_good_matches, input_data, best_matches, HUM_MATCH_SCORE_LIMIT
+        )
+        if size <= old_max:
+            old_seconds, old = time_call(
+                split_with_lists, input_data, best_matches, HUM_MATCH_SCORE_LIMIT
+            )
+            assert old == new, "results differ at {} lines".format(size)
+            old_column = "{:10.3f}".format(old_seconds)
+        else:
+            old_column = "{:>10}".format("-")
+        print("{:>8}  {}  {:10.3f}".format(size, old_column, new_seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--old-max",
+        type=int,
+        default=20000,
+        help="largest input to time the old, quadratic approach on",
+    )
+    args = parser.parse_args()
+    main(args.old_max)
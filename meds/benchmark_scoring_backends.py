@@ -0,0 +1,92 @@
+#! env/bin/python3
+"""
+benchmark_scoring_backends.py
+
+Compares the scoring backends of match_meds.py on the drugs in meds-ssa.csv
+and meds-ces.csv, for both automatic stages:
+
+- fuzzywuzzy scoring the whole dictionary (what the stages originally did),
+- fuzzywuzzy scoring the trigram index shortlist (the default backend), and
+- rapidfuzz scoring the whole batch against the whole dictionary with cdist.
+
+Reports the time each takes, and how often the faster ones agree with the
+first on the best match, and on whether it clears the stage's score limit.
+The rapidfuzz scorers are not exactly the fuzzywuzzy ones (its partial_ratio
+finds the optimal alignment, for one), so some disagreement is expected.
+"""
+import time
+
+from fuzzywuzzy import fuzz, process
+
+import batch_scoring
+from benchmark_ngram_index import load_queries
+import match_meds
+from match_meds import CIEL_MATCH_SCORE_LIMIT, HUM_MATCH_SCORE_LIMIT
+from ngram_index import NgramIndex
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def compare(name, queries, codes_to_names, scorer, score_limit):
+    index = NgramIndex(codes_to_names, match_meds.CANDIDATE_LIMIT)
+    backends = [
+        (
+            "fuzzywuzzy, full scan",
+            lambda: [
+                process.extractOne(q, codes_to_names, scorer=scorer) for q in queries
+            ],
+        ),
+        (
+            "fuzzywuzzy, trigram index",
+            lambda: [index.extract_one(q, scorer=scorer) for q in queries],
+        ),
+        (
+            "rapidfuzz cdist",
+            lambda: batch_scoring.best_matches(queries, codes_to_names, scorer),
+        ),
+    ]
+    print("{} ({} entries, {} queries)".format(name, len(codes_to_names), len(queries)))
+    reference = None
+    for backend, run in backends:
+        seconds, results = timed(run)
+        if reference is None:
+            reference = results
+            print("  {:<26} {:7.2f}s".format(backend, seconds))
+            continue
+        same_match = sum(1 for r, b in zip(reference, results) if r[2] == b[2])
+        same_decision = sum(
+            1
+            for r, b in zip(reference, results)
+            if (r[1] > score_limit) == (b[1] > score_limit)
+            and (r[1] <= score_limit or r[2] == b[2])
+        )
+        print(
+            "  {:<26} {:7.2f}s  same best match {}/{}, same outcome {}/{}".format(
+                backend, seconds, same_match, len(queries), same_decision, len(queries),
+            )
+        )
+
+
+def main():
+    queries = load_queries()
+    match_meds.USE_CACHE = False
+    hum = match_meds.load_hum_dictionary()
+    ciel = match_meds.load_ciel_dictionary()
+    compare(
+        "HUM, WRatio", queries, hum.codes_to_names, fuzz.WRatio, HUM_MATCH_SCORE_LIMIT
+    )
+    compare(
+        "CIEL, token_sort_ratio",
+        queries,
+        ciel.codes_to_names,
+        fuzz.token_sort_ratio,
+        CIEL_MATCH_SCORE_LIMIT,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+drug_dictionary.py
+
+A compact, read-only store for the concepts of a drug dictionary (HUM or
+CIEL): their concept codes, clean names and full names, kept as columns.
+
+A dictionary is snapshotted to a binary file in intermediates/cache the
+first time it is built from its source file, and later runs memory-map that
+snapshot instead of re-reading and re-cleaning the source. Each column is a
+blob of UTF-8 strings plus an array of offsets into it, so a column that
+isn't used is never decoded.
+"""
+import mmap
+import os
+import struct
+
+from match_cache import CACHE_DIR, file_hash
+
+# Bump this when the layout below or the pipelines in normalize.py change,
+# so that snapshots built the old way get rebuilt.
+SNAPSHOT_VERSION = 2
+
+# magic, version, sha1 of the source file, number of concepts
+HEADER = struct.Struct("<8sI40sI")
+MAGIC = b"CESDICT\0"
+# length in bytes of the column's UTF-8 blob, which is padded to OFFSET_SIZE
+COLUMN_HEADER = struct.Struct("<I")
+OFFSET_TYPE = "I"
+OFFSET_SIZE = struct.calcsize(OFFSET_TYPE)
+
+COLUMNS = ("codes", "clean_names", "full_names")
+
+
+class StringColumn:
+    """ A column of strings, stored as UTF-8 in a (memory-mapped) buffer """
+
+    __slots__ = ("_offsets", "_blob")
+
+    def __init__(self, offsets, blob):
+        """
+        Args:
+            offsets (memoryview): len(column) + 1 offsets into `blob`
+            blob (memoryview): the UTF-8 strings, concatenated
+        """
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self._blob[self._offsets[i] : self._offsets[i + 1]], "utf8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class DrugDictionary:
+    """
+    The concepts of one drug dictionary, shared by all the matching stages.
+
+    Attributes:
+        name (str): 'hum' or 'ciel'
+        codes: [concept_code]
+        clean_names: [clean_name], in the same order as codes
+        full_names: [full_name], in the same order as codes
+    """
+
+    __slots__ = ("name", "codes", "clean_names", "full_names", "_codes_to_names")
+
+    def __init__(self, name, codes, clean_names, full_names):
+        self.name = name
+        self.codes = codes
+        self.clean_names = clean_names
+        self.full_names = full_names
+        self._codes_to_names = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def codes_to_names(self):
+        """ {concept_code: clean_name}, as the fuzzywuzzy scorers want it """
+        if self._codes_to_names is None:
+            self._codes_to_names = dict(zip(self.codes, self.clean_names))
+        return self._codes_to_names
+
+    def full_name(self, code):
+        """ Returns the full name of the concept with `code` """
+        # Only used for display, so a linear search is fine
+        for i, c in enumerate(self.codes):
+            if c == code:
+                return self.full_names[i]
+        raise KeyError(code)
+
+    @classmethod
+    def from_dicts(cls, name, codes_to_clean_names, codes_to_full_names):
+        """ Builds a DrugDictionary from {code: clean_name} and {code: full_name} """
+        codes = list(codes_to_clean_names)
+        return cls(
+            name,
+            codes,
+            [codes_to_clean_names[c] for c in codes],
+            [codes_to_full_names[c] for c in codes],
+        )
+
+    @classmethod
+    def load(cls, name, source_filename, build):
+        """
+        Memory-maps the snapshot of the dictionary built from
+        `source_filename`, building and snapshotting it first if there's no
+        snapshot or `source_filename` has changed since it was taken.
+
+        Args:
+            name (str): 'hum' or 'ciel'
+            source_filename (str): the input file the dictionary is built from
+            build: nullary function returning the DrugDictionary
+        """
+        source_hash = file_hash(source_filename).encode("ascii")
+        dictionary = cls.read_snapshot(name, source_hash)
+        if dictionary is None:
+            dictionary = build()
+            write_snapshot(dictionary, source_hash)
+            dictionary = cls.read_snapshot(name, source_hash)
+        return dictionary
+
+    @classmethod
+    def read_snapshot(cls, name, source_hash):
+        """ Returns None if there's no snapshot of `source_hash`'s dictionary """
+        try:
+            with open(snapshot_filename(name), "rb") as f:
+                # The mapping stays open for as long as the columns use it
+                buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(buffer) < HEADER.size:
+            return None
+        magic, version, snapshot_hash, count = HEADER.unpack_from(buffer)
+        if (magic, version, snapshot_hash) != (MAGIC, SNAPSHOT_VERSION, source_hash):
+            return None
+        position = HEADER.size
+        columns = []
+        for _ in COLUMNS:
+            (blob_size,) = COLUMN_HEADER.unpack_from(buffer, position)
+            position += COLUMN_HEADER.size
+            offsets_end = position + (count + 1) * OFFSET_SIZE
+            offsets = buffer[position:offsets_end].cast(OFFSET_TYPE)
+            columns.append(StringColumn(offsets, buffer[offsets_end:][:blob_size]))
+            position = offsets_end + blob_size
+        return cls(name, *columns)
+
+
+def snapshot_filename(name):
+    return os.path.join(CACHE_DIR, name + ".dict")
+
+
+def write_snapshot(dictionary, source_hash):
+    """ Writes `dictionary` to its snapshot file, atomically """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    filename = snapshot_filename(dictionary.name)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, SNAPSHOT_VERSION, source_hash, len(dictionary)))
+        for column in COLUMNS:
+            encoded = [s.encode("utf8") for s in getattr(dictionary, column)]
+            offsets = [0]
+            for s in encoded:
+                offsets.append(offsets[-1] + len(s))
+            blob = b"".join(encoded)
+            # Pad the blob so the next column's offsets stay aligned
+            blob += b"\0" * (-len(blob) % OFFSET_SIZE)
+            f.write(COLUMN_HEADER.pack(len(blob)))
+            f.write(struct.pack("={}{}".format(len(offsets), OFFSET_TYPE), *offsets))
+            f.write(blob)
+    os.replace(filename + ".tmp", filename)
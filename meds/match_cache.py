@@ -0,0 +1,115 @@
+"""
+match_cache.py
+
+A content-hash-keyed cache, kept in intermediates/cache, of the fuzzy match
+results for each (query, dictionary version, scorer), keyed on the hash of
+the cleaned dictionary. The dictionaries themselves are snapshotted
+alongside, by drug_dictionary.py, keyed on the hash of their source file.
+
+An entry whose hash no longer matches is thrown away and rebuilt, so editing
+an input file can never serve stale results.
+"""
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.path.join("intermediates", "cache")
+
+
+def file_hash(filename):
+    """Returns the sha1 hex digest of the contents of `filename`"""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dictionary_hash(codes_to_names):
+    """Returns a sha1 hex digest identifying the contents of a {code: name} dict"""
+    return hashlib.sha1(
+        json.dumps(list(codes_to_names.items()), ensure_ascii=False).encode("utf8")
+    ).hexdigest()
+
+
+def cache_filename(name):
+    return os.path.join(CACHE_DIR, name + ".json")
+
+
+def read_cache_file(name):
+    try:
+        with open(cache_filename(name), "rt", encoding="utf8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_cache_file(name, data):
+    """Writes `data` to the cache atomically, so a crash can't leave half a file"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    filename = cache_filename(name)
+    with open(filename + ".tmp", "wt", encoding="utf8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(filename + ".tmp", filename)
+
+
+class ScoreCache:
+    """
+    The top-`limit` match results for each query against one dictionary, with
+    one scorer. Results for a previous version of the dictionary, or computed
+    with different settings, are evicted on load.
+    """
+
+    def __init__(
+        self,
+        name,
+        codes_to_names,
+        scorer,
+        limit=1,
+        candidate_limit=None,
+        backend="fuzzywuzzy",
+    ):
+        """
+        Args:
+            name (str): which dictionary this is, e.g. 'hum' or 'ciel'
+            codes_to_names (dict): {concept_code: clean_name}
+            scorer: the fuzzywuzzy scorer the results are computed with
+            limit (int): how many results are kept per query
+            candidate_limit (int): the trigram index shortlist size used. 0
+                and None both mean the whole dictionary was scored.
+            backend (str): the library that implements the scorer
+        """
+        # Normalized, so that the file name and the key agree on it
+        candidate_limit = candidate_limit or None
+        self.name = "scores-{}-{}-{}-{}-{}".format(
+            name, backend, scorer.__name__, limit, candidate_limit or "all"
+        )
+        self.key = {
+            "dictionary_hash": dictionary_hash(codes_to_names),
+            "candidate_limit": candidate_limit,
+        }
+        cached = read_cache_file(self.name)
+        if cached is not None and cached["key"] == self.key:
+            # {query: [(name, score, concept_code)]}
+            self.results = {
+                q: [tuple(r) for r in results]
+                for q, results in cached["results"].items()
+            }
+        else:
+            self.results = {}
+        self.changed = False
+
+    def __contains__(self, query):
+        return query in self.results
+
+    def __getitem__(self, query):
+        return self.results[query]
+
+    def __setitem__(self, query, results):
+        self.results[query] = [tuple(r) for r in results]
+        self.changed = True
+
+    def save(self):
+        if self.changed:
+            write_cache_file(self.name, {"key": self.key, "results": self.results})
+            self.changed = False
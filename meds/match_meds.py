@@ -7,15 +7,32 @@ meds-ssa.csv and meds-ces.csv to PIH and CIEL concept codes
 found in HUM_Drug_List.
 """
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 from functools import partial
 import json
 import os
-import re
+import sys
 
 from fuzzywuzzy import fuzz, process
 from tqdm import tqdm
 
+from drug_dictionary import DrugDictionary
+from match_cache import ScoreCache, file_hash
+from ngram_index import NgramIndex
+from normalize import (
+    clean_ces_drug_name,
+    clean_ciel_drug_name,
+    clean_hum_drug_name,
+    clean_ssa_drug_name,
+)
+from working_store import WorkingStore, row_key
+
+# The modules in common/ at the top of the repo are shared by the scripts
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import instrument
+from common.inputs import iter_json_fields, snapshot_path
+
 MODE = None  # set to 'ces' or 'ssa' at runtime
 
 # We want to match these:
@@ -25,6 +42,9 @@ CES_CSV = os.path.join("input", "meds-ces.csv")
 # With codes from these:
 HUM_CSV = os.path.join("input", "HUM_Drug_List-13.csv")
 CIEL_JSON = os.path.join("input", "meds-ciel.json")
+# Where sources/sync_sources.py keeps its snapshots of CIEL_JSON, which
+# --snapshot reads it from instead
+SNAPSHOT_STORE = os.path.join("..", "sources", "snapshots")
 
 
 # We're going to define a bunch of filename constants that use the runtime global MODE
@@ -42,6 +62,11 @@ UNMATCHED_CIEL_AUTO_CSV = partial(
     csv_filename, "intermediates", "no-match-ciel-auto-{}.csv"
 )
 
+# The state of the matching, for both modes. See working_store.py.
+WORKING_STORE_DB = os.path.join("intermediates", "meds.sqlite")
+
+# The choice stage's state as written by older versions of this script. Still
+# read, so those sessions can be resumed. See import_legacy_state.
 CHOICE_MATCHES_INTERMEDIATE_CSV = partial(
     csv_filename, "intermediates", "choice-matches-{}.csv"
 )
@@ -55,202 +80,589 @@ CHOICE_UNMATCHED_INTERMEDIATE_CSV = partial(
 MATCHES_CHOICE_CSV = partial(csv_filename, "output", "meds-matches-choice-{}.csv")
 UNMATCHED_CSV = partial(csv_filename, "output", "meds-unmatched-{}.csv")
 
+# The drugs --batch left for a person to decide on, best candidates first
+REVIEW_CSV = partial(csv_filename, "output", "meds-review-{}.csv")
+
+# Where each run reports how long its stages took and how much they did.
+# See common/instrument.py.
+RUN_REPORT_JSON = partial(csv_filename, "intermediates", "run-report-{}.json")
+
 HUM_MATCH_SCORE_LIMIT = 80
 CIEL_MATCH_SCORE_LIMIT = 70
 
+# How many options from each dictionary the choice stage offers
+HUM_MATCH_LIMIT = 2
+CIEL_MATCH_LIMIT = 6
+
+# How many options --ensemble ranks for each dictionary: as many as the choice
+# stage offers, the best CIEL option standing in for the token_sort_ratio one
+ENSEMBLE_LIMITS = {"hum": HUM_MATCH_LIMIT, "ciel": 1 + CIEL_MATCH_LIMIT}
+
+# How many dictionary entries the trigram index shortlists for scoring, per drug.
+# Can be set at runtime with --candidates. 0 means score the whole dictionary.
+CANDIDATE_LIMIT = 50
+
+# How many processes the automatic stages spread their work across.
+# Can be set at runtime with --workers.
+WORKERS = 1
+
+# Which library scores the automatic stages: 'fuzzywuzzy', one query at a time
+# against the trigram index shortlist, or 'rapidfuzz', the whole batch of
+# queries against the whole dictionary at once. Can be set with --backend.
+BACKEND = "fuzzywuzzy"
+
+# Whether the automatic stages assign drugs to dictionary entries one-to-one,
+# within blocks that share a leading ingredient, instead of giving each drug
+# its best match. Can be set at runtime with --assign. See assignment.py.
+ASSIGN = False
+
+# Whether to rank each dictionary by one weighted ensemble of scorers, pruning
+# the entries that can't make the top, and use the same ranked lists for the
+# automatic stages and the choice stage. Can be set at runtime with
+# --ensemble. See ranking.py.
+ENSEMBLE = False
+
+# Whether to reuse the cleaned dictionaries and match scores cached in
+# intermediates/cache. Can be turned off at runtime with --no-cache.
+USE_CACHE = True
+
+# Whether to compute the options for every drug in the choice stage before
+# asking about the first one. Can be set at runtime with --precompute-choices.
+PRECOMPUTE_CHOICES = False
+
+# The decision policy that replaces the choice stage's questions when running
+# unattended. Set at runtime with --batch. None means ask. See load_batch_policy.
+BATCH_POLICY = None
+
+# Whether to only re-match the input lines that changed since the last run,
+# keeping the decisions made about the rest. Can be set at runtime with --update.
+UPDATE = False
+
+DEFAULT_BATCH_POLICY = {
+    # The automatic stages' score limits
+    "hum_accept_above": HUM_MATCH_SCORE_LIMIT,
+    "ciel_accept_above": CIEL_MATCH_SCORE_LIMIT,
+    # A drug left for the choice stage gets its best option if that scores
+    # above choice_accept_above, no match if it scores below
+    # choice_reject_below, and goes in the review queue otherwise
+    "choice_accept_above": 90,
+    "choice_reject_below": 60,
+}
+
 
 def main():
-    if MODE == "ssa":
-        ssa_csv = clean_csv_list(csv_as_list(SSA_CSV))
-        # [ssa_code, ssa_name, moa, clean_ssa_name]
-        input_data = [(l[0], l[1], l[2], clean_ssa_drug_name(l[1])) for l in ssa_csv]
-    elif MODE == "ces":
-        ces_csv = clean_csv_list(csv_as_list(CES_CSV))
-        input_data = [("-", l[0], "-", clean_ces_drug_name(l[0])) for l in ces_csv]
-
-    hum_csv = clean_csv_list(csv_as_list(HUM_CSV))
-    ciel_data = from_json_file(CIEL_JSON)
-
-    skipped_hum_auto = False
-    if os.path.isfile(MATCHES_HUM_AUTO_CSV()) and os.path.isfile(
-        UNMATCHED_HUM_AUTO_CSV()
-    ):
-        print(
-            "\nAutomatic matches from HUM found in " + MATCHES_HUM_AUTO_CSV() + " and"
-        )
-        print("unmatched after HUM auto found in " + UNMATCHED_HUM_AUTO_CSV())
-        skipped_hum_auto = True
+    with instrument.stage("read_input", file=SSA_CSV if MODE == "ssa" else CES_CSV):
+        if MODE == "ssa":
+            ssa_csv = clean_csv_list(csv_as_list(SSA_CSV))
+            # [ssa_code, ssa_name, moa, clean_ssa_name]
+            input_data = [
+                (l[0], l[1], l[2], clean_ssa_drug_name(l[1])) for l in ssa_csv
+            ]
+        elif MODE == "ces":
+            ces_csv = clean_csv_list(csv_as_list(CES_CSV))
+            input_data = [("-", l[0], "-", clean_ces_drug_name(l[0])) for l in ces_csv]
+        instrument.count("queries", len(input_data))
+
+    with instrument.stage("load_hum", file=HUM_CSV):
+        hum = load_hum_dictionary()
+        instrument.count("dictionary_entries", len(hum.codes_to_names))
+    with instrument.stage("load_ciel", file=CIEL_JSON):
+        ciel = load_ciel_dictionary()
+        instrument.count("dictionary_entries", len(ciel.codes_to_names))
+    with instrument.stage("open_working_store"):
+        store = open_working_store(input_data, hum, ciel)
+
+    if store.stage_done(MODE, "hum"):
+        print("\nAutomatic matches from HUM found in " + WORKING_STORE_DB)
     else:
         print("\nExtracting good matches from HUM...")
-        matches, unmatched_lines = extract_good_matches_hum(input_data, hum_csv)
-        save_matches_and_unmatched(
-            matches, unmatched_lines, MATCHES_HUM_AUTO_CSV(), UNMATCHED_HUM_AUTO_CSV()
-        )
+        undecided = store.undecided(MODE)
+        with instrument.stage(
+            "hum", queries=len(undecided), dictionary=len(hum.codes_to_names)
+        ):
+            matches, unmatched_lines = extract_good_matches_hum(undecided, hum)
+            store.record_matches(MODE, "hum", matches)
+            store.finish_stage(MODE, "hum")
+            instrument.count("matches", len(matches))
+            save_matches_and_unmatched(
+                store.matches(MODE, "hum"),
+                unmatched_lines,
+                MATCHES_HUM_AUTO_CSV(),
+                UNMATCHED_HUM_AUTO_CSV(),
+            )
 
-    skipped_ciel_auto = False
-    if os.path.isfile(MATCHES_CIEL_AUTO_CSV()):
-        print(
-            "\nAutomatic matches from CIEL found in " + MATCHES_CIEL_AUTO_CSV() + " and"
-        )
-        print("unmatched after CIEL auto found in " + UNMATCHED_CIEL_AUTO_CSV())
-        skipped_ciel_auto = True
+    if store.stage_done(MODE, "ciel"):
+        print("\nAutomatic matches from CIEL found in " + WORKING_STORE_DB)
     else:
         print("\nExtracting good matches from CIEL...")
-        if skipped_hum_auto:
-            unmatched_lines = csv_as_list(UNMATCHED_HUM_AUTO_CSV())
-        matches, unmatched_lines = extract_good_matches_ciel(unmatched_lines, ciel_data)
+        undecided = store.undecided(MODE)
+        with instrument.stage(
+            "ciel", queries=len(undecided), dictionary=len(ciel.codes_to_names)
+        ):
+            matches, unmatched_lines = extract_good_matches_ciel(undecided, ciel)
+            store.record_matches(MODE, "ciel", matches)
+            store.finish_stage(MODE, "ciel")
+            instrument.count("matches", len(matches))
+            save_matches_and_unmatched(
+                store.matches(MODE, "ciel"),
+                unmatched_lines,
+                MATCHES_CIEL_AUTO_CSV(),
+                UNMATCHED_CIEL_AUTO_CSV(),
+            )
+
+    if BATCH_POLICY is None:
+        print("\nOkay, now to sort through the remaining drugs.")
+        print("Always prefer one of the first two matches, if it's good.")
+    unmatched_lines = store.undecided(MODE)
+    print(str(len(unmatched_lines)) + " " + MODE + " drugs left to sort.\n")
+    # Asking includes however long the person takes to answer
+    with instrument.stage(
+        "choice",
+        queries=len(unmatched_lines),
+        decided_by="policy" if BATCH_POLICY is not None else "person",
+    ):
+        if BATCH_POLICY is not None:
+            extract_policy_matches(unmatched_lines, hum, ciel, store)
+        else:
+            extract_user_chosen_matches(unmatched_lines, hum, ciel, store)
         save_matches_and_unmatched(
-            matches, unmatched_lines, MATCHES_CIEL_AUTO_CSV(), UNMATCHED_CIEL_AUTO_CSV()
+            store.matches(MODE, "choice"),
+            store.no_match(MODE),
+            MATCHES_CHOICE_CSV(),
+            UNMATCHED_CSV(),
         )
+        if BATCH_POLICY is not None:
+            review = store.review(MODE)
+            print("{} drugs need review".format(len(review)))
+            print("Writing a csv of them, best candidates first: " + REVIEW_CSV())
+            write_to_csv(review, REVIEW_CSV())
 
-    print("\nOkay, now to sort through the remaining drugs.")
-    print("Always prefer one of the first two matches, if it's good.")
-    if os.path.isfile(CHOICE_TODO_INTERMEDIATE_CSV()):
-        unmatched_lines = csv_as_list(CHOICE_TODO_INTERMEDIATE_CSV())
+
+def open_working_store(input_data, hum, ciel):
+    """
+    Opens the working store and loads this run's input and dictionaries into
+    it. The first time `MODE` is run, whatever an older version of this
+    script left in output/ and intermediates/ is imported. With --update, the
+    decisions that no longer hold are dropped, so that the stages run again
+    on just those drugs.
+
+    Args:
+        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        hum (DrugDictionary): The HUM_Drug_List concepts
+        ciel (DrugDictionary): The CIEL drug concepts
+
+    Returns:
+        WorkingStore
+    """
+    store = WorkingStore(WORKING_STORE_DB)
+    first_run = not store.has_inputs(MODE)
+    added = store.load_inputs(MODE, input_data)
+    for dictionary, source in [(hum, HUM_CSV), (ciel, CIEL_JSON)]:
+        if store.load_concepts(dictionary, file_hash(source)):
+            print(source + " has changed since the last run")
+    if first_run:
+        import_legacy_state(store)
+    elif UPDATE:
+        print("\nComparing the input with the last run")
+        changed, removed = store.forget_stale(MODE)
+        gone = store.forget_unknown_concepts(MODE)
+        store.reset_stages(MODE)
         print(
-            "Found work-in-progress, importing from " + CHOICE_TODO_INTERMEDIATE_CSV()
+            "{} drugs to match. {} decisions were about drugs that have changed, "
+            "{} about drugs that were removed, and {} matched concepts that are "
+            "gone.".format(len(store.undecided(MODE)), changed, removed, gone)
         )
-    elif skipped_ciel_auto:
-        unmatched_lines = csv_as_list(UNMATCHED_CIEL_AUTO_CSV())
-    starting_choice_matches = (
-        csv_as_list(CHOICE_MATCHES_INTERMEDIATE_CSV())
-        if os.path.isfile(CHOICE_MATCHES_INTERMEDIATE_CSV())
-        else []
-    )
-    starting_no_match = (
-        csv_as_list(CHOICE_UNMATCHED_INTERMEDIATE_CSV())
-        if os.path.isfile(CHOICE_UNMATCHED_INTERMEDIATE_CSV())
-        else []
-    )
-    print(str(len(unmatched_lines)) + " " + MODE + " drugs left to sort.\n")
-    matches, unmatched_lines = extract_user_chosen_matches(
-        unmatched_lines, hum_csv, ciel_data, starting_choice_matches, starting_no_match
-    )
-    save_matches_and_unmatched(
-        matches, unmatched_lines, MATCHES_CHOICE_CSV(), UNMATCHED_CSV()
-    )
+    else:
+        changed, _ = store.count_stale(MODE)
+        if added or changed:
+            print(
+                "WARNING: {} drugs have been added and {} changed since the last "
+                "run. Run with --update to match them.".format(added, changed)
+            )
+    return store
 
 
-def extract_good_matches_hum(input_data, hum_csv):
+def import_legacy_state(store):
     """
-    Args:
-        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
-        hum_csv (list): The HUM_Drug_List CSV file as a list
+    Records the decisions found in the CSVs older versions of this script
+    kept its state in, and marks the automatic stages whose output is there
+    as done.
+    """
+    decisions = read_previous_decisions()
+    if not decisions:
+        return
+    print("Importing the results of the last run from output/ and intermediates/")
+    for stage in ["hum", "ciel", "choice"]:
+        store.record_matches(
+            MODE, stage, [l for s, l in decisions.values() if s == stage]
+        )
+    store.record_no_match(MODE, [l for s, l in decisions.values() if s == "none"])
+    if os.path.isfile(MATCHES_HUM_AUTO_CSV()):
+        store.finish_stage(MODE, "hum")
+    if os.path.isfile(MATCHES_CIEL_AUTO_CSV()):
+        store.finish_stage(MODE, "ciel")
+
+
+def read_previous_decisions():
+    """
+    Reads the outcome of the last run for each line of its input.
 
     Returns:
-        matches: [ssa_code, ssa_name, moa, concept_code, clean_hum_name, score]
-        unmatched_input_data: The lines from input_data with no match
+        {row_key: (stage, line)}, where stage is 'hum', 'ciel' or 'choice' for
+            a match, with line [ssa_code, ssa_name, moa, concept_code,
+            clean_other_name, score], or 'none' for a drug that was chosen to
+            have no match, with line [ssa_code, ssa_name, moa, clean_ssa_name]
+    """
+    decisions = {}
+    for stage, filename in [
+        ("hum", MATCHES_HUM_AUTO_CSV()),
+        ("ciel", MATCHES_CIEL_AUTO_CSV()),
+    ]:
+        if os.path.isfile(filename):
+            for l in csv_as_list(filename):
+                decisions[row_key(l)] = (stage, l)
+
+    # The choice stage's outputs, then its work-in-progress, which is newer if
+    # the stage was interrupted, and is gone if intermediates/ was cleared
+    for matches_filename, no_match_filename in [
+        (MATCHES_CHOICE_CSV(), UNMATCHED_CSV()),
+        (CHOICE_MATCHES_INTERMEDIATE_CSV(), CHOICE_UNMATCHED_INTERMEDIATE_CSV()),
+    ]:
+        for stage, filename in [
+            ("choice", matches_filename),
+            ("none", no_match_filename),
+        ]:
+            if os.path.isfile(filename):
+                for l in csv_as_list(filename):
+                    decisions[row_key(l)] = (stage, l)
+    return decisions
+
+
+def load_batch_policy(filename):
     """
-    # create a dict [concept code -> HUM drug name]
-    # this also serves to de-duplicate concept codes
-    # {concept_code: clean_hum_name}
-    hum_codes_to_drug_names = {l[3]: clean_hum_drug_name(l[2]) for l in hum_csv}
+    Reads a --batch decision policy, a JSON object with any of the keys of
+    DEFAULT_BATCH_POLICY, e.g.
 
-    # [(ssa_code, ssa_name, moa, clean_ssa_name), (hum_name, score, concept_code)]
-    matches = [
-        (l, process.extractOne(l[3], hum_codes_to_drug_names)) for l in tqdm(input_data)
-    ]
-    good_matches = [m for m in matches if m[1][1] > HUM_MATCH_SCORE_LIMIT]
+        {"choice_accept_above": 95, "choice_reject_below": 50}
 
-    # [ssa_code, ssa_name, moa, concept_code, clean_hum_name, score]
-    good_matches_formatted = [
-        [m[0][0], m[0][1], m[0][2], m[1][2], m[1][0], m[1][1]] for m in good_matches
-    ]
+    Keys that are left out keep their default.
 
-    # [clean_ssa_name]
-    matched_clean_ssa_names = [l[0][3] for l in good_matches]
-    # [ssa_code, ssa_name, moa, clean_ssa_name]
-    ssa_remainder = [l for l in input_data if l[3] not in matched_clean_ssa_names]
+    Returns:
+        dict: {key: score}, with every key of DEFAULT_BATCH_POLICY
+    """
+    with open(filename, "rt", encoding="utf8") as f:
+        policy = json.load(f)
+    unknown = set(policy) - set(DEFAULT_BATCH_POLICY)
+    if unknown:
+        raise ValueError(
+            "Unknown keys in batch policy {}: {}".format(
+                filename, ", ".join(sorted(unknown))
+            )
+        )
+    policy = {**DEFAULT_BATCH_POLICY, **policy}
+    if policy["choice_reject_below"] > policy["choice_accept_above"]:
+        raise ValueError(
+            "In batch policy {}, choice_reject_below is above "
+            "choice_accept_above".format(filename)
+        )
+    return policy
 
-    return good_matches_formatted, ssa_remainder
 
+def load_hum_dictionary():
+    """
+    Reads the HUM_Drug_List CSV, or the snapshot of the dictionary built from it.
 
-def extract_good_matches_ciel(input_data, ciel_data):
+    Returns:
+        DrugDictionary: of HUM concept codes, clean and full HUM drug names
     """
-     Args:
-        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
-        ciel_data (list): The ciel json as a list
+
+    def build():
+        hum_csv = clean_csv_list(csv_as_list(HUM_CSV))
+        # using the concept code as the key also serves to de-duplicate them
+        return DrugDictionary.from_dicts(
+            "hum",
+            {l[3]: clean_hum_drug_name(l[2]) for l in hum_csv},
+            {l[3]: l[2] for l in hum_csv},
+        )
+
+    return DrugDictionary.load("hum", HUM_CSV, build) if USE_CACHE else build()
+
+
+def load_ciel_dictionary():
+    """
+    Reads the CIEL json, or the snapshot of the dictionary built from it.
 
     Returns:
-        matches: [ssa_code, ssa_name, moa, concept_code, clean_hum_name]
-        unmatched_input_data: The lines from input_data with no match
+        DrugDictionary: of CIEL concept codes, clean and full CIEL drug names
     """
-    # { ciel_code: clean_ciel_name }
-    ciel_code_to_ciel_name = {
-        "CIEL:{}".format(i["id"]): clean_ciel_drug_name(i["display_name"])
-        for i in ciel_data
-    }
 
-    # [(ssa_code, ssa_name, moa, clean_ssa_name), (clean_ciel_name, score, ciel_code)]
-    matches = [
-        (
-            l,
-            process.extractOne(
-                l[3], ciel_code_to_ciel_name, scorer=fuzz.token_sort_ratio
-            ),
+    def build():
+        ciel_codes_to_names = {
+            "CIEL:{}".format(concept_id): display_name
+            for concept_id, display_name in iter_json_fields(
+                CIEL_JSON, ["id", "display_name"], concept_class="Drug", retired=False
+            )
+        }
+        return DrugDictionary.from_dicts(
+            "ciel",
+            {c: clean_ciel_drug_name(n) for c, n in ciel_codes_to_names.items()},
+            ciel_codes_to_names,
         )
-        for l in tqdm(input_data)
-    ]
-    good_matches = [m for m in matches if m[1][1] > CIEL_MATCH_SCORE_LIMIT]
 
-    # [ssa_code, ssa_name, moa, concept_code, clean_ciel_name, score]
-    good_matches_formatted = [
-        [m[0][0], m[0][1], m[0][2], m[1][2], m[1][0], m[1][1]] for m in good_matches
-    ]
+    return DrugDictionary.load("ciel", CIEL_JSON, build) if USE_CACHE else build()
 
-    # [clean_ssa_name]
-    matched_clean_ssa_names = [l[0][3] for l in good_matches]
-    # [ssa_code, ssa_name, moa, clean_ssa_name]
-    ssa_remainder = [l for l in input_data if l[3] not in matched_clean_ssa_names]
 
-    return good_matches_formatted, ssa_remainder
+def extract_good_matches_hum(input_data, hum):
+    """
+    Args:
+        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        hum (DrugDictionary): The HUM_Drug_List concepts
+
+    Returns:
+        matches: [ssa_code, ssa_name, moa, concept_code, clean_hum_name, score]
+        unmatched_input_data: The lines from input_data with no match
+    """
+    # [(clean_hum_name, score, concept_code)]
+    best_matches = extract_best_matches(
+        [l[3] for l in input_data], hum.codes_to_names, cache_name="hum"
+    )
+    return split_good_matches(input_data, best_matches, HUM_MATCH_SCORE_LIMIT)
 
 
-def extract_user_chosen_matches(input_data, hum_csv, ciel_data, matches, no_match):
+def extract_good_matches_ciel(input_data, ciel):
     """
      Args:
         input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
-        hum_csv (list): The HUM_Drug_List CSV file as a list
-        ciel_data (list): The ciel json as a list
-        matches (list): [ssa_code, ssa_name, moa, concept_code, clean_hum_name]
-            The matches from a previous run
-        no_match (list): [ssa_code, ssa_name, moa, clean_ssa_name]
-            The items that in a previous run were identified as not having a match
+        ciel (DrugDictionary): The CIEL drug concepts
 
     Returns:
         matches: [ssa_code, ssa_name, moa, concept_code, clean_hum_name]
         unmatched_input_data: The lines from input_data with no match
     """
-    HUM_MATCH_LIMIT = 2
-    CIEL_MATCH_LIMIT = 6
-    # create a dict [concept code -> HUM drug name]
-    # this also serves to de-duplicate concept codes
-    # {concept_code: clean_hum_name}
-    hum_codes_to_drug_names = {l[3]: clean_hum_drug_name(l[2]) for l in hum_csv}
+    # [(clean_ciel_name, score, ciel_code)]
+    best_matches = extract_best_matches(
+        [l[3] for l in input_data],
+        ciel.codes_to_names,
+        scorer=fuzz.token_sort_ratio,
+        cache_name="ciel",
+    )
+    return split_good_matches(input_data, best_matches, CIEL_MATCH_SCORE_LIMIT)
+
 
-    # let's keep another with the full hum_name, for reference
-    hum_codes_to_full_drug_names = {l[3]: l[2] for l in hum_csv}
+def split_good_matches(input_data, best_matches, score_limit):
+    """
+    Splits the input lines into those whose best match scores above
+    `score_limit` and the remainder. Lines are told apart by their position
+    in `input_data`, so lines that share a clean name are each accounted for.
 
-    # { ciel_code: clean_ciel_name }
-    ciel_code_to_ciel_name = {
-        "CIEL:{}".format(i["id"]): clean_ciel_drug_name(i["display_name"])
-        for i in ciel_data
+    Args:
+        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        best_matches (list): [(clean_other_name, score, concept_code)]
+            The best match for each line of input_data
+        score_limit (int): scores above this are good matches
+
+    Returns:
+        matches: [ssa_code, ssa_name, moa, concept_code, clean_other_name, score]
+        unmatched_input_data: The lines from input_data with no good match
+    """
+    # {input line number: (clean_other_name, score, concept_code)}
+    good_matches = {
+        linenum: match
+        for linenum, match in enumerate(best_matches)
+        if match[1] > score_limit
     }
+    matches = []
+    # [ssa_code, ssa_name, moa, clean_ssa_name]
+    ssa_remainder = []
+    for linenum, l in enumerate(input_data):
+        match = good_matches.get(linenum)
+        if match:
+            matches.append([l[0], l[1], l[2], match[2], match[0], match[1]])
+        else:
+            ssa_remainder.append(l)
+    return matches, ssa_remainder
 
-    for ssa_linenum, ssa_line in enumerate(input_data):
+
+def extract_best_matches(queries, codes_to_names, scorer=fuzz.WRatio, cache_name=None):
+    """
+    Finds the best match in `codes_to_names` for each of `queries`. Only the
+    queries that aren't in the score cache for this version of the
+    dictionary get scored. With ASSIGN, the queries are assigned one-to-one
+    instead, which depends on all of them, so nothing is cached. With
+    ENSEMBLE, each query's best match is the top of its ranked list.
+
+    Args:
+        queries (list): [clean_ssa_name]
+        codes_to_names (dict): {concept_code: clean_name}
+        scorer: the fuzzywuzzy scorer to rank matches with
+        cache_name (str): what the dictionary is called in the score cache.
+            If None, nothing is cached.
+
+    Returns:
+        [(clean_name, score, concept_code)], in the same order as `queries`
+    """
+    if ASSIGN:
+        # Imported here so that scipy is only needed to use it
+        import assignment
+
+        return assignment.assign_matches(queries, codes_to_names, scorer)
+    if ENSEMBLE:
+        return [r[0] for r in ranked_matches(queries, codes_to_names, cache_name)]
+
+    # {query: [(clean_name, score, concept_code)]}
+    cache = (
+        ScoreCache(
+            cache_name,
+            codes_to_names,
+            scorer,
+            candidate_limit=CANDIDATE_LIMIT if BACKEND == "fuzzywuzzy" else None,
+            backend=BACKEND,
+        )
+        if cache_name and USE_CACHE
+        else {}
+    )
+    to_score = [q for q in dict.fromkeys(queries) if q not in cache]
+    print("{} of {} drugs need scoring".format(len(to_score), len(queries)))
+    instrument.count("queries_scored", len(to_score))
+    for query, match in zip(
+        to_score, score_best_matches(to_score, codes_to_names, scorer)
+    ):
+        cache[query] = [match]
+    if isinstance(cache, ScoreCache):
+        cache.save()
+    return [cache[q][0] for q in queries]
+
+
+def ranked_matches(queries, codes_to_names, cache_name=None):
+    """
+    Ranks `codes_to_names` for each of `queries` by the ensemble score of
+    ranking.py, keeping as many options as the choice stage offers, so that
+    it finds them in the score cache.
+
+    Args:
+        queries (list): [clean_ssa_name]
+        codes_to_names (dict): {concept_code: clean_name}
+        cache_name (str): 'hum' or 'ciel'. If None, nothing is cached.
+
+    Returns:
+        [[(clean_name, score, concept_code)]], in the same order as `queries`
+    """
+    # Imported here so that numpy is only needed to use it
+    import ranking
+
+    ranker = ranking.EnsembleRanker(codes_to_names)
+    limit = ENSEMBLE_LIMITS.get(cache_name, 1)
+    cache = (
+        ScoreCache(cache_name, codes_to_names, ranker, limit)
+        if cache_name and USE_CACHE
+        else {}
+    )
+    to_rank = [q for q in dict.fromkeys(queries) if q not in cache]
+    print("{} of {} drugs need ranking".format(len(to_rank), len(queries)))
+    instrument.count("queries_scored", len(to_rank))
+    for query in tqdm(to_rank):
+        cache[query] = ranker.rank(query, limit)
+    if isinstance(cache, ScoreCache):
+        cache.save()
+    if to_rank:
+        ranker.print_pruning()
+    return [cache[q] for q in queries]
+
+
+def score_best_matches(queries, codes_to_names, scorer):
+    """
+    Scores each of `queries` against `codes_to_names` with BACKEND. The
+    fuzzywuzzy backend uses WORKERS processes.
+
+    Returns:
+        [(clean_name, score, concept_code)], in the same order as `queries`
+    """
+    if not queries:
+        return []
+    if BACKEND == "rapidfuzz":
+        # Imported here so that rapidfuzz and numpy are only needed to use it
+        import batch_scoring
+
+        instrument.count("scorer_calls", len(queries) * len(codes_to_names))
+        return batch_scoring.best_matches(queries, codes_to_names, scorer)
+    if WORKERS <= 1:
+        index = NgramIndex(codes_to_names, CANDIDATE_LIMIT)
+        matches = [index.extract_one(q, scorer=scorer) for q in tqdm(queries)]
+        instrument.count("scorer_calls", index.scored)
+        return matches
+
+    # A few chunks per worker keeps them all busy without paying for a
+    # round-trip per query.
+    chunk_size = max(1, len(queries) // (WORKERS * 8))
+    chunks = [queries[i : i + chunk_size] for i in range(0, len(queries), chunk_size)]
+    results = []
+    with ProcessPoolExecutor(
+        WORKERS,
+        initializer=_init_match_worker,
+        initargs=(codes_to_names, CANDIDATE_LIMIT),
+    ) as executor, tqdm(total=len(queries)) as progress:
+        # executor.map yields chunk results in the order the chunks were submitted
+        for chunk_matches, scored in executor.map(
+            partial(_extract_chunk, scorer=scorer), chunks
+        ):
+            results.extend(chunk_matches)
+            instrument.count("scorer_calls", scored)
+            progress.update(len(chunk_matches))
+    return results
+
+
+# Each worker process builds its own index from the dictionary it is handed
+# once, at startup, rather than receiving the dictionary with every chunk.
+_worker_index = None
+
+
+def _init_match_worker(codes_to_names, candidate_limit):
+    global _worker_index
+    _worker_index = NgramIndex(codes_to_names, candidate_limit)
+
+
+def _extract_chunk(queries, scorer):
+    """Returns the best match for each of `queries`, and how many entries were scored"""
+    scored = _worker_index.scored
+    matches = [_worker_index.extract_one(q, scorer=scorer) for q in queries]
+    return matches, _worker_index.scored - scored
+
+
+def extract_user_chosen_matches(input_data, hum, ciel, store):
+    """
+    Asks which of the options offered, if any, each drug matches, and records
+    each answer in `store` as soon as it is given.
+
+     Args:
+        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        hum (DrugDictionary): The HUM_Drug_List concepts
+        ciel (DrugDictionary): The CIEL drug concepts
+        store (WorkingStore): where the answers go
+    """
+    candidates = ChoiceCandidates(
+        [l[3] for l in input_data], hum.codes_to_names, ciel.codes_to_names
+    )
+    try:
+        if PRECOMPUTE_CHOICES:
+            print("Computing the options for every drug...")
+            candidates.compute_all()
+        _ask_for_matches(input_data, hum, candidates, store)
+    finally:
+        candidates.close()
+
+
+def _ask_for_matches(input_data, hum, candidates, store):
+    # A drug listed more than once with the same code and name only needs one
+    # answer. Drugs without a code, or sharing one, are asked about each time.
+    answered = set()
+    for ssa_line in input_data:
+        if tuple(ssa_line[:2]) in answered:
+            continue
         print(ssa_line[1])
         print("0) None of these")
-        hum_matches = process.extract(
-            ssa_line[3], hum_codes_to_drug_names, limit=HUM_MATCH_LIMIT
-        )
-        ciel_sorted_match = process.extractOne(
-            ssa_line[3], ciel_code_to_ciel_name, scorer=fuzz.token_sort_ratio
-        )
-        ciel_matches = process.extract(
-            ssa_line[3], ciel_code_to_ciel_name, limit=CIEL_MATCH_LIMIT
-        )
+        hum_matches, ciel_sorted_match, ciel_matches = candidates[ssa_line[3]]
         for i, match in enumerate(hum_matches):
-            full_hum_name = hum_codes_to_full_drug_names[match[2]]
+            full_hum_name = hum.full_name(match[2])
             print(
                 "{}) {}\t({}),\te.g. {}".format(
                     i + 1, match[0], match[2], full_hum_name
@@ -284,20 +696,170 @@ def extract_user_chosen_matches(input_data, hum_csv, ciel_data, matches, no_matc
         ):
             choice = ciel_matches[choice_num - (HUM_MATCH_LIMIT + 1)]
         if choice:
-            # [ssa_code, ssa_name, moa, concept_code, clean_other_name]
-            matches.append(
-                [ssa_line[0], ssa_line[1], ssa_line[2], choice[2], choice[0], "-"]
-            )
             print("chose {}".format(choice))
-            write_to_csv(matches, CHOICE_MATCHES_INTERMEDIATE_CSV())
-        else:
-            print("writing unmatched " + str(len(input_data[ssa_linenum:])))
-            no_match.append(ssa_line)
-            write_to_csv(no_match, CHOICE_UNMATCHED_INTERMEDIATE_CSV())
-        print("writing remaining " + str(len(input_data[ssa_linenum:])))
-        write_to_csv(input_data[ssa_linenum + 1 :], CHOICE_TODO_INTERMEDIATE_CSV())
+        _record_answer(store, ssa_line, choice)
+        answered.add(tuple(ssa_line[:2]))
         print()
-    return matches, no_match
+
+
+def _record_answer(store, ssa_line, choice, score="-"):
+    """
+    Records the answer for `ssa_line` in `store`.
+
+    Args:
+        store (WorkingStore)
+        ssa_line (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        choice (tuple): (clean_other_name, score, concept_code), or None
+        score: what to put in the score column of the match
+    """
+    if choice:
+        # [ssa_code, ssa_name, moa, concept_code, clean_other_name, score]
+        store.record_matches(
+            MODE,
+            "choice",
+            [[ssa_line[0], ssa_line[1], ssa_line[2], choice[2], choice[0], score]],
+        )
+    else:
+        store.record_no_match(MODE, [ssa_line])
+
+
+def extract_policy_matches(input_data, hum, ciel, store):
+    """
+    The choice stage, with the questions answered by BATCH_POLICY instead of
+    a person. Each drug's best option, out of the ones the choice stage would
+    offer, is accepted or rejected according to its score. The drugs in
+    between are left undecided, with their options recorded in `store` for
+    review, so that running the choice stage interactively afterwards only
+    asks about those.
+
+    Args:
+        input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        hum (DrugDictionary): The HUM_Drug_List concepts
+        ciel (DrugDictionary): The CIEL drug concepts
+        store (WorkingStore): where the decisions go
+    """
+    candidates = ChoiceCandidates(
+        [l[3] for l in input_data], hum.codes_to_names, ciel.codes_to_names
+    )
+    try:
+        print("Computing the options for every drug...")
+        candidates.compute_all()
+        for ssa_line in input_data:
+            hum_matches, ciel_sorted_match, ciel_matches = candidates[ssa_line[3]]
+            # sorted keeps the order of equal scores, so HUM wins ties, as the
+            # choice stage advises
+            options = sorted(
+                [*hum_matches, ciel_sorted_match, *ciel_matches],
+                key=lambda m: m[1],
+                reverse=True,
+            )
+            best = options[0]
+            if best[1] > BATCH_POLICY["choice_accept_above"]:
+                _record_answer(store, ssa_line, best, best[1])
+            elif best[1] < BATCH_POLICY["choice_reject_below"]:
+                _record_answer(store, ssa_line, None)
+            else:
+                store.record_candidates(MODE, ssa_line, options)
+    finally:
+        candidates.close()
+
+
+class ChoiceCandidates:
+    """
+    The options offered for each drug in the choice stage. These take three
+    full scans of the dictionaries per drug, so they are computed ahead of
+    time in a background thread while the user is busy answering, and
+    persisted in the score cache so that a resumed session has them ready.
+    With ENSEMBLE, they are the ranked lists of ranking.py instead, one per
+    dictionary, which the automatic stages have mostly cached already.
+    """
+
+    def __init__(self, queries, hum_codes_to_drug_names, ciel_code_to_ciel_name):
+        """
+        Args:
+            queries (list): [clean_ssa_name], in the order they will be asked
+            hum_codes_to_drug_names (dict): {concept_code: clean_hum_name}
+            ciel_code_to_ciel_name (dict): {ciel_code: clean_ciel_name}
+        """
+        # [(codes_to_names, scorer, limit, cache_name)]
+        self.scans = [
+            (hum_codes_to_drug_names, fuzz.WRatio, HUM_MATCH_LIMIT, "hum"),
+            (ciel_code_to_ciel_name, fuzz.token_sort_ratio, 1, "ciel"),
+            (ciel_code_to_ciel_name, fuzz.WRatio, CIEL_MATCH_LIMIT, "ciel"),
+        ]
+        if ENSEMBLE:
+            # Imported here so that numpy is only needed to use it
+            import ranking
+
+            self.scans = [
+                (
+                    hum_codes_to_drug_names,
+                    ranking.EnsembleRanker(hum_codes_to_drug_names),
+                    ENSEMBLE_LIMITS["hum"],
+                    "hum",
+                ),
+                (
+                    ciel_code_to_ciel_name,
+                    ranking.EnsembleRanker(ciel_code_to_ciel_name),
+                    ENSEMBLE_LIMITS["ciel"],
+                    "ciel",
+                ),
+            ]
+        self.caches = [
+            ScoreCache(name, codes_to_names, scorer, limit) if USE_CACHE else {}
+            for codes_to_names, scorer, limit, name in self.scans
+        ]
+        # A single worker computes the options in the order they'll be needed
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # {clean_ssa_name: Future}
+        self.ready = {
+            q: self.executor.submit(self._compute, q) for q in dict.fromkeys(queries)
+        }
+
+    def _compute(self, query):
+        results = []
+        for cache, (codes_to_names, scorer, limit, _) in zip(self.caches, self.scans):
+            if query not in cache and ENSEMBLE:
+                cache[query] = scorer.rank(query, limit)
+            elif query not in cache:
+                cache[query] = process.extract(
+                    query, codes_to_names, scorer=scorer, limit=limit
+                )
+                instrument.count("scorer_calls", len(codes_to_names))
+            results.append(cache[query])
+        return results
+
+    def __getitem__(self, query):
+        """
+        Returns:
+            hum_matches: [(clean_hum_name, score, concept_code)]
+            ciel_sorted_match: (clean_ciel_name, score, ciel_code)
+            ciel_matches: [(clean_ciel_name, score, ciel_code)]
+        """
+        if ENSEMBLE:
+            hum_matches, ciel_matches = self.ready[query].result()
+            return hum_matches, ciel_matches[0], ciel_matches[1:]
+        hum_matches, ciel_sorted_matches, ciel_matches = self.ready[query].result()
+        return hum_matches, ciel_sorted_matches[0], ciel_matches
+
+    def compute_all(self):
+        """Waits for the options for every drug, and persists them"""
+        for future in tqdm(self.ready.values()):
+            future.result()
+        self._save()
+
+    def close(self):
+        """Stops computing options, and persists the ones that were computed"""
+        self.executor.shutdown(cancel_futures=True)
+        self._save()
+        for _, scorer, _, _ in self.scans:
+            if ENSEMBLE and scorer.considered:
+                scorer.print_pruning()
+
+    def _save(self):
+        for cache in self.caches:
+            if isinstance(cache, ScoreCache):
+                cache.save()
 
 
 def save_matches_and_unmatched(
@@ -310,7 +872,12 @@ def save_matches_and_unmatched(
         suffix: str
     """
     print("Found %d matches:" % len(matches))
-    selection = input("Enter 'p' to show these, or anything else to continue")
+    # Nobody's there to ask in batch mode
+    selection = (
+        input("Enter 'p' to show these, or anything else to continue")
+        if BATCH_POLICY is None
+        else None
+    )
     if selection == "p":
         for m in matches:
             # ssa_name, other_name, matched_code, score
@@ -333,59 +900,113 @@ def clean_csv_list(input_list):
     return [l for l in input_list if l != []][1:]
 
 
-def clean_ces_drug_name(drug_name):
-    drug_name = drug_name.lower()
-    result = re.split(r",|-|\d", drug_name)[0]
-    result = result.replace("**especial**", "")
-    result = re.sub(r"[/+]", " ", result).strip()
-    if result == "":
-        result = drug_name.split()[0]
-        print(
-            "WARNING: clean_ces_drug_name reduced drug name to empty string. Using "
-            + result
-        )
-    return result
-
-
-def clean_ciel_drug_name(drug_name):
-    return drug_name.lower()
-
-
-def clean_hum_drug_name(drug_name):
-    drug_name = drug_name.lower()
-    result = re.split(r",|\d", drug_name)[0].strip()
-    return result
-
-
-def clean_ssa_drug_name(drug_name):
-    drug_name = drug_name.lower()
-    result = re.split(r",|de|-|\(|\d", drug_name)[0].strip()
-    if result == "":
-        result = drug_name.split()[0]
-        print(
-            "WARNING: clean_ssa_drug_name reduced drug name to empty string. Using "
-            + result
-        )
-    return result
-
-
-def from_json_file(filename):
-    with open(filename) as f:
-        return json.load(f)
-
-
 def write_to_csv(data, filename):
-    with open(filename, "w") as csvfile:
+    with instrument.stage("write_to_csv", file=filename), open(
+        filename, "w"
+    ) as csvfile:
         writer = csv.writer(csvfile)
         writer.writerows(data)
+        instrument.count("rows_written", len(data))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("mode", help="either 'ssa' or 'ces'")
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=CANDIDATE_LIMIT,
+        help="how many trigram-index candidates to score per drug in the "
+        "automatic stages (0 scores the whole dictionary)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="how many processes to run the automatic stages on, with the "
+        "fuzzywuzzy backend",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["fuzzywuzzy", "rapidfuzz"],
+        default=BACKEND,
+        help="the library that scores the automatic stages. rapidfuzz scores "
+        "every drug against the whole dictionary at once, on all cores",
+    )
+    parser.add_argument(
+        "--assign",
+        action="store_true",
+        help="in the automatic stages, assign drugs to dictionary entries "
+        "one-to-one, maximizing the total score within blocks of drugs that "
+        "share a leading ingredient, instead of giving each its best match",
+    )
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help="rank each dictionary by a weighted mix of WRatio and "
+        "token_sort_ratio, skipping the entries that can't make the top, and "
+        "use the same ranked lists in the automatic and choice stages",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="POLICY",
+        help="run unattended, deciding the drugs left for the choice stage "
+        "with the decision policy in the JSON file POLICY, e.g. "
+        "batch-policy.json, and writing the undecided ones to a review queue",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="only match the drugs that are new or have changed since the last "
+        "run, or whose match is gone from the dictionaries, and keep the "
+        "decisions about the rest",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the dictionary and score cache in "
+        + os.path.join("intermediates", "cache"),
+    )
+    parser.add_argument(
+        "--precompute-choices",
+        action="store_true",
+        help="compute and cache the options for all the remaining drugs before "
+        "starting to ask about them",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="profile each stage with cProfile, writing the stats to DIR",
+    )
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        const=SNAPSHOT_STORE,
+        metavar="STORE",
+        help="read the CIEL drugs from the current snapshot in STORE (default "
+        "{}), as written by sync_sources.py".format(SNAPSHOT_STORE),
+    )
     args = parser.parse_args()
     if args.mode not in ["ssa", "ces"]:
         parser.print_help()
         parser.exit()
     MODE = args.mode
-    main()
+    CANDIDATE_LIMIT = args.candidates
+    WORKERS = args.workers
+    BACKEND = args.backend
+    ASSIGN = args.assign
+    ENSEMBLE = args.ensemble
+    USE_CACHE = not args.no_cache
+    PRECOMPUTE_CHOICES = args.precompute_choices
+    UPDATE = args.update
+    if args.snapshot:
+        CIEL_JSON = snapshot_path(args.snapshot, CIEL_JSON)
+    if args.batch:
+        BATCH_POLICY = load_batch_policy(args.batch)
+        HUM_MATCH_SCORE_LIMIT = BATCH_POLICY["hum_accept_above"]
+        CIEL_MATCH_SCORE_LIMIT = BATCH_POLICY["ciel_accept_above"]
+    instrument.start("match_meds", args.profile)
+    try:
+        main()
+    finally:
+        instrument.finish(RUN_REPORT_JSON())
@@ -0,0 +1,259 @@
+#! env/bin/python3
+"""
+med_lookup.py
+
+Looks drugs up by name in HUM_Drug_List, the CIEL drugs and the OpenMRS
+concept dictionary (names and synonyms), and lists the concepts found, best
+first. Replaces grepping the raw input files with medgrep.
+
+Three kinds of lookup:
+    substring  names containing the query, e.g. 'moxi'
+    token      names with words starting with each word of the query, in
+               any order, e.g. 'amox clav' finds 'Amoxicillin / Clavulanic acid'
+    fuzzy      the names most similar to the query, by trigram shortlist and
+               the QRatio scorer, e.g. 'amoxicilina'
+
+The default, auto, does a token lookup and tops it up with fuzzy results.
+Accents and case are ignored. Substring and token results are ranked by
+their WRatio score, and come before fuzzy results, which are ranked by the
+QRatio score, since WRatio rates short names that are part of the query,
+like 'Na', as highly as good matches.
+
+The index is built once and cached in intermediates/cache until one of the
+input files changes. Run with a query to look it up, or without one to
+look up one query per line, e.g.
+
+    ./med_lookup.py amox clav
+    ./med_lookup.py --kind fuzzy amoxicilina
+    ./med_lookup.py
+    > s moxi
+    > f amoxicilina
+"""
+import argparse
+from bisect import bisect_left
+from collections import defaultdict
+import os
+import re
+import time
+
+from fuzzywuzzy import fuzz
+
+from match_cache import file_hash, read_cache_file, write_cache_file
+import match_meds
+from ngram_index import NgramIndex, process_name
+from normalize import fold_accents
+
+CONCEPT_DICTIONARY_CSV = os.path.join("input", "conceptDictionary1682018_1627.csv")
+
+KINDS = ["auto", "substring", "token", "fuzzy"]
+# The prefixes that pick the kind of lookup at the prompt, e.g. 's moxi'
+KIND_PREFIXES = {"a": "auto", "s": "substring", "t": "token", "f": "fuzzy"}
+
+# How many results to list per lookup. Can be set at runtime with --limit.
+LIMIT = 20
+
+# How many trigram candidates the fuzzy lookup scores
+FUZZY_CANDIDATE_LIMIT = 200
+
+WORD = re.compile(r"\w+")
+
+
+def search_name(name):
+    """The form of a name that's searched: lowercase, without accents"""
+    return fold_accents(name.lower())
+
+
+def load_entries():
+    """
+    Returns:
+        [(source, concept_code, name)] for every name in the three sources.
+            A concept from the concept dictionary has an entry per synonym.
+    """
+    entries = []
+    hum = match_meds.load_hum_dictionary()
+    entries += [("HUM", c, n) for c, n in zip(hum.codes, hum.full_names)]
+    ciel = match_meds.load_ciel_dictionary()
+    entries += [("CIEL", c, n) for c, n in zip(ciel.codes, ciel.full_names)]
+    concept_csv = match_meds.clean_csv_list(
+        match_meds.csv_as_list(CONCEPT_DICTIONARY_CSV)
+    )
+    # [concept_id, name, description, synonyms, answers, set_members, class, ...]
+    for l in concept_csv:
+        names = dict.fromkeys([l[1]] + [s for s in l[3].split("\n") if s])
+        entries += [("OpenMRS", l[0], n) for n in names]
+    return entries
+
+
+class DrugLookup:
+    """An index over the names of the drug sources, for med_lookup"""
+
+    def __init__(self, entries, ngram_state=None):
+        """
+        Args:
+            entries (list): [(source, concept_code, name)]
+            ngram_state (dict): the NgramIndex state from a previous build
+        """
+        self.entries = entries
+        names = {i: search_name(e[2]) for i, e in enumerate(entries)}
+        self.names = names
+        if ngram_state is None:
+            self.ngrams = NgramIndex(names, FUZZY_CANDIDATE_LIMIT)
+        else:
+            self.ngrams = NgramIndex.from_state(
+                names, ngram_state, FUZZY_CANDIDATE_LIMIT
+            )
+        # {word: [entry position]}
+        self.word_postings = defaultdict(list)
+        for position, name in names.items():
+            for word in set(WORD.findall(name)):
+                self.word_postings[word].append(position)
+        # For finding the words that start with a prefix
+        self.words = sorted(self.word_postings)
+
+    @classmethod
+    def load(cls):
+        """Loads the index from the cache, building it if it's out of date"""
+        key = {
+            f: file_hash(f)
+            for f in [match_meds.HUM_CSV, match_meds.CIEL_JSON, CONCEPT_DICTIONARY_CSV]
+        }
+        cached = read_cache_file("med-lookup")
+        if cached is not None and cached["key"] == key:
+            return cls([tuple(e) for e in cached["entries"]], cached["ngrams"])
+        lookup = cls(load_entries())
+        write_cache_file(
+            "med-lookup",
+            {"key": key, "entries": lookup.entries, "ngrams": lookup.ngrams.state()},
+        )
+        return lookup
+
+    def substring(self, query):
+        """Returns the positions of the entries whose names contain `query`"""
+        query = search_name(query)
+        processed = process_name(query)
+        grams = [processed[i : i + 3] for i in range(len(processed) - 2)]
+        if grams:
+            # A name can only contain the query if it has all its trigrams
+            positions = set.intersection(
+                *(set(self.ngrams.postings.get(g, ())) for g in grams)
+            )
+        else:
+            positions = self.names.keys()
+        return [p for p in positions if query in self.names[p]]
+
+    def token(self, query):
+        """
+        Returns the positions of the entries with, for each word of `query`,
+        a word that starts with it
+        """
+        positions = None
+        for prefix in WORD.findall(search_name(query)):
+            matching = set()
+            i = bisect_left(self.words, prefix)
+            while i < len(self.words) and self.words[i].startswith(prefix):
+                matching.update(self.word_postings[self.words[i]])
+                i += 1
+            positions = matching if positions is None else positions & matching
+        return list(positions or [])
+
+    def fuzzy(self, query):
+        """Returns the positions of the entries with the most similar names"""
+        candidates = self.ngrams.candidates(search_name(query))
+        # The index falls back on every name when none share a trigram
+        return [] if candidates is self.names else list(candidates)
+
+    def lookup(self, query, kind="auto", limit=LIMIT):
+        """
+        Returns:
+            [(score, source, concept_code, name)], best first, with one
+                result per concept
+        """
+        # [(positions, scorer)], in order of precedence
+        if kind == "auto":
+            hits = [(self.token(query), fuzz.WRatio)]
+            if len(hits[0][0]) < limit:
+                hits.append((self.fuzzy(query), fuzz.QRatio))
+        elif kind == "fuzzy":
+            hits = [(self.fuzzy(query), fuzz.QRatio)]
+        else:
+            hits = [(getattr(self, kind)(query), fuzz.WRatio)]
+        query = search_name(query)
+
+        # {(source, concept_code): (precedence, score, name)}
+        best = {}
+        for precedence, (positions, scorer) in enumerate(hits):
+            for p in positions:
+                source, code, name = self.entries[p]
+                if best.get((source, code), (precedence,))[0] < precedence:
+                    continue
+                score = scorer(query, self.names[p])
+                if (source, code) not in best or score > best[(source, code)][1]:
+                    best[(source, code)] = (precedence, score, name)
+        # Of equally good results, the shortest names are usually the closest
+        ranked = sorted(best.items(), key=lambda r: (r[1][0], -r[1][1], len(r[1][2])))
+        return [
+            (score, source, code, name)
+            for (source, code), (_, score, name) in ranked[:limit]
+        ]
+
+
+def print_results(results, seconds):
+    for score, source, code, name in results:
+        print("{:>3}  {:<8} {:<12} {}".format(score, source, code, name))
+    print("({} found in {:.0f} ms)".format(len(results), seconds * 1000))
+
+
+def run_lookup(lookup, query, kind):
+    start = time.perf_counter()
+    results = lookup.lookup(query, kind, LIMIT)
+    print_results(results, time.perf_counter() - start)
+
+
+def prompt(lookup, kind):
+    print(
+        "One lookup per line. Start a line with 's ', 't ' or 'f ' for a "
+        "substring, token or fuzzy lookup. Ctrl-D to quit."
+    )
+    while True:
+        try:
+            line = input("> ").strip()
+        except EOFError:
+            print()
+            return
+        if not line:
+            continue
+        first, _, rest = line.partition(" ")
+        if first in KIND_PREFIXES and rest:
+            run_lookup(lookup, rest, KIND_PREFIXES[first])
+        else:
+            run_lookup(lookup, line, kind)
+
+
+def main(query, kind):
+    start = time.perf_counter()
+    lookup = DrugLookup.load()
+    if not query:
+        print(
+            "Loaded {} names in {:.2f}s".format(
+                len(lookup.entries), time.perf_counter() - start
+            )
+        )
+        prompt(lookup, kind)
+    else:
+        run_lookup(lookup, query, kind)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "query", nargs="*", help="what to look up. If left out, prompts for queries"
+    )
+    parser.add_argument(
+        "--kind", choices=KINDS, default="auto", help="the kind of lookup to do"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=LIMIT, help="how many results to list"
+    )
+    args = parser.parse_args()
+    LIMIT = args.limit
+    main(" ".join(args.query), args.kind)
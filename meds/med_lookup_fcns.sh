@@ -1,3 +1,3 @@
 function medlookup { grep -i "$1" old-results/meds-matches-* ; }
-function medgrep { grep -i $1 input/HUM_Drug_List-13.csv input/meds-ciel.json ; }
-function medgrep2 { grep -i $1 input/HUM_Drug_List-13.csv input/meds-ciel.json | grep -i $2 ; }
+function medgrep { ./med_lookup.py "$@" ; }
+function medgrep2 { ./med_lookup.py --kind token "$1" "$2" ; }
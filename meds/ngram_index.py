@@ -0,0 +1,112 @@
+"""
+ngram_index.py
+
+A character-trigram inverted index over a {concept_code: clean_name}
+dictionary. It shortlists the dictionary entries that share the most
+trigrams with a query, so that the (expensive) fuzzywuzzy scorers only
+have to run on that shortlist instead of on the whole dictionary.
+"""
+from collections import Counter, defaultdict
+from functools import partial
+import heapq
+
+from fuzzywuzzy import fuzz, process, utils
+
+NGRAM_SIZE = 3
+
+# The scorers process their inputs with full_process(force_ascii=True), so we
+# tokenize the same way to make sure the index sees what the scorers see.
+process_name = partial(utils.full_process, force_ascii=True)
+
+
+def ngrams(name):
+    """Returns the set of character trigrams of the processed `name`"""
+    padded = " " + process_name(name) + " "
+    return {padded[i : i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+class NgramIndex:
+    """
+    Built once per run from a {concept_code: clean_name} dict.
+
+    Candidates are ranked by the Dice coefficient of their trigram set and
+    the query's trigram set. Only the top `limit` of them get scored.
+    """
+
+    def __init__(self, codes_to_names, limit=50):
+        """
+        Args:
+            codes_to_names (dict): {concept_code: clean_name}
+            limit (int): how many candidates to shortlist per query. If 0 or
+                None, every query is scored against the whole dictionary.
+        """
+        self.codes_to_names = codes_to_names
+        self.limit = limit
+        self.codes = list(codes_to_names.keys())
+        self.gram_counts = []
+        # How many dictionary entries have been scored against queries
+        self.scored = 0
+        # {trigram: [position of code in self.codes]}
+        self.postings = defaultdict(list)
+        for position, name in enumerate(codes_to_names.values()):
+            grams = ngrams(name)
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                self.postings[gram].append(position)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def state(self):
+        """Returns what from_state needs to rebuild the index, as JSON-able data"""
+        return {"gram_counts": self.gram_counts, "postings": self.postings}
+
+    @classmethod
+    def from_state(cls, codes_to_names, state, limit=50):
+        """Rebuilds an index over `codes_to_names` without re-tokenizing it"""
+        index = cls({}, limit)
+        index.codes_to_names = codes_to_names
+        index.codes = list(codes_to_names.keys())
+        index.gram_counts = state["gram_counts"]
+        index.postings = state["postings"]
+        return index
+
+    def candidates(self, query):
+        """
+        Returns the shortlisted {concept_code: clean_name} entries for `query`,
+        in their original dictionary order so that ties are broken the same
+        way as a full scan would break them.
+        """
+        if not self.limit:
+            return self.codes_to_names
+        query_grams = ngrams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self.postings.get(gram, ()))
+        if not shared:
+            return self.codes_to_names
+        best = heapq.nlargest(
+            self.limit,
+            shared.items(),
+            key=lambda p: 2 * p[1] / (len(query_grams) + self.gram_counts[p[0]]),
+        )
+        positions = sorted(p for p, _ in best)
+        return {self.codes[p]: self.codes_to_names[self.codes[p]] for p in positions}
+
+    def extract_one(self, query, scorer=fuzz.WRatio):
+        """
+        Like `process.extractOne(query, codes_to_names, scorer=scorer)`, but
+        only scores the shortlisted candidates.
+
+        Returns:
+            (clean_name, score, concept_code)
+        """
+        candidates = self.candidates(query)
+        self.scored += len(candidates)
+        return process.extractOne(query, candidates, scorer=scorer)
+
+    def extract(self, query, limit=5, scorer=fuzz.WRatio):
+        """Like `process.extract`, but only scores the shortlisted candidates"""
+        candidates = self.candidates(query)
+        self.scored += len(candidates)
+        return process.extract(query, candidates, limit=limit, scorer=scorer)
@@ -0,0 +1,107 @@
+"""
+normalize.py
+
+The drug name normalization used by match_meds.py, one pipeline per source
+list. A pipeline lowercases a name, folds its accents ('ÁCIDO FÓLICO' becomes
+'acido folico'), cuts it at the first of its split pattern (which is where the
+strength and presentation start) and tidies up what's left.
+
+The patterns are compiled once, and each pipeline memoizes its results on the
+raw name, so that names which repeat (the same drug in different
+presentations, mostly) are only cleaned once.
+"""
+from functools import lru_cache
+import re
+import unicodedata
+
+# How many raw names each pipeline remembers the clean name of
+CACHE_SIZE = 2 ** 16
+
+
+def fold_accents(name):
+    """Removes the accents from the letters of `name`, e.g. 'ó' -> 'o'"""
+    if name.isascii():
+        return name
+    return "".join(
+        c for c in unicodedata.normalize("NFKD", name) if not unicodedata.combining(c)
+    )
+
+
+class NamePipeline:
+    """
+    Cleans drug names from one source. Call it with the raw name.
+
+    The steps are applied in this order:
+        1. lowercase and fold accents
+        2. keep what comes before the first match of `split`
+        3. remove each of `remove`
+        4. replace each match of `replace_with_space` with a space
+        5. strip whitespace
+        6. if `fallback` and that left nothing, use the first word of step 1,
+            with a warning
+    """
+
+    def __init__(
+        self, name, split=None, remove=(), replace_with_space=None, fallback=False
+    ):
+        """
+        Args:
+            name (str): what to call the pipeline in warnings
+            split (str): regex
+            remove (tuple): strings
+            replace_with_space (str): regex
+            fallback (bool)
+        """
+        self.name = name
+        self.split = re.compile(split) if split else None
+        self.remove = remove
+        self.replace_with_space = (
+            re.compile(replace_with_space) if replace_with_space else None
+        )
+        self.fallback = fallback
+        self._clean = lru_cache(maxsize=CACHE_SIZE)(self._run)
+
+    def __call__(self, drug_name):
+        return self._clean(drug_name)
+
+    def cache_info(self):
+        return self._clean.cache_info()
+
+    def cache_clear(self):
+        self._clean.cache_clear()
+
+    def _run(self, drug_name):
+        drug_name = fold_accents(drug_name.lower())
+        result = drug_name
+        if self.split:
+            result = self.split.split(result, maxsplit=1)[0]
+        for s in self.remove:
+            result = result.replace(s, "")
+        if self.replace_with_space:
+            result = self.replace_with_space.sub(" ", result)
+        result = result.strip()
+        if result == "" and self.fallback:
+            result = drug_name.split()[0]
+            print(
+                "WARNING: {} reduced drug name to empty string. Using {}".format(
+                    self.name, result
+                )
+            )
+        return result
+
+
+clean_ces_drug_name = NamePipeline(
+    "clean_ces_drug_name",
+    split=r",|-|\d",
+    remove=("**especial**",),
+    replace_with_space=r"[/+]",
+    fallback=True,
+)
+
+clean_ciel_drug_name = NamePipeline("clean_ciel_drug_name")
+
+clean_hum_drug_name = NamePipeline("clean_hum_drug_name", split=r",|\d")
+
+clean_ssa_drug_name = NamePipeline(
+    "clean_ssa_drug_name", split=r",|de|-|\(|\d", fallback=True
+)
@@ -0,0 +1,323 @@
+"""
+ranking.py
+
+The ensemble ranking mode of match_meds.py (--ensemble). Instead of ranking
+a dictionary with one scorer at a time, which costs a full scan of it per
+scorer and gives the automatic stages and the choice stage different
+lists, every entry gets one score, the weighted mean of the scores of the
+WEIGHTS scorers, and each drug gets one ranked list per dictionary.
+
+Most entries are never scored. A cheap upper bound on each scorer is
+computed for the whole dictionary at once with NumPy, from how many
+letters and words the drug and each entry have in common, and the entries
+are scored in descending order of their bound, until the next one's bound
+can't reach the worst of the `limit` best scores found so far. Each entry
+is scored by the cheapest scorer first, and the more expensive ones are
+skipped if that score and the others' bounds can't make the top either.
+The bounds hold for every step of the fuzzywuzzy scorers, so the ranking
+is the same as scoring every entry, ties included.
+"""
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+
+from common import instrument
+
+# {scorer: weight}, cheapest scorer first, which is the order they're run
+# in. The weights add up to 1, so the combined score is on the scorers'
+# 0-100 scale, and the score limits keep their meaning.
+WEIGHTS = {fuzz.token_sort_ratio: 0.5, fuzz.WRatio: 0.5}
+
+# The characters a processed name can be made of. Anything else is counted
+# together, which can only loosen the bounds.
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789_"
+SPACE = len(ALPHABET) + 1
+CHARACTER_COLUMNS = np.full(256, len(ALPHABET), dtype=np.intp)
+CHARACTER_COLUMNS[[ord(c) for c in ALPHABET]] = np.arange(len(ALPHABET))
+CHARACTER_COLUMNS[ord(" ")] = SPACE
+
+# How many names to count the characters of at a time, which bounds the
+# memory that takes
+COUNT_CHUNK_SIZE = 100000
+
+
+def process_query(query):
+    """Processes a query the way fuzzywuzzy's process.extract does"""
+    return utils.full_process(utils.full_process(query), force_ascii=True)
+
+
+def process_choice(choice):
+    """Processes a dictionary entry the way fuzzywuzzy's process.extract does"""
+    return utils.full_process(choice, force_ascii=True)
+
+
+def character_counts(names):
+    """
+    Returns:
+        np.ndarray: how many of each character of ALPHABET, then other
+            characters, then spaces, each of `names` has
+    """
+    columns = SPACE + 1
+    counts = np.zeros((len(names), columns), dtype=np.uint16)
+    for start in range(0, len(names), COUNT_CHUNK_SIZE):
+        chunk = names[start : start + COUNT_CHUNK_SIZE]
+        lengths = [len(n) for n in chunk]
+        data = np.frombuffer("".join(chunk).encode("ascii"), dtype=np.uint8)
+        rows = np.repeat(np.arange(len(chunk)), lengths)
+        counts[start : start + len(chunk)] = np.bincount(
+            rows * columns + CHARACTER_COLUMNS[data], minlength=len(chunk) * columns
+        ).reshape(len(chunk), columns)
+    return counts
+
+
+class Names:
+    """The measurements of processed names that the bounds are made from"""
+
+    def __init__(self, processed):
+        """
+        Args:
+            processed (list): processed names, as process_choice returns
+        """
+        counts = character_counts(processed)
+        self.letters = counts[:, :SPACE]
+        self.spaces = counts[:, SPACE].astype(np.int64)
+        self.length = np.array([len(p) for p in processed], dtype=np.int64)
+        tokens = [p.split() for p in processed]
+        # The length of the tokens joined by single spaces, as token_sort_ratio
+        # compares them
+        self.token_count = np.array([len(t) for t in tokens], dtype=np.int64)
+        self.sorted_length = np.array(
+            [sum(map(len, t)) + max(len(t) - 1, 0) for t in tokens], dtype=np.int64
+        )
+        # The same for the distinct tokens, as token_set_ratio compares them
+        unique = [set(t) for t in tokens]
+        self.unique_count = np.array([len(u) for u in unique], dtype=np.int64)
+        self.unique_length = np.array(
+            [sum(map(len, u)) + max(len(u) - 1, 0) for u in unique], dtype=np.int64
+        )
+        self.tokens = unique
+
+
+def ratio_bound(common, length_1, length_2):
+    """The most fuzz.ratio can be for strings that share `common` characters"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bound = np.ceil(200 * common / (length_1 + length_2))
+    return np.nan_to_num(bound)
+
+
+def partial_ratio_bound(common, shorter_length):
+    """
+    The most fuzz.partial_ratio can be for strings that share `common`
+    characters. It compares the shorter string with substrings of the longer
+    one, which can be cut short at its end, so the bound is that of the
+    ratio with a substring of just the characters in common.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bound = np.ceil(200 * common / (shorter_length + common))
+    return np.nan_to_num(bound)
+
+
+class EnsembleRanker:
+    """Ranks the entries of a dictionary by the WEIGHTS ensemble score"""
+
+    def __init__(self, codes_to_names, weights=None):
+        """
+        Args:
+            codes_to_names (dict): {concept_code: clean_name}
+            weights (dict): {scorer: weight}, out of WRatio and
+                token_sort_ratio, cheapest first. Defaults to WEIGHTS.
+        """
+        self.weights = weights or WEIGHTS
+        unsupported = [s for s in self.weights if s not in SCORE_BOUNDS]
+        if unsupported:
+            raise ValueError(
+                "No upper bound for scorer {}".format(unsupported[0].__name__)
+            )
+        # What the score cache calls the results
+        self.__name__ = "ensemble-" + "-".join(
+            "{}{:g}".format(s.__name__, w) for s, w in self.weights.items()
+        )
+        self.codes_to_names = codes_to_names
+        self.codes = list(codes_to_names.keys())
+        self.names = None
+        # How many entries the queries could have been scored against, how
+        # many were, and how many scorer calls that took
+        self.considered = 0
+        self.scored = 0
+        self.scorer_calls = 0
+
+    def _index(self):
+        """Measures the dictionary, the first time it's needed"""
+        if self.names is None:
+            self.processed = [process_choice(n) for n in self.codes_to_names.values()]
+            self.names = Names(self.processed)
+            # {token: positions of the entries that have it}
+            postings = {}
+            for position, tokens in enumerate(self.names.tokens):
+                for token in tokens:
+                    postings.setdefault(token, []).append(position)
+            self.postings = {t: np.array(p) for t, p in postings.items()}
+
+    def bounds(self, processed_query):
+        """
+        Returns:
+            [np.ndarray]: the upper bound on each scorer's score of each entry
+                for the query, in the order of the weights
+        """
+        query = Names([processed_query])
+        names = self.names
+        common_letters = np.minimum(names.letters, query.letters[0]).sum(
+            axis=1, dtype=np.int64
+        )
+        common = {
+            # in the processed strings, which can have runs of spaces
+            "processed": common_letters + np.minimum(names.spaces, query.spaces[0]),
+            # in the tokens joined by single spaces
+            "sorted": common_letters
+            + np.maximum(np.minimum(names.token_count, query.token_count[0]) - 1, 0),
+            # in the distinct tokens. Duplicate tokens' letters are counted too,
+            # which can only loosen it.
+            "unique": np.minimum(
+                common_letters
+                + np.maximum(
+                    np.minimum(names.unique_count, query.unique_count[0]) - 1, 0
+                ),
+                np.minimum(names.unique_length, query.unique_length[0]),
+            ),
+        }
+        shares_token = np.zeros(len(self.codes), dtype=bool)
+        for token in query.tokens[0]:
+            if token in self.postings:
+                shares_token[self.postings[token]] = True
+        # Scorers can give empty names anything from 0 to 100: two empty
+        # strings are equal, which token_sort_ratio scores 100
+        empty = (names.length == 0) | (query.length[0] == 0)
+        return [
+            np.where(
+                empty, 100, SCORE_BOUNDS[scorer](names, query, common, shares_token)
+            )
+            for scorer in self.weights
+        ]
+
+    def rank(self, query, limit):
+        """
+        Like `process.extract(query, codes_to_names, limit=limit)`, with the
+        ensemble score as the scorer, without scoring the entries that can't
+        make the top `limit`.
+
+        Returns:
+            [(clean_name, score, concept_code)], best first, ties in
+                dictionary order
+        """
+        self._index()
+        processed_query = process_query(query)
+        scorers = list(self.weights.items())
+        # [weight * bound], by scorer
+        weighted_bounds = [
+            w * b for (_, w), b in zip(scorers, self.bounds(processed_query))
+        ]
+        bounds = np.ceil(sum(weighted_bounds))
+        # [(score, position)], best first
+        top = []
+        scored = calls = 0
+        for position in np.argsort(-bounds, kind="stable"):
+            if len(top) == limit and bounds[position] < top[-1][0]:
+                break
+            scored += 1
+            name = self.processed[position]
+            score = 0
+            remaining = bounds[position]
+            for (scorer, weight), weighted_bound in zip(scorers, weighted_bounds):
+                score += weight * scorer(processed_query, name, full_process=False)
+                remaining -= weighted_bound[position]
+                calls += 1
+                # Can the rest of the scorers still get it into the top?
+                if len(top) == limit and np.ceil(score + remaining) < top[-1][0]:
+                    break
+            else:
+                top.append((utils.intr(score), int(position)))
+                top.sort(key=lambda t: (-t[0], t[1]))
+                del top[limit:]
+        self.considered += len(self.codes)
+        self.scored += scored
+        self.scorer_calls += calls
+        instrument.count("candidates_considered", len(self.codes))
+        instrument.count("candidates_scored", scored)
+        instrument.count("scorer_calls", calls)
+        return [
+            (self.codes_to_names[self.codes[p]], score, self.codes[p])
+            for score, p in top
+        ]
+
+    def pruning_rate(self):
+        """The fraction of the entries that were never scored"""
+        return 1 - self.scored / self.considered if self.considered else 0
+
+    def print_pruning(self):
+        print(
+            "Scored {} of {} candidates ({:.1%} pruned), with {} scorer calls "
+            "instead of {}".format(
+                self.scored,
+                self.considered,
+                self.pruning_rate(),
+                self.scorer_calls,
+                self.considered * len(self.weights),
+            )
+        )
+
+
+def wratio_bound(names, query, common, shares_token):
+    """An upper bound on fuzz.WRatio, step by step"""
+    longer = np.maximum(names.length, query.length[0])
+    shorter = np.minimum(names.length, query.length[0])
+    base = ratio_bound(common["processed"], names.length, query.length[0])
+
+    # Similar lengths: the token ratios, scaled by 0.95
+    token_sort = ratio_bound(
+        common["sorted"], names.sorted_length, query.sorted_length[0]
+    )
+    unique_common = common["unique"]
+    token_set = ratio_bound(unique_common, names.unique_length, query.unique_length[0])
+    # With a token in common, the intersection is compared with each side
+    for unique_length in [names.unique_length, query.unique_length[0]]:
+        token_set = np.where(
+            shares_token,
+            np.maximum(
+                token_set, ratio_bound(unique_common, unique_common, unique_length)
+            ),
+            token_set,
+        )
+    similar = np.maximum(base, 0.95 * np.maximum(token_sort, token_set))
+
+    # Different lengths: the partial ratios, scaled by 0.9, or 0.6 past 8 times
+    # as long, and the token ones by 0.95 on top of that
+    scale = np.where(longer > 8 * shorter, 0.6, 0.9)
+    partial = partial_ratio_bound(common["processed"], shorter)
+    partial_token_sort = partial_ratio_bound(
+        common["sorted"], np.minimum(names.sorted_length, query.sorted_length[0])
+    )
+    # With a token in common, the intersection is a substring of each side
+    partial_token_set = np.where(
+        shares_token,
+        100,
+        partial_ratio_bound(
+            unique_common, np.minimum(names.unique_length, query.unique_length[0])
+        ),
+    )
+    different = np.maximum(
+        base,
+        scale
+        * np.maximum(partial, 0.95 * np.maximum(partial_token_sort, partial_token_set)),
+    )
+    return np.ceil(np.where(longer < 1.5 * shorter, similar, different))
+
+
+def token_sort_ratio_bound(names, query, common, shares_token):
+    """An upper bound on fuzz.token_sort_ratio"""
+    return ratio_bound(common["sorted"], names.sorted_length, query.sorted_length[0])
+
+
+# {scorer: the function that bounds it}
+SCORE_BOUNDS = {
+    fuzz.WRatio: wratio_bound,
+    fuzz.token_sort_ratio: token_sort_ratio_bound,
+}
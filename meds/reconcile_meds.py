@@ -0,0 +1,167 @@
+#! env/bin/python3
+"""
+reconcile_meds.py
+
+Checks the medication matches of both modes (results/meds-ces.csv and
+results/meds-ssa.csv) against the CIEL concepts already in the concept
+dictionary, and splits them into the drugs that are ready to be created
+and the CIEL concepts that have to be imported first. Replaces the IPython
+session that used to be saved as current_session.py.
+
+The CIEL codes in the dictionary (ciel-in-concepts-dict.csv, minus the
+voided ones) are read into an integer index, and the matches are joined
+against it in one pass over both modes. Writes to results/:
+
+    {mode}-ready.csv            the drugs whose concept is in the dictionary
+    {mode}-drugs-from-ciel.csv  the drugs whose CIEL concept isn't
+    {mode}-ciel-needs.csv       the CIEL concepts those need, for each mode
+    ciel-needs.csv              the same, for both modes
+    meds-duplicates.csv         the drugs that share a concept with another
+
+Drugs matched to PIH concepts, and drugs with no match, are counted but
+not reconciled, since the dictionary export doesn't say which PIH concepts
+it has.
+"""
+import os
+import time
+
+import pandas as pd
+
+MODES = ["ces", "ssa"]
+
+# The matches to reconcile, one table per mode
+MATCHES_CSV = os.path.join("results", "meds-{}.csv")
+
+# The CIEL codes of the concepts in the concept dictionary. The dictionary
+# export itself (conceptDictionary1682018_1627.csv) only has local concept
+# ids, which aren't CIEL codes.
+CIEL_IN_DICTIONARY_CSV = os.path.join("input", "ciel-in-concepts-dict.csv")
+
+READY_CSV = os.path.join("results", "{}-ready.csv")
+DRUGS_FROM_CIEL_CSV = os.path.join("results", "{}-drugs-from-ciel.csv")
+MODE_CIEL_NEEDS_CSV = os.path.join("results", "{}-ciel-needs.csv")
+CIEL_NEEDS_CSV = os.path.join("results", "ciel-needs.csv")
+DUPLICATES_CSV = os.path.join("results", "meds-duplicates.csv")
+
+
+def load_ciel_in_dictionary():
+    """
+    Returns:
+        pd.Index: the integer CIEL codes of the unvoided concepts in the
+            dictionary. Rows whose ID isn't a CIEL code (there are a few ICD
+            codes in the export) are left out.
+    """
+    extant = pd.read_csv(CIEL_IN_DICTIONARY_CSV, dtype={"ID": str})
+    extant = extant[extant["voided"] == 0]
+    codes = pd.to_numeric(extant["ID"], errors="coerce").dropna().astype("int64")
+    return pd.Index(codes.unique())
+
+
+def load_matches():
+    """
+    Returns:
+        dict: {mode: its match table}, read as current_session.py read it,
+            so that the reports are written the way it wrote them
+    """
+    return {mode: pd.read_csv(MATCHES_CSV.format(mode)) for mode in MODES}
+
+
+def join_modes(tables):
+    """
+    Args:
+        tables (dict): as returned by load_matches
+
+    Returns:
+        pd.DataFrame: the `concept` and `name_es` of the drugs of both modes,
+            one mode after the other, indexed by mode and row, with `mode`,
+            `source` ('CIEL' or 'PIH') and integer `ciel_id` columns added
+    """
+    matches = pd.concat(
+        [
+            table[["concept", "name_es"]].assign(mode=mode)
+            for mode, table in tables.items()
+        ],
+        keys=tables.keys(),
+    )
+    parts = matches["concept"].str.extract(r"^(?P<source>\w+):(?P<ciel_id>\d+)$")
+    matches["source"] = parts["source"]
+    matches["ciel_id"] = pd.to_numeric(parts["ciel_id"]).astype("Int64")
+    return matches
+
+
+def reconcile(matches, extant):
+    """
+    Args:
+        matches (pd.DataFrame): as returned by join_modes
+        extant (pd.Index): as returned by load_ciel_in_dictionary
+
+    Returns:
+        pd.Series: the status of each match, 'ready', 'needs' (a CIEL
+            concept that isn't in the dictionary), 'pih' or 'unmatched'
+    """
+    is_ciel = (matches["source"] == "CIEL").to_numpy()
+    in_dictionary = matches["ciel_id"].isin(extant).to_numpy(dtype=bool)
+    status = pd.Series("unmatched", index=matches.index, name="status")
+    status[matches["source"] == "PIH"] = "pih"
+    status[is_ciel & in_dictionary] = "ready"
+    status[is_ciel & ~in_dictionary] = "needs"
+    return status
+
+
+def find_duplicates(matches):
+    """
+    Returns:
+        pd.DataFrame: the matched drugs whose concept is shared by another
+            drug, in either mode, with the number of drugs sharing it and
+            the modes they're from. Sorted by concept.
+    """
+    matched = matches[matches["source"].notna()]
+    by_concept = matched.groupby("concept")["mode"]
+    shared = matched.assign(
+        drugs=by_concept.transform("size"),
+        modes=by_concept.transform(lambda m: " ".join(sorted(set(m)))),
+    )
+    shared = shared[shared["drugs"] > 1]
+    return shared.sort_values(["concept", "mode"], kind="stable")[
+        ["concept", "drugs", "modes", "mode", "name_es"]
+    ]
+
+
+def write_reports(tables, matches, status):
+    """
+    Writes the reports listed in the module docstring. The ones
+    current_session.py wrote are written in the same layout: the drugs of a
+    mode with the columns of its match table and their row in it, and the
+    CIEL concepts as a column named 0, with their position.
+    """
+    for mode, table in tables.items():
+        of_mode = status.loc[mode]
+        table[of_mode == "ready"].to_csv(READY_CSV.format(mode))
+        needs = table[of_mode == "needs"]
+        needs.to_csv(DRUGS_FROM_CIEL_CSV.format(mode))
+        pd.DataFrame(needs["concept"].unique()).to_csv(MODE_CIEL_NEEDS_CSV.format(mode))
+    needs = matches[status == "needs"]
+    pd.DataFrame(needs["concept"].unique()).to_csv(CIEL_NEEDS_CSV)
+    find_duplicates(matches).to_csv(DUPLICATES_CSV, index=False)
+
+
+def print_summary(matches, status):
+    counts = pd.crosstab(matches["mode"], status)
+    print(counts.reindex(columns=["ready", "needs", "pih", "unmatched"], fill_value=0))
+    needs = matches.loc[status == "needs", "concept"]
+    print("{} CIEL concepts to import".format(needs.nunique()))
+
+
+def main():
+    start = time.perf_counter()
+    extant = load_ciel_in_dictionary()
+    tables = load_matches()
+    matches = join_modes(tables)
+    status = reconcile(matches, extant)
+    write_reports(tables, matches, status)
+    print_summary(matches, status)
+    print("Reconciled in {:.2f}s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Tests for match_cache.py"""
+from fuzzywuzzy import fuzz
+
+from match_cache import ScoreCache
+
+DICTIONARY = {"1": "amoxicilina", "2": "paracetamol"}
+
+
+def test_whole_dictionary_caches_share_a_file_and_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = ScoreCache("hum", DICTIONARY, fuzz.WRatio, candidate_limit=0)
+    first["amoxicilina"] = [("amoxicilina", 100, "1")]
+    first.save()
+
+    # --candidates 0 and the choice stage both score the whole dictionary
+    second = ScoreCache("hum", DICTIONARY, fuzz.WRatio, candidate_limit=None)
+    assert second.name == first.name
+    assert "amoxicilina" in second
+    second["paracetamol"] = [("paracetamol", 100, "2")]
+    second.save()
+
+    third = ScoreCache("hum", DICTIONARY, fuzz.WRatio, candidate_limit=0)
+    assert "amoxicilina" in third and "paracetamol" in third
+
+
+def test_shortlist_sizes_have_their_own_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    whole = ScoreCache("hum", DICTIONARY, fuzz.WRatio, candidate_limit=None)
+    shortlist = ScoreCache("hum", DICTIONARY, fuzz.WRatio, candidate_limit=50)
+    assert whole.name != shortlist.name
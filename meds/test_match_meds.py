@@ -0,0 +1,63 @@
+"""Tests for match_meds.py"""
+import os
+
+import match_meds
+from test_working_store import LINES, match
+from working_store import WorkingStore
+
+
+class Candidates:
+    """Offers the same options for every drug"""
+
+    def __getitem__(self, clean_name):
+        hum = [("hum option", 80, "HUM:{}".format(i)) for i in range(2)]
+        ciel = [("ciel option", 70, "CIEL:{}".format(i)) for i in range(6)]
+        return hum, ("ciel sorted option", 75, "CIEL:9"), ciel
+
+
+class Hum:
+    def full_name(self, code):
+        return "HUM option"
+
+
+def test_each_drug_without_a_code_gets_its_own_answer(tmp_path, monkeypatch):
+    lines = LINES + LINES[2:3]
+    store = WorkingStore(str(tmp_path / "meds.sqlite"))
+    store.load_inputs("ssa", lines)
+    monkeypatch.setattr(match_meds, "MODE", "ssa")
+    questions = []
+
+    def answer(prompt):
+        questions.append(prompt)
+        return "1"
+
+    monkeypatch.setattr("builtins.input", answer)
+    match_meds._ask_for_matches(lines, Hum(), Candidates(), store)
+
+    # Asked once about each line but the repeated one
+    assert len(questions) == len(LINES)
+    assert len(store.matches("ssa", "choice")) == len(lines)
+    store.close()
+
+
+def test_the_csvs_of_older_versions_are_imported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(match_meds, "MODE", "ssa")
+    os.makedirs("output")
+    os.makedirs("intermediates")
+    match_meds.write_to_csv(
+        [match(LINES[0], "HUM:1")], match_meds.MATCHES_HUM_AUTO_CSV()
+    )
+    match_meds.write_to_csv(
+        [match(LINES[2], "CIEL:2")], match_meds.MATCHES_CHOICE_CSV()
+    )
+    match_meds.write_to_csv([LINES[3]], match_meds.UNMATCHED_CSV())
+    store = WorkingStore(str(tmp_path / "meds.sqlite"))
+    store.load_inputs("ssa", LINES)
+
+    match_meds.import_legacy_state(store)
+    assert [m[3] for m in store.matches("ssa", "hum")] == ["HUM:1"]
+    assert [m[3] for m in store.matches("ssa", "choice")] == ["CIEL:2"]
+    assert store.no_match("ssa") == [LINES[3]]
+    assert store.stage_done("ssa", "hum") and not store.stage_done("ssa", "ciel")
+    store.close()
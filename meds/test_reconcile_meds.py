@@ -0,0 +1,58 @@
+"""Tests for reconcile_meds.py"""
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import reconcile_meds
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def reports(tmp_path, monkeypatch):
+    """Reconciles the committed match tables in `tmp_path`"""
+    os.makedirs(tmp_path / "results")
+    os.makedirs(tmp_path / "input")
+    for mode in reconcile_meds.MODES:
+        shutil.copy(
+            os.path.join(HERE, reconcile_meds.MATCHES_CSV.format(mode)),
+            tmp_path / "results",
+        )
+    shutil.copy(
+        os.path.join(HERE, reconcile_meds.CIEL_IN_DICTIONARY_CSV), tmp_path / "input"
+    )
+    monkeypatch.chdir(tmp_path)
+    reconcile_meds.main()
+    return tmp_path
+
+
+def contents(filename):
+    with open(filename, encoding="utf8") as f:
+        return f.read()
+
+
+REPORTS = [
+    csv.format(mode)
+    for csv in [
+        reconcile_meds.READY_CSV,
+        reconcile_meds.DRUGS_FROM_CIEL_CSV,
+        reconcile_meds.MODE_CIEL_NEEDS_CSV,
+    ]
+    for mode in reconcile_meds.MODES
+] + [reconcile_meds.CIEL_NEEDS_CSV, reconcile_meds.DUPLICATES_CSV]
+
+
+@pytest.mark.parametrize("report", REPORTS)
+def test_reports_are_the_committed_ones(reports, report):
+    # The ones in results/ that current_session.py wrote are compared too,
+    # so that their layout stays the same
+    assert contents(reports / report) == contents(os.path.join(HERE, report))
+
+
+def test_ssa_codes_are_kept(reports):
+    ready = pd.read_csv(reports / reconcile_meds.READY_CSV.format("ssa"), dtype=str)
+    matches = pd.read_csv(reports / reconcile_meds.MATCHES_CSV.format("ssa"), dtype=str)
+    assert ready["code"].notna().all()
+    assert set(ready["code"]) <= set(matches["code"])
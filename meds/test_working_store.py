@@ -0,0 +1,86 @@
+"""Tests for working_store.py"""
+import pytest
+
+from working_store import WorkingStore, row_key
+
+# [ssa_code, ssa_name, moa, clean_ssa_name], with a code that repeats with
+# different names, and placeholder codes
+LINES = [
+    ("010.000.0101.00", "ACIDO ACETILSALICILICO 500 MG", "TABLETA", "acido 500"),
+    ("010.000.0101.00", "ACIDO FOLICO 5 MG", "TABLETA", "acido folico 5"),
+    ("S/C", "MISOPROSTOL 200 MCG", "TABLETA", "misoprostol 200"),
+    ("S/C", "LORATADINA 10 MG", "TABLETA", "loratadina 10"),
+    ("SIN CLAVE", "NISTATINA 100 000 UI", "SUSPENSION", "nistatina"),
+    ("SIN CLAVE", "DIFENHIDRAMINA 25 MG", "CAPSULA", "difenhidramina 25"),
+]
+
+
+def match(line, concept_code):
+    """A match of `line`, as the stages record them"""
+    return [line[0], line[1], line[2], concept_code, line[3], 90]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = WorkingStore(str(tmp_path / "meds.sqlite"))
+    store.load_inputs("ssa", LINES)
+    yield store
+    store.close()
+
+
+def test_every_line_has_its_own_key():
+    assert len({row_key(l) for l in LINES}) == len(LINES)
+
+
+def test_placeholder_codes_are_keyed_on_the_name():
+    assert row_key(("S/C", "LORATADINA 10 MG")) == row_key(
+        ("SIN CLAVE", "LORATADINA 10 MG")
+    )
+    assert row_key(("-", "LORATADINA 10 MG")) == "LORATADINA 10 MG"
+
+
+def test_a_decision_is_about_one_line(store):
+    store.record_matches("ssa", "hum", [match(LINES[2], "CIEL:1")])
+    store.record_no_match("ssa", [LINES[0]])
+
+    assert store.matches("ssa", "hum") == [
+        (*LINES[2][:3], "CIEL:1", "misoprostol 200", 90)
+    ]
+    assert store.no_match("ssa") == [LINES[0]]
+    assert store.undecided("ssa") == [LINES[1], LINES[3], LINES[4], LINES[5]]
+
+
+def test_each_line_is_either_matched_no_match_or_undecided(store):
+    store.record_matches("ssa", "hum", [match(LINES[2], "CIEL:1")])
+    store.record_matches("ssa", "ciel", [match(LINES[4], "CIEL:2")])
+    store.record_no_match("ssa", [LINES[3], LINES[5]])
+
+    outcomes = (
+        [m[:3] for stage in ["hum", "ciel"] for m in store.matches("ssa", stage)]
+        + [l[:3] for l in store.no_match("ssa")]
+        + [l[:3] for l in store.undecided("ssa")]
+    )
+    assert sorted(outcomes) == sorted(l[:3] for l in LINES)
+
+
+def test_duplicate_lines_share_a_decision(store):
+    duplicate = LINES[:1] + LINES
+    store.load_inputs("ssa", duplicate)
+    store.record_matches("ssa", "hum", [match(LINES[0], "CIEL:1")])
+    assert len(store.matches("ssa", "hum")) == 2
+    assert LINES[1] in store.undecided("ssa")
+
+
+def test_update_only_forgets_the_lines_that_changed(store):
+    store.record_matches("ssa", "hum", [match(l, "CIEL:1") for l in LINES[:3]])
+    store.record_no_match("ssa", LINES[3:])
+    edited = list(LINES)
+    # Another packaging of the same drug, and a drug renamed, both under 'S/C'
+    edited[3] = (*LINES[3][:2], "JARABE", LINES[3][3])
+    edited[2] = ("S/C", "MISOPROSTOL 100 MCG", *LINES[2][2:])
+    store.load_inputs("ssa", edited)
+
+    assert store.forget_stale("ssa") == (1, 1)
+    assert store.undecided("ssa") == [edited[2], edited[3]]
+    assert len(store.matches("ssa", "hum")) == 2
+    assert store.no_match("ssa") == [LINES[4], LINES[5]]
@@ -0,0 +1,389 @@
+"""
+working_store.py
+
+The state of match_meds.py, kept in a SQLite database in intermediates/:
+the input drugs, the dictionary concepts, the options the choice stage
+offered, and the decision made about each drug. The CSVs in output/ are
+exported from views on it.
+
+Decisions are keyed on the drug's row key (see row_key) rather than its
+line number, so they survive lines being added to or removed from the input.
+"""
+import hashlib
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inputs (
+    mode TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    row_key TEXT NOT NULL,
+    row_hash TEXT NOT NULL,
+    ssa_code TEXT NOT NULL,
+    ssa_name TEXT NOT NULL,
+    moa TEXT NOT NULL,
+    clean_name TEXT NOT NULL,
+    PRIMARY KEY (mode, line)
+);
+CREATE INDEX IF NOT EXISTS inputs_row_key ON inputs (mode, row_key);
+
+CREATE TABLE IF NOT EXISTS concepts (
+    source TEXT NOT NULL,
+    concept_code TEXT NOT NULL,
+    clean_name TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    PRIMARY KEY (source, concept_code)
+);
+CREATE INDEX IF NOT EXISTS concepts_concept_code ON concepts (concept_code);
+CREATE INDEX IF NOT EXISTS concepts_clean_name ON concepts (clean_name);
+
+-- The options offered for a drug in the choice stage, best first
+CREATE TABLE IF NOT EXISTS candidates (
+    mode TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    concept_code TEXT NOT NULL,
+    clean_other_name TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (mode, row_key, rank)
+);
+
+-- stage is 'hum', 'ciel' or 'choice' for a match, or 'none' for a drug that
+-- was decided to have no match. score is '-' for matches chosen by a person.
+-- row_hash is that of the input line the decision was made about.
+CREATE TABLE IF NOT EXISTS decisions (
+    mode TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    row_hash TEXT,
+    stage TEXT NOT NULL,
+    concept_code TEXT,
+    clean_other_name TEXT,
+    score,
+    PRIMARY KEY (mode, row_key)
+);
+CREATE INDEX IF NOT EXISTS decisions_stage ON decisions (mode, stage);
+CREATE INDEX IF NOT EXISTS decisions_concept_code ON decisions (concept_code);
+
+-- The automatic stages that have been run over every undecided drug
+CREATE TABLE IF NOT EXISTS stages (
+    mode TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    PRIMARY KEY (mode, stage)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE VIEW IF NOT EXISTS matches AS
+SELECT i.mode, i.line, i.ssa_code, i.ssa_name, i.moa, d.concept_code,
+    d.clean_other_name, d.score, d.stage
+FROM inputs AS i
+JOIN decisions AS d ON d.mode = i.mode AND d.row_key = i.row_key
+WHERE d.stage != 'none';
+
+CREATE VIEW IF NOT EXISTS no_match AS
+SELECT i.mode, i.line, i.ssa_code, i.ssa_name, i.moa, i.clean_name
+FROM inputs AS i
+JOIN decisions AS d ON d.mode = i.mode AND d.row_key = i.row_key
+WHERE d.stage = 'none';
+
+CREATE VIEW IF NOT EXISTS undecided AS
+SELECT i.mode, i.line, i.row_key, i.ssa_code, i.ssa_name, i.moa, i.clean_name
+FROM inputs AS i
+LEFT JOIN decisions AS d ON d.mode = i.mode AND d.row_key = i.row_key
+WHERE d.row_key IS NULL;
+
+CREATE VIEW IF NOT EXISTS review AS
+SELECT u.mode, u.line, u.ssa_code, u.ssa_name, u.moa, u.clean_name, c.score,
+    c.concept_code, c.clean_other_name
+FROM undecided AS u
+JOIN candidates AS c ON c.mode = u.mode AND c.row_key = u.row_key AND c.rank = 0;
+"""
+
+# The decisions that no longer hold, because the input line they were made
+# about has changed, or is gone
+CHANGED_DECISIONS = """
+mode = :mode AND row_key IN (SELECT row_key FROM inputs WHERE mode = :mode)
+AND NOT EXISTS (
+    SELECT 1 FROM inputs AS i
+    WHERE i.mode = :mode AND i.row_key = decisions.row_key
+        AND i.row_hash = decisions.row_hash
+)
+"""
+REMOVED_DECISIONS = """
+mode = :mode AND row_key NOT IN (SELECT row_key FROM inputs WHERE mode = :mode)
+"""
+
+
+# What the SSA list has in place of the code of drugs without one. CES drugs
+# get '-'.
+PLACEHOLDER_CODES = {"", "-", "S/C", "SIN CLAVE"}
+
+
+def row_key(line):
+    """
+    Identifies a line of the input across versions of the input file, by its
+    SSA code and name. Codes alone don't: some repeat with different names,
+    and drugs without one have a placeholder like 'S/C', so those are
+    identified by their name alone. Lines with the same key are the same
+    drug, and share a decision.
+    """
+    code, name = line[0].strip(), line[1]
+    if code.upper() in PLACEHOLDER_CODES:
+        return name
+    return code + "\t" + name
+
+
+def row_hash(line):
+    """Returns a sha1 hex digest of [ssa_code, ssa_name, moa, clean_ssa_name]"""
+    return hashlib.sha1("\0".join(line).encode("utf8")).hexdigest()
+
+
+class WorkingStore:
+    """
+    Each method that changes the store commits before returning, so that
+    whatever has been recorded survives the script being interrupted.
+    """
+
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def has_inputs(self, mode):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM inputs WHERE mode = ? LIMIT 1", (mode,)
+            ).fetchone()
+            is not None
+        )
+
+    def load_inputs(self, mode, input_data):
+        """
+        Replaces the input drugs for `mode` with `input_data`.
+
+        Args:
+            mode (str): 'ssa' or 'ces'
+            input_data (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+
+        Returns:
+            int: how many of the lines' row keys weren't in the previous input
+        """
+        previous = {
+            k
+            for (k,) in self.db.execute(
+                "SELECT row_key FROM inputs WHERE mode = ?", (mode,)
+            )
+        }
+        rows = [
+            (mode, i, row_key(l), row_hash(l), *l) for i, l in enumerate(input_data)
+        ]
+        with self.db:
+            self.db.execute("DELETE FROM inputs WHERE mode = ?", (mode,))
+            self.db.executemany(
+                "INSERT INTO inputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len({r[2] for r in rows} - previous)
+
+    def load_concepts(self, dictionary, source_hash):
+        """
+        Replaces the concepts from `dictionary`, unless they were loaded from
+        the same version of its source already.
+
+        Args:
+            dictionary (DrugDictionary)
+            source_hash (str): the hash of the file `dictionary` was built from
+
+        Returns:
+            bool: whether the source has changed since it was last loaded
+        """
+        key = "source_hash:" + dictionary.name
+        previous_hash = self.get_meta(key)
+        if previous_hash == source_hash:
+            return False
+        with self.db:
+            self.db.execute("DELETE FROM concepts WHERE source = ?", (dictionary.name,))
+            self.db.executemany(
+                "INSERT INTO concepts VALUES (?, ?, ?, ?)",
+                (
+                    (dictionary.name, code, clean_name, full_name)
+                    for code, clean_name, full_name in zip(
+                        dictionary.codes, dictionary.clean_names, dictionary.full_names
+                    )
+                ),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, source_hash),
+            )
+        return previous_hash is not None
+
+    def undecided(self, mode):
+        """
+        Returns:
+            [(ssa_code, ssa_name, moa, clean_ssa_name)], in input order, for
+                the drugs there's no decision about
+        """
+        return self.db.execute(
+            "SELECT ssa_code, ssa_name, moa, clean_name FROM undecided "
+            "WHERE mode = ? ORDER BY line",
+            (mode,),
+        ).fetchall()
+
+    def matches(self, mode, stage):
+        """
+        Returns:
+            [(ssa_code, ssa_name, moa, concept_code, clean_other_name, score)],
+                in input order, for the drugs matched in `stage`
+        """
+        return self.db.execute(
+            "SELECT ssa_code, ssa_name, moa, concept_code, clean_other_name, score "
+            "FROM matches WHERE mode = ? AND stage = ? ORDER BY line",
+            (mode, stage),
+        ).fetchall()
+
+    def no_match(self, mode):
+        """
+        Returns:
+            [(ssa_code, ssa_name, moa, clean_ssa_name)], in input order, for the
+                drugs decided to have no match
+        """
+        return self.db.execute(
+            "SELECT ssa_code, ssa_name, moa, clean_name FROM no_match "
+            "WHERE mode = ? ORDER BY line",
+            (mode,),
+        ).fetchall()
+
+    def review(self, mode):
+        """
+        Returns:
+            [(ssa_code, ssa_name, moa, clean_ssa_name, score, concept_code,
+                clean_other_name)] with the best option for each undecided drug
+                that was offered options, highest scoring first
+        """
+        return self.db.execute(
+            "SELECT ssa_code, ssa_name, moa, clean_name, score, concept_code, "
+            "clean_other_name FROM review WHERE mode = ? ORDER BY score DESC, line",
+            (mode,),
+        ).fetchall()
+
+    def record_matches(self, mode, stage, matches):
+        """
+        Args:
+            matches (list): [ssa_code, ssa_name, moa, concept_code,
+                clean_other_name, score]
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO decisions VALUES "
+                "(:mode, :key, (SELECT row_hash FROM inputs "
+                "WHERE mode = :mode AND row_key = :key LIMIT 1), "
+                ":stage, :code, :name, :score)",
+                (
+                    {
+                        "mode": mode,
+                        "key": row_key(m),
+                        "stage": stage,
+                        "code": m[3],
+                        "name": m[4],
+                        "score": m[5],
+                    }
+                    for m in matches
+                ),
+            )
+
+    def record_no_match(self, mode, lines):
+        """
+        Args:
+            lines (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO decisions VALUES "
+                "(:mode, :key, (SELECT row_hash FROM inputs "
+                "WHERE mode = :mode AND row_key = :key LIMIT 1), "
+                "'none', NULL, NULL, NULL)",
+                ({"mode": mode, "key": row_key(l)} for l in lines),
+            )
+
+    def record_candidates(self, mode, line, options):
+        """
+        Args:
+            line (list): [ssa_code, ssa_name, moa, clean_ssa_name]
+            options (list): [(clean_other_name, score, concept_code)], best first
+        """
+        key = row_key(line)
+        with self.db:
+            self.db.execute(
+                "DELETE FROM candidates WHERE mode = ? AND row_key = ?", (mode, key)
+            )
+            self.db.executemany(
+                "INSERT INTO candidates VALUES (?, ?, ?, ?, ?, ?)",
+                ((mode, key, rank, o[2], o[0], o[1]) for rank, o in enumerate(options)),
+            )
+
+    def count_stale(self, mode):
+        """
+        Returns:
+            changed (int): how many decisions are about lines that have changed
+            removed (int): how many are about lines no longer in the input
+        """
+        return tuple(
+            self.db.execute(
+                "SELECT COUNT(*) FROM decisions WHERE " + where, {"mode": mode}
+            ).fetchone()[0]
+            for where in [CHANGED_DECISIONS, REMOVED_DECISIONS]
+        )
+
+    def forget_stale(self, mode):
+        """
+        Deletes the decisions counted by count_stale.
+
+        Returns:
+            changed (int), removed (int): how many there were
+        """
+        with self.db:
+            return tuple(
+                self.db.execute(
+                    "DELETE FROM decisions WHERE " + where, {"mode": mode}
+                ).rowcount
+                for where in [CHANGED_DECISIONS, REMOVED_DECISIONS]
+            )
+
+    def forget_unknown_concepts(self, mode):
+        """
+        Deletes the matches to concepts that aren't in the loaded dictionaries
+        any more. Returns how many there were.
+        """
+        with self.db:
+            return self.db.execute(
+                "DELETE FROM decisions WHERE mode = ? AND stage != 'none' "
+                "AND concept_code NOT IN (SELECT concept_code FROM concepts)",
+                (mode,),
+            ).rowcount
+
+    def stage_done(self, mode, stage):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM stages WHERE mode = ? AND stage = ?", (mode, stage)
+            ).fetchone()
+            is not None
+        )
+
+    def finish_stage(self, mode, stage):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO stages VALUES (?, ?)", (mode, stage))
+
+    def reset_stages(self, mode):
+        """Marks the automatic stages as needing to run over the undecided drugs"""
+        with self.db:
+            self.db.execute("DELETE FROM stages WHERE mode = ?", (mode,))
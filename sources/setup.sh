@@ -0,0 +1,4 @@
+#! /bin/sh
+
+python3 -m venv env
+./env/bin/pip install -r requirements.txt
@@ -0,0 +1,197 @@
+"""
+snapshot_store.py
+
+A local store of versioned snapshots of the dictionary sources, which
+sync_sources.py writes and the matching scripts read. It's laid out as
+
+    snapshots/
+        CURRENT                  the name of the current version
+        versions/<version>/      one directory per snapshot, with the files
+                                 in the layouts the scripts read, and a
+                                 manifest.json of where each came from
+        pending/<source>/        the pages of a sync that hasn't finished
+
+A version is only ever written in a temporary directory and renamed into
+place once complete, and CURRENT is only moved to it after that, so a
+reader always sees a whole snapshot. The pages of an interrupted sync are
+kept in pending/, so that running it again only fetches the missing ones.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional
+
+MANIFEST = "manifest.json"
+
+
+def file_hash(filename: str) -> str:
+    """The SHA-256 of the contents of `filename`"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_hashes(files: Dict) -> Dict[str, str]:
+    """{filename: SHA-256} of the `files` of a manifest"""
+    return {filename: origin["sha256"] for filename, origin in files.items()}
+
+
+def write_atomically(filename: str, text: str):
+    """Writes `text` to `filename` so that readers see all of it or none"""
+    temporary = filename + ".tmp"
+    with open(temporary, "w", encoding="utf8") as f:
+        f.write(text)
+    os.replace(temporary, filename)
+
+
+class PendingPages:
+    """The pages of one source fetched so far by a sync"""
+
+    def __init__(self, directory: str, plan: Dict):
+        """
+        Pages fetched with a different `plan` (the source's URL or query,
+        page size and total) are thrown away, since they may not line up.
+        """
+        self.directory = directory
+        plan_filename = os.path.join(directory, "plan.json")
+        if os.path.exists(plan_filename):
+            with open(plan_filename, encoding="utf8") as f:
+                if json.load(f) != plan:
+                    self.clear()
+        os.makedirs(directory, exist_ok=True)
+        write_atomically(plan_filename, json.dumps(plan, sort_keys=True))
+
+    def _filename(self, page: int) -> str:
+        return os.path.join(self.directory, "page-{:05d}.json".format(page))
+
+    def has(self, page: int) -> bool:
+        return os.path.exists(self._filename(page))
+
+    def write(self, page: int, items: List):
+        write_atomically(self._filename(page), json.dumps(items))
+
+    def read(self, page: int) -> List:
+        with open(self._filename(page), encoding="utf8") as f:
+            return json.load(f)
+
+    def items(self, pages: int) -> Iterator:
+        """The items of pages 1 to `pages`, in order"""
+        for page in range(1, pages + 1):
+            yield from self.read(page)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SnapshotStore:
+    """The snapshots in the directory `root`"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.versions_dir = os.path.join(root, "versions")
+        self.pending_dir = os.path.join(root, "pending")
+
+    def current(self) -> Optional[str]:
+        """The name of the current version, or None if there isn't one yet"""
+        try:
+            with open(os.path.join(self.root, "CURRENT"), encoding="utf8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def path(self, filename: str, version: Optional[str] = None) -> str:
+        """Where `filename` is in `version`, by default the current one"""
+        version = version or self.current()
+        if version is None:
+            raise FileNotFoundError("There's no snapshot in " + self.root)
+        return os.path.join(self.versions_dir, version, filename)
+
+    def manifest(self, version: Optional[str] = None) -> Dict:
+        """The manifest of `version`, or an empty one if there's no snapshot"""
+        if (version or self.current()) is None:
+            return {"files": {}}
+        with open(self.path(MANIFEST, version), encoding="utf8") as f:
+            return json.load(f)
+
+    def pending(self, source: str, plan: Dict) -> PendingPages:
+        return PendingPages(os.path.join(self.pending_dir, source), plan)
+
+    def clear_pending(self, source: str):
+        """Throws away the pages of `source` that a sync left behind"""
+        shutil.rmtree(os.path.join(self.pending_dir, source), ignore_errors=True)
+
+    def new_version(self) -> "NewVersion":
+        return NewVersion(self)
+
+
+class NewVersion:
+    """A snapshot being written, which readers can't see until it's published"""
+
+    def __init__(self, store: SnapshotStore):
+        self.store = store
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+        self.name = self.created.strftime("%Y%m%dT%H%M%SZ")
+        self.directory = os.path.join(store.versions_dir, "." + self.name)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        # {filename: where it came from}
+        self.files = {}
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def add(self, filename: str, **origin):
+        """Records where the file written to path(filename) came from"""
+        self.files[filename] = origin
+
+    def carry_over(self, filenames: List[str]):
+        """Copies `filenames` from the current version, where it has them"""
+        current = self.store.manifest()
+        for filename in filenames:
+            if filename in current["files"] and filename not in self.files:
+                shutil.copyfile(self.store.path(filename), self.path(filename))
+                self.files[filename] = dict(
+                    current["files"][filename], carried_over=True
+                )
+
+    def publish(self) -> str:
+        """
+        Makes this the current version, unless its files are the same as
+        the current version's, in which case it's thrown away.
+
+        Returns:
+            str: the name of the current version
+        """
+        for filename, origin in self.files.items():
+            origin.update(
+                sha256=file_hash(self.path(filename)),
+                bytes=os.path.getsize(self.path(filename)),
+            )
+        current = self.store.current()
+        previous = self.store.manifest()["files"]
+        if current and file_hashes(previous) == file_hashes(self.files):
+            self.discard()
+            return current
+        name = self.name
+        suffix = 1
+        while os.path.exists(os.path.join(self.store.versions_dir, name)):
+            suffix += 1
+            name = "{}-{}".format(self.name, suffix)
+        manifest = {
+            "version": name,
+            "created": self.created.isoformat(timespec="seconds"),
+            "previous": current,
+            "files": self.files,
+        }
+        with open(self.path(MANIFEST), "w", encoding="utf8") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(self.directory, os.path.join(self.store.versions_dir, name))
+        write_atomically(os.path.join(self.store.root, "CURRENT"), name + "\n")
+        return name
+
+    def discard(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
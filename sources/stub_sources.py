@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+"""
+stub_sources.py
+
+Stand-ins for the sources sync_sources.py reads, made from the sample data
+in this repo, to try it or work on it without the network:
+
+    ./stub_sources.py serve --port 8000 &
+    ./stub_sources.py db pih.sqlite ../diagnoses/input/pih-diagnoses-w-names.csv
+    ./sync_sources.py --ocl-url http://localhost:8000 --pih-db sqlite:///pih.sqlite
+
+`serve` answers the OCL API listings that sync_sources.py pages through,
+with the CIEL drugs in meds/input/meds-ciel.json and ICD-10 mappings made
+from diagnoses/input/ciel-diagnoses.csv. --fail-every makes it fail some
+requests, and --delay makes it slow, to see the retries and concurrency at
+work; killing it halfway through a sync leaves pages to resume from.
+
+`db` writes a SQLite database with the OpenMRS tables that the diagnosis
+query reads, filled from a CSV of concept IDs, names, locales and ICD-10
+codes, like diagnoses/input/pih-diagnoses-w-names.csv.
+"""
+import argparse
+import csv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+import urllib.parse
+
+CONCEPTS_JSON = os.path.join("..", "meds", "input", "meds-ciel.json")
+ICD_CODES_CSV = os.path.join("..", "diagnoses", "input", "ciel-diagnoses.csv")
+
+CONCEPTS_PATH = "/orgs/CIEL/sources/CIEL/concepts/"
+MAPPINGS_PATH = "/orgs/CIEL/sources/CIEL/mappings/"
+
+# The OpenMRS tables that the diagnosis query reads, with just the columns
+# it uses, and concept_name's
+OPENMRS_SCHEMA = """
+CREATE TABLE concept_reference_term (
+    concept_reference_term_id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL
+);
+CREATE TABLE concept_reference_map (
+    concept_map_id INTEGER PRIMARY KEY,
+    concept_reference_term_id INTEGER NOT NULL,
+    concept_id INTEGER NOT NULL,
+    concept_map_type_id INTEGER NOT NULL
+);
+CREATE TABLE concept_name (
+    concept_name_id INTEGER PRIMARY KEY,
+    concept_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    locale TEXT NOT NULL,
+    voided INTEGER NOT NULL DEFAULT 0
+);
+"""
+SAME_AS = 2
+
+
+def icd_mappings(filename: str) -> List[Dict]:
+    """OCL mappings from CIEL concepts to ICD-10, from a CSV of (concept_id, code)"""
+    with open(filename, "r", encoding="utf8", newline="") as f:
+        return [
+            {
+                "id": str(i),
+                "map_type": "SAME-AS",
+                "from_concept_code": concept_id,
+                "to_concept_code": code,
+                "to_source_name": "ICD-10-WHO",
+            }
+            for i, (concept_id, code) in enumerate(r for r in csv.reader(f) if r)
+        ]
+
+
+class OclStub(BaseHTTPRequestHandler):
+    """Answers OCL API listings from the server's `listings`, a page at a time"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_every and server.requests % server.fail_every == 0
+        time.sleep(server.delay)
+        url = urllib.parse.urlsplit(self.path)
+        if fail:
+            self.send_error(503, "Failing every {} requests".format(server.fail_every))
+            return
+        if url.path not in server.listings:
+            self.send_error(404)
+            return
+        params = dict(urllib.parse.parse_qsl(url.query))
+        items = [
+            item
+            for item in server.listings[url.path]
+            if params.get("conceptClass") in [None, item.get("concept_class")]
+            and params.get("mapType") in [None, item.get("map_type")]
+        ]
+        limit = int(params.get("limit", 10))
+        page = int(params.get("page", 1))
+        body = json.dumps(items[(page - 1) * limit : page * limit]).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("num_found", str(len(items)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(args):
+    with open(args.concepts, "r", encoding="utf8") as f:
+        concepts = json.load(f)
+    server = ThreadingHTTPServer(("localhost", args.port), OclStub)
+    server.listings = {
+        CONCEPTS_PATH: concepts,
+        MAPPINGS_PATH: icd_mappings(args.icd_codes),
+    }
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.fail_every = args.fail_every
+    server.delay = args.delay
+    server.verbose = args.verbose
+    print(
+        "Serving {} concepts and {} mappings at http://localhost:{}".format(
+            len(concepts), len(server.listings[MAPPINGS_PATH]), args.port
+        ),
+        flush=True,
+    )
+    server.serve_forever()
+
+
+def write_db(args):
+    """Writes a SQLite stand-in for the OpenMRS tables the sync queries"""
+    if os.path.exists(args.database):
+        os.remove(args.database)
+    db = sqlite3.connect(args.database)
+    db.executescript(OPENMRS_SCHEMA)
+    terms = {}
+    maps = set()
+    with open(args.names, "r", encoding="utf8", newline="") as f:
+        for concept_id, name, locale, code in (r for r in csv.reader(f) if r):
+            db.execute(
+                "INSERT INTO concept_name (concept_id, name, locale) VALUES (?, ?, ?)",
+                (int(concept_id), name, locale),
+            )
+            if code not in terms:
+                terms[code] = len(terms) + 1
+                db.execute(
+                    "INSERT INTO concept_reference_term VALUES (?, ?)",
+                    (terms[code], code),
+                )
+            if (concept_id, code) not in maps:
+                maps.add((concept_id, code))
+                db.execute(
+                    "INSERT INTO concept_reference_map (concept_reference_term_id, "
+                    "concept_id, concept_map_type_id) VALUES (?, ?, ?)",
+                    (terms[code], int(concept_id), SAME_AS),
+                )
+    db.commit()
+    db.close()
+    print(
+        "Wrote {} concepts with {} ICD-10 codes to {}".format(
+            len({c for c, _ in maps}), len(terms), args.database
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stand-ins for the OCL API and OpenMRS databases"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="serve a stand-in OCL API")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--concepts",
+        default=CONCEPTS_JSON,
+        help="a JSON array of OCL concepts to serve. Default {}.".format(CONCEPTS_JSON),
+    )
+    serve_parser.add_argument(
+        "--icd-codes",
+        default=ICD_CODES_CSV,
+        help="a CSV of (concept_id, ICD-10 code) to serve as mappings. "
+        "Default {}.".format(ICD_CODES_CSV),
+    )
+    serve_parser.add_argument(
+        "--fail-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="answer every Nth request with a 503",
+    )
+    serve_parser.add_argument(
+        "--delay", type=float, default=0, help="seconds to wait before answering"
+    )
+    serve_parser.add_argument("--verbose", action="store_true", help="log each request")
+    serve_parser.set_defaults(run=serve)
+
+    db_parser = commands.add_parser(
+        "db", help="write a SQLite stand-in for an OpenMRS database"
+    )
+    db_parser.add_argument("database", help="the SQLite file to write")
+    db_parser.add_argument(
+        "names",
+        help="a CSV of (concept_id, name, locale, ICD-10 code), like "
+        "diagnoses/input/pih-diagnoses-w-names.csv",
+    )
+    db_parser.set_defaults(run=write_db)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,481 @@
+#! /usr/bin/env python3
+"""
+emit_sql.py
+
+Generates the bulk INSERT and UPDATE statements in this directory from the
+match CSVs, instead of writing them out by hand. The CSV is streamed and its
+rows are emitted in batches of multi-row statements, e.g.
+
+    INSERT INTO concept_set (concept_id, concept_set, ...) VALUES
+        (10011, 11722, 201, 16404, now(), uuid()),
+        ...
+        (10018, 11722, 202, 16404, now(), uuid());
+
+    UPDATE concept_name SET locale_preferred = 0
+    WHERE locale = 'es' AND concept_id IN (198, 141, ...);
+
+so that MySQL parses one statement per batch rather than one per row.
+Inserts can also be written as a tab-separated file for LOAD DATA INFILE,
+which is faster still for large loads.
+
+With --check, the statements are also run against an in-memory SQLite
+stand-in for the table, which fails loudly if any of them don't parse or
+don't touch the expected number of rows.
+
+The dx.sql concept set, for example, comes from the diagnosis matches with
+
+    ./emit_sql.py insert concept_set ../diagnoses/output/diagnoses-matches-pih.csv \\
+        --columns concept_id,_ --value concept_set=11722 --counter sort_weight=201 \\
+        --value creator=16404 --sql date_created='now()' --sql uuid='uuid()'
+"""
+import argparse
+import csv
+from itertools import islice
+import re
+import sqlite3
+import sys
+import uuid
+
+# How many CSV rows go in each statement. Can be set at runtime with
+# --batch-size. MySQL's max_allowed_packet limits how large this can be.
+BATCH_SIZE = 1000
+
+# Values that are written unquoted. Numbers with leading zeros are quoted, so
+# that codes like '007' keep them.
+NUMBER = re.compile(r"^-?(0|[1-9]\d*)(\.\d+)?$")
+
+# What --columns uses for a CSV column that isn't loaded
+SKIP = "_"
+
+# The escapes that LOAD DATA INFILE expects by default
+TSV_ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"}
+
+
+def literal(value, dialect="mysql"):
+    """
+    Renders a CSV value (a str, or None) as an SQL literal for `dialect`,
+    'mysql' or 'sqlite'. Numbers are left unquoted, empty values become
+    NULL, and everything else is single-quoted.
+    """
+    if value is None or value == "":
+        return "NULL"
+    if NUMBER.match(value):
+        return value
+    escaped = value.replace("'", "''")
+    if dialect == "mysql":
+        escaped = escaped.replace("\\", "\\\\")
+    return "'" + escaped + "'"
+
+
+def read_rows(filename, columns, header):
+    """
+    Streams the rows of the CSV at `filename`, keeping the values of the
+    columns that aren't `SKIP` in `columns`, in order. Blank lines are
+    skipped, as is the first line if `header`.
+
+    Yields:
+        list: the kept values of a row, as strings
+    """
+    keep = [i for i, c in enumerate(columns) if c != SKIP]
+    with open(filename, "rt", encoding="utf8", newline="") as f:
+        reader = csv.reader(f)
+        if header:
+            next(reader, None)
+        for row in reader:
+            if row:
+                yield [row[i] if i < len(row) else "" for i in keep]
+
+
+def batches(rows, size):
+    """Splits `rows` into lists of up to `size` rows"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Insert:
+    """
+    Inserts a row into `table` per CSV row. Each row gets the CSV values for
+    `columns`, the same `values` (literals) and `expressions` (SQL, such as
+    uuid()), and a number for each of `counters` that goes up by one per row.
+    """
+
+    def __init__(self, table, columns, values, expressions, counters):
+        """
+        Args:
+            table (str)
+            columns (list): the column of each CSV column, or SKIP
+            values (dict): {column: value}
+            expressions (dict): {column: SQL expression}
+            counters (dict): {column: the int the first row gets}
+        """
+        self.table = table
+        self.columns = [c for c in columns if c != SKIP]
+        self.values = values
+        self.expressions = expressions
+        self.counters = counters
+
+    @property
+    def column_names(self):
+        return (
+            self.columns
+            + list(self.values)
+            + list(self.counters)
+            + list(self.expressions)
+        )
+
+    def row_values(self, rows):
+        """The values of the columns that aren't expressions, per row"""
+        constants = list(self.values.values())
+        for n, row in enumerate(rows):
+            counters = [str(start + n) for start in self.counters.values()]
+            yield row + constants + counters
+
+    def statements(self, rows, batch_size, dialect="mysql"):
+        """Yields an INSERT statement per `batch_size` rows"""
+        head = "INSERT INTO {} ({}) VALUES\n".format(
+            self.table, ", ".join(self.column_names)
+        )
+        expressions = list(self.expressions.values())
+        for batch in batches(self.row_values(rows), batch_size):
+            tuples = ",\n".join(
+                "    ({})".format(
+                    ", ".join([literal(v, dialect) for v in values] + expressions)
+                )
+                for values in batch
+            )
+            yield head + tuples + ";\n"
+
+    def load_data(self, rows, tsv_filename):
+        """
+        Writes the rows to `tsv_filename` in the format LOAD DATA INFILE
+        reads by default, and returns the statement that loads it
+        """
+        with open(tsv_filename, "w", encoding="utf8", newline="\n") as f:
+            for row in self.row_values(rows):
+                f.write("\t".join(tsv_field(v) for v in row) + "\n")
+        loaded = self.columns + list(self.values) + list(self.counters)
+        statement = (
+            "LOAD DATA LOCAL INFILE '{}' INTO TABLE {} CHARACTER SET utf8\n"
+            "    ({})".format(tsv_filename, self.table, ", ".join(loaded))
+        )
+        if self.expressions:
+            statement += "\n    SET " + ", ".join(
+                "{} = {}".format(c, e) for c, e in self.expressions.items()
+            )
+        return statement + ";\n"
+
+    def check(self, rows, batch_size):
+        """
+        Runs the statements against an empty SQLite copy of the table.
+
+        Returns:
+            int: the number of rows inserted
+        """
+        db = stand_in_db(self.table, self.column_names)
+        counted = Counted(rows)
+        for statement in self.statements(counted, batch_size, dialect="sqlite"):
+            db.execute(statement)
+        expected = counted.count
+        (inserted,) = db.execute("SELECT COUNT(*) FROM " + self.table).fetchone()
+        if inserted != expected:
+            raise ValueError(
+                "Inserted {} rows into the stand-in, expected {}".format(
+                    inserted, expected
+                )
+            )
+        return inserted
+
+    def check_tsv(self, tsv_filename, expected):
+        """
+        Loads the file written by load_data into an empty SQLite copy of the
+        table, the way LOAD DATA INFILE would.
+
+        Returns:
+            int: the number of rows loaded
+        """
+        db = stand_in_db(self.table, self.column_names)
+        loaded = self.columns + list(self.values) + list(self.counters)
+        statement = "INSERT INTO {} ({}) VALUES ({})".format(
+            self.table,
+            ", ".join(loaded + list(self.expressions)),
+            ", ".join(["?"] * len(loaded) + list(self.expressions.values())),
+        )
+        with open(tsv_filename, "rt", encoding="utf8", newline="\n") as f:
+            for line in f:
+                fields = [tsv_value(v) for v in line[:-1].split("\t")]
+                if len(fields) != len(loaded):
+                    raise ValueError(
+                        "{} fields on a line of {}, expected {}".format(
+                            len(fields), tsv_filename, len(loaded)
+                        )
+                    )
+                db.execute(statement, fields)
+        (inserted,) = db.execute("SELECT COUNT(*) FROM " + self.table).fetchone()
+        if inserted != expected:
+            raise ValueError(
+                "Loaded {} rows into the stand-in, expected {}".format(
+                    inserted, expected
+                )
+            )
+        return inserted
+
+
+class Update:
+    """
+    Sets `values` on the rows of `table` where `key` is one of the CSV values
+    and all of `where` match.
+    """
+
+    def __init__(self, table, key, values, where):
+        """
+        Args:
+            table (str)
+            key (str): the column the CSV values are of
+            values (dict): {column: value}
+            where (dict): {column: value}
+        """
+        self.table = table
+        self.key = key
+        self.values = values
+        self.where = where
+
+    def statements(self, keys, batch_size, dialect="mysql"):
+        """Yields an UPDATE statement per `batch_size` distinct keys"""
+        assignments = ", ".join(
+            "{} = {}".format(c, literal(v, dialect)) for c, v in self.values.items()
+        )
+        conditions = "".join(
+            "{} = {} AND ".format(c, literal(v, dialect)) for c, v in self.where.items()
+        )
+        for batch in batches(dict.fromkeys(keys), batch_size):
+            yield "UPDATE {} SET {}\nWHERE {}{} IN ({});\n".format(
+                self.table,
+                assignments,
+                conditions,
+                self.key,
+                ", ".join(literal(k, dialect) for k in batch),
+            )
+
+    def check(self, keys, batch_size):
+        """
+        Runs the statements against a SQLite stand-in for the table that has
+        one matching row per key.
+
+        Returns:
+            int: the number of rows updated
+        """
+        keys = list(dict.fromkeys(keys))
+        db = stand_in_db(self.table, [self.key] + list(self.where) + list(self.values))
+        # Seeded through literal(), so that the keys have the types they're
+        # compared with
+        seed = Insert(self.table, [self.key], self.where, {}, {})
+        for statement in seed.statements(([k] for k in keys), BATCH_SIZE, "sqlite"):
+            db.execute(statement)
+        updated = 0
+        for statement in self.statements(keys, batch_size, dialect="sqlite"):
+            updated += db.execute(statement).rowcount
+        if updated != len(keys):
+            raise ValueError(
+                "Updated {} rows of the stand-in, expected {}".format(
+                    updated, len(keys)
+                )
+            )
+        return updated
+
+
+class Counted:
+    """Wraps an iterable, counting the items taken from it"""
+
+    def __init__(self, items):
+        self.items = items
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.items:
+            self.count += 1
+            yield item
+
+
+def tsv_field(value):
+    """Renders a CSV value as a LOAD DATA INFILE field, like literal()"""
+    if value == "":
+        return "\\N"
+    return "".join(TSV_ESCAPES.get(c, c) for c in value)
+
+
+def tsv_value(field):
+    """Reads a LOAD DATA INFILE field back, undoing tsv_field(). NULL is None."""
+    if field == "\\N":
+        return None
+    unescape = {v[1]: k for k, v in TSV_ESCAPES.items()}
+    return re.sub(r"\\(.)", lambda m: unescape.get(m.group(1), m.group(1)), field)
+
+
+def stand_in_db(table, columns):
+    """
+    Returns:
+        sqlite3.Connection: an in-memory SQLite database with an untyped
+            `table` of `columns`, and the MySQL functions the statements use
+    """
+    db = sqlite3.connect(":memory:")
+    db.create_function("now", 0, lambda: "2000-01-01 00:00:00")
+    db.create_function("uuid", 0, lambda: str(uuid.uuid4()))
+    db.execute("CREATE TABLE {} ({})".format(table, ", ".join(columns)))
+    return db
+
+
+def assignments(pairs, parse=str):
+    """Parses ['column=value', ...] into {column: parse(value)}"""
+    result = {}
+    for pair in pairs or []:
+        column, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError("Expected column=value, got " + pair)
+        result[column] = parse(value)
+    return result
+
+
+def emit(statements, output):
+    """Writes `statements` to `output`, returning how many and their size"""
+    count = size = 0
+    for statement in statements:
+        output.write(statement + "\n")
+        count += 1
+        size += len(statement)
+    return count, size
+
+
+def main(args):
+    columns = args.columns.split(",")
+
+    def rows():
+        """Streams the CSV again, for each pass over it"""
+        return read_rows(args.csv, columns, args.header)
+
+    output = open(args.output, "w", encoding="utf8") if args.output else sys.stdout
+
+    if args.command == "insert":
+        statement = Insert(
+            args.table,
+            columns,
+            assignments(args.value),
+            assignments(args.sql),
+            assignments(args.counter, int),
+        )
+        if args.tsv:
+            output.write(statement.load_data(rows(), args.tsv))
+            emitted = "a LOAD DATA statement for " + args.tsv
+        else:
+            emitted = "{} statements ({} bytes)".format(
+                *emit(statement.statements(rows(), BATCH_SIZE), output)
+            )
+    else:
+        key = args.key or next(c for c in columns if c != SKIP)
+        if key not in columns:
+            raise ValueError("--key {} isn't one of --columns".format(key))
+        key_position = [c for c in columns if c != SKIP].index(key)
+
+        def keys():
+            return (row[key_position] for row in rows())
+
+        statement = Update(
+            args.table, key, assignments(args.set), assignments(args.where)
+        )
+        emitted = "{} statements ({} bytes)".format(
+            *emit(statement.statements(keys(), BATCH_SIZE), output)
+        )
+
+    if output is not sys.stdout:
+        output.close()
+    print("Wrote " + emitted, file=sys.stderr)
+    if args.check:
+        if args.command == "update":
+            checked = "{} rows updated".format(statement.check(keys(), BATCH_SIZE))
+        elif args.tsv:
+            expected = sum(1 for _ in rows())
+            checked = "{} rows loaded".format(statement.check_tsv(args.tsv, expected))
+        else:
+            checked = "{} rows inserted".format(statement.check(rows(), BATCH_SIZE))
+        print("Checked against SQLite: " + checked, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates bulk SQL statements from a CSV"
+    )
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("table", help="the table to insert into or update")
+    common.add_argument("csv", help="the CSV of values")
+    common.add_argument(
+        "--columns",
+        required=True,
+        help="the table column of each CSV column, in order, comma-separated. "
+        "Use {} for a CSV column to leave out.".format(SKIP),
+    )
+    common.add_argument(
+        "--header", action="store_true", help="skip the first line of the CSV"
+    )
+    common.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="how many CSV rows to put in each statement",
+    )
+    common.add_argument("-o", "--output", help="where to write. Default stdout.")
+    common.add_argument(
+        "--check",
+        action="store_true",
+        help="also run the statements against a SQLite stand-in for the table",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    insert = commands.add_parser("insert", parents=[common])
+    insert.add_argument(
+        "--value",
+        action="append",
+        metavar="COLUMN=VALUE",
+        help="a value to give every row",
+    )
+    insert.add_argument(
+        "--sql",
+        action="append",
+        metavar="COLUMN=EXPRESSION",
+        help="an SQL expression to give every row, e.g. uuid=uuid()",
+    )
+    insert.add_argument(
+        "--counter",
+        action="append",
+        metavar="COLUMN=START",
+        help="a number that goes up by one per row, e.g. sort_weight=201",
+    )
+    insert.add_argument(
+        "--tsv",
+        metavar="FILE",
+        help="write the rows to FILE for LOAD DATA INFILE instead of as INSERTs",
+    )
+
+    update = commands.add_parser("update", parents=[common])
+    update.add_argument(
+        "--key", help="the column of --columns to select rows by. Default the first.",
+    )
+    update.add_argument(
+        "--set",
+        action="append",
+        required=True,
+        metavar="COLUMN=VALUE",
+        help="a value to set",
+    )
+    update.add_argument(
+        "--where",
+        action="append",
+        metavar="COLUMN=VALUE",
+        help="a condition the rows must also meet",
+    )
+
+    args = parser.parse_args()
+    BATCH_SIZE = args.batch_size
+    main(args)